@@ -0,0 +1,203 @@
+"""
+Offline benchmarks of the twtcalc, twttopo and twtsoils kernels on synthetic
+inputs (see synthetic.py), compared with a stored baseline.
+
+  python run_benchmarks.py                              # 1000 x 1000 px, 30 days
+  python run_benchmarks.py --sizes 1000 5000 --days 30 365
+  python run_benchmarks.py --update-baseline            # store this machine's results
+
+Every kernel is timed (best of --repeat runs) and summarized by statistics of
+its output raster. A kernel fails when its statistics differ from the
+baseline (a change of results) and is flagged as slower when its time
+exceeds the baseline time by more than --tolerance; --fail-slower turns that
+into a failure too. Baseline times are only meaningful on the machine that
+wrote them.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import numpy
+import rasterio
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import synthetic
+import twtcalc
+import twtsoils
+import twttopo
+
+FNAME_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+def bench_soil_transmissivity(case, dir_out, workers):
+    fname = os.path.join(dir_out, 'soil_transmissivity.tiff')
+    twtsoils.set_soil_transmissivity(fname_texture        = case['soil_texture'],
+                                     fname_dem            = case['dem'],
+                                     fname_transmissivity = fname,
+                                     overwrite            = True)
+    case['soil_transmissivity'] = fname
+    return fname
+
+def bench_twi_mean(case, dir_out, workers):
+    fname = os.path.join(dir_out, 'twi_mean.tiff')
+    twttopo.calc_twi_mean(fname_twi      = case['twi'],
+                          fname_twi_mean = fname,
+                          wtd_raw_dir    = case['wtd_raw_dir'],
+                          overwrite      = True)
+    case['twi_mean'] = fname
+    return fname
+
+def bench_inundation(case, dir_out, workers):
+    dirname = os.path.join(dir_out, 'inundation')
+    twtcalc.calculate_inundation(dt_start           = case['dt_start'],
+                                 dt_end             = case['dt_end'],
+                                 wtd_raw_dir        = case['wtd_raw_dir'],
+                                 inundation_out_dir = dirname,
+                                 fname_twi          = case['twi'],
+                                 fname_twi_mean     = case['twi_mean'],
+                                 fname_soil_trans   = case['soil_transmissivity'],
+                                 workers            = workers,
+                                 overwrite          = True)
+    case['inundation_raw_dir'] = dirname
+    return os.path.join(dirname, f'inundation_{case["dt_end"].strftime("%Y%m%d")}.tiff')
+
+def bench_summary_perc_inundated(case, dir_out, workers):
+    fname = twtcalc.calculate_summary_perc_inundated(dt_start               = case['dt_start'],
+                                                     dt_end                 = case['dt_end'],
+                                                     inundation_raw_dir     = case['inundation_raw_dir'],
+                                                     inundation_summary_dir = os.path.join(dir_out, 'summary'),
+                                                     fname_dem              = case['dem'],
+                                                     overwrite              = True)
+    case['perc_inundated'] = fname
+    return fname
+
+def bench_strm_permanence(case, dir_out, workers):
+    fname_p, fname_np = twtcalc.calculate_strm_permanence(fname_perc_inundation = case['perc_inundated'],
+                                                          fname_strm_mask       = case['stream_mask'],
+                                                          overwrite             = True)
+    return fname_np
+
+# in dependency order - each kernel uses the outputs of the ones before it
+KERNELS = [('soil_transmissivity',    bench_soil_transmissivity),
+           ('calc_twi_mean',          bench_twi_mean),
+           ('calculate_inundation',   bench_inundation),
+           ('summary_perc_inundated', bench_summary_perc_inundated),
+           ('strm_permanence',        bench_strm_permanence)]
+
+def raster_stats(fname):
+    """Statistics of a single band raster that identify its values"""
+    with rasterio.open(fname) as src:
+        arr = src.read(1, masked=True).astype(numpy.float64).filled(numpy.nan)
+    valid = numpy.isfinite(arr)
+    return {'shape'   : list(arr.shape),
+            'n_valid' : int(valid.sum()),
+            'sum'     : float(arr[valid].sum()),
+            'min'     : float(arr[valid].min()) if valid.any() else None,
+            'max'     : float(arr[valid].max()) if valid.any() else None}
+
+def same_stats(a, b, rtol=1e-5):
+    if a.keys() != b.keys():
+        return False
+    for k in a:
+        if a[k] is None or b[k] is None or isinstance(a[k], list):
+            if a[k] != b[k]: return False
+        elif not numpy.isclose(a[k], b[k], rtol=rtol, atol=1e-6):
+            return False
+    return True
+
+def run_case(size, n_days, seed, dir_work, repeat=1, workers=1, verbose=False):
+    name = synthetic.case_name(size, n_days, seed)
+    case = synthetic.make_case(os.path.join(dir_work, name), size, n_days, seed=seed, verbose=verbose)
+    results = dict()
+    for kernel, func in KERNELS:
+        times = list()
+        for _ in range(max(1, repeat)):
+            dir_out = os.path.join(dir_work, name, 'out', kernel)
+            shutil.rmtree(dir_out, ignore_errors=True)
+            os.makedirs(dir_out)
+            t0 = time.perf_counter()
+            fname = func(case, dir_out, workers)
+            times.append(time.perf_counter() - t0)
+            stats = raster_stats(fname)
+        results[kernel] = {'seconds': min(times), 'result': stats}
+        if verbose: print(f' {name} {kernel}: {min(times):.2f} s')
+    return name, results
+
+def compare(results, baseline, tolerance):
+    """Rows of (case, kernel, seconds, baseline seconds, status) and whether any result changed"""
+    rows, changed, slower = list(), False, False
+    for name, kernels in results.items():
+        for kernel, res in kernels.items():
+            base = baseline.get('cases', dict()).get(name, dict()).get(kernel)
+            if base is None:
+                rows.append((name, kernel, res['seconds'], None, 'no baseline'))
+                continue
+            if not same_stats(res['result'], base['result']):
+                status, changed = 'RESULT CHANGED', True
+            elif res['seconds'] > base['seconds'] * (1. + tolerance):
+                status, slower = 'slower', True
+            elif res['seconds'] < base['seconds'] / (1. + tolerance):
+                status = 'faster'
+            else:
+                status = 'ok'
+            rows.append((name, kernel, res['seconds'], base['seconds'], status))
+    return rows, changed, slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Synthetic-data benchmarks of the twtcalc, twttopo and twtsoils kernels')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000], help='grid sizes (pixels per side)')
+    parser.add_argument('--days', type=int, nargs='+', default=[30], help='numbers of days')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per kernel, the best time is kept')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes for calculate_inundation')
+    parser.add_argument('--workdir', default=None, help='directory for the synthetic cases (kept and reused), default a temporary directory')
+    parser.add_argument('--baseline', default=FNAME_BASELINE)
+    parser.add_argument('--update-baseline', action='store_true', help='write the results to the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown flagged as slower')
+    parser.add_argument('--fail-slower', action='store_true', help='exit with an error when a kernel is slower')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    tmp = None
+    dir_work = args.workdir
+    if dir_work is None:
+        tmp = tempfile.TemporaryDirectory(prefix='twt_bench_')
+        dir_work = tmp.name
+    try:
+        results = dict()
+        for size in args.sizes:
+            for n_days in args.days:
+                name, res = run_case(size, n_days, args.seed, dir_work, repeat=args.repeat,
+                                     workers=args.workers, verbose=args.verbose)
+                results[name] = res
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+    baseline = dict()
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    rows, changed, slower = compare(results, baseline, args.tolerance)
+    print(f'{"case":<22} {"kernel":<24} {"seconds":>9} {"baseline":>9}  status')
+    for name, kernel, seconds, base_seconds, status in rows:
+        base_str = f'{base_seconds:9.2f}' if base_seconds is not None else f'{"-":>9}'
+        print(f'{name:<22} {kernel:<24} {seconds:9.2f} {base_str}  {status}')
+
+    if args.update_baseline:
+        baseline.setdefault('cases', dict()).update(results)
+        baseline['machine'] = {'platform' : platform.platform(),
+                               'python'   : platform.python_version(),
+                               'cpus'     : os.cpu_count()}
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print(f'wrote baseline {args.baseline}')
+        return 0
+    if changed or (slower and args.fail_slower):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""
+Synthetic inputs for the benchmarks: a DEM, TWI, stream mask and soil texture
+polygons on a size x size grid (EPSG:5070, 10 m pixels) and n_days of daily
+water table depth on the ParFlow CONUS1 grid covering it. Everything is
+generated from a seed, so a case is identical on every machine.
+"""
+import os
+import json
+import datetime
+import numpy
+import rasterio
+import rasterio.warp
+import geopandas
+import shapely
+import twtwt
+import twtsoils
+
+PIXEL_M   = 10.
+ORIGIN    = (1000000., 1500000.) # upper left corner of the fine grid in EPSG:5070
+CRS       = 'EPSG:5070'
+DT_START  = datetime.datetime(2003, 10, 1)
+VALLEY_M  = 4000. # spacing of the synthetic valleys
+STRIP     = 1024  # rows generated at a time
+
+def case_name(size, n_days, seed=0):
+    return f'{size}x{size}_{n_days}d_s{seed}'
+
+def make_case(dirname, size, n_days, seed=0, verbose=False):
+    """
+    Write the inputs of one case to dirname (reused if complete) and return a
+    dict of their file names plus dt_start and dt_end.
+    """
+    fnames = {'dem'          : os.path.join(dirname, 'dem.tiff'),
+              'twi'          : os.path.join(dirname, 'twi.tiff'),
+              'stream_mask'  : os.path.join(dirname, 'stream_mask.tiff'),
+              'soil_texture' : os.path.join(dirname, 'soil_texture.gpkg'),
+              'wtd_raw_dir'  : os.path.join(dirname, 'wtd'),
+              'dt_start'     : DT_START,
+              'dt_end'       : DT_START + datetime.timedelta(days=n_days - 1)}
+    fname_meta = os.path.join(dirname, 'case.json')
+    meta = {'size': size, 'n_days': n_days, 'seed': seed}
+    if os.path.isfile(fname_meta):
+        with open(fname_meta, 'r') as f:
+            if json.load(f) == meta:
+                if verbose: print(f' using existing synthetic case {dirname}')
+                return fnames
+        os.remove(fname_meta)
+    os.makedirs(dirname, exist_ok=True)
+    if verbose: print(f' generating synthetic case {dirname}')
+    profile = {'driver'    : 'GTiff',
+               'height'    : size,
+               'width'     : size,
+               'count'     : 1,
+               'dtype'     : 'float32',
+               'crs'       : CRS,
+               'transform' : rasterio.transform.from_origin(ORIGIN[0], ORIGIN[1], PIXEL_M, PIXEL_M),
+               'tiled'     : True,
+               'blockxsize': 512,
+               'blockysize': 512,
+               'compress'  : 'deflate'}
+    _write_topo(fnames, profile, seed)
+    _write_soil_texture(fnames['soil_texture'], profile, seed)
+    _write_wtd(fnames['wtd_raw_dir'], profile, n_days, seed)
+    # case.json is written last, a case without it is incomplete
+    with open(fname_meta, 'w') as f:
+        json.dump(meta, f)
+    return fnames
+
+def _valley_distance(rows, cols):
+    """Distance (m) to the nearest synthetic valley floor, valleys run north-south"""
+    x = (cols + 0.5) * PIXEL_M
+    y = (rows + 0.5) * PIXEL_M
+    meander = 300. * numpy.sin(y / 1700.)
+    return numpy.abs(numpy.mod(x + meander, VALLEY_M) - VALLEY_M / 2.)
+
+def _write_topo(fnames, profile, seed):
+    """DEM (tilted plane, hills and valleys), TWI (high in valleys) and stream mask (valley floors)"""
+    size = profile['height']
+    with rasterio.open(fnames['dem'], 'w', **profile, nodata=-9999.) as dem, \
+         rasterio.open(fnames['twi'], 'w', **profile, nodata=-9999.) as twi, \
+         rasterio.open(fnames['stream_mask'], 'w', **profile) as strm:
+        for row_off in range(0, size, STRIP):
+            height = min(STRIP, size - row_off)
+            window = rasterio.windows.Window(0, row_off, size, height)
+            rows, cols = numpy.mgrid[row_off:row_off + height, 0:size].astype(numpy.float64)
+            rng = numpy.random.default_rng([seed, row_off])
+            dist = _valley_distance(rows, cols)
+            x, y = cols * PIXEL_M, rows * PIXEL_M
+            z = (500. - 0.002 * y + 25. * numpy.sin(x / 2300.) * numpy.cos(y / 3100.)
+                 + 0.01 * dist + rng.random(dist.shape))
+            dem.write(z.astype(numpy.float32), 1, window=window)
+            t = 4. + 10. * numpy.exp(-(dist / 250.) ** 2) + 2. * rng.random(dist.shape)
+            twi.write(t.astype(numpy.float32), 1, window=window)
+            strm.write((dist < 1.5 * PIXEL_M).astype(numpy.float32), 1, window=window)
+
+def _write_soil_texture(fname, profile, seed):
+    """Square soil texture polygons (about 20 x 20 across the grid), a few without texture"""
+    rng = numpy.random.default_rng([seed, 1])
+    size = profile['height']
+    step = max(1, size // 20) * PIXEL_M
+    minx, maxy = ORIGIN
+    textures = list(twtsoils.TRANSMISSIVITY_F.keys())
+    geoms, texture = list(), list()
+    n = int(numpy.ceil(size * PIXEL_M / step))
+    for i in range(n):
+        for j in range(n):
+            x0, y1 = minx + j * step, maxy - i * step
+            geoms.append(shapely.geometry.box(x0, y1 - step, x0 + step, y1))
+            texture.append(None if rng.random() < 0.03 else textures[rng.integers(len(textures))])
+    soils = geopandas.GeoDataFrame({'texture': texture}, geometry=geoms, crs=CRS)
+    if os.path.isfile(fname): os.remove(fname)
+    soils.to_file(fname, driver='GPKG')
+
+def _write_wtd(dirname, profile, n_days, seed):
+    """Daily water table depth on the CONUS1 cells covering the grid: a smooth field plus a seasonal cycle"""
+    conus1_proj, _, conus1_transform, _ = twtwt._get_parflow_conus1_grid_info()
+    bounds = rasterio.transform.array_bounds(profile['height'], profile['width'], profile['transform'])
+    minx, miny, maxx, maxy = rasterio.warp.transform_bounds(CRS, conus1_proj, *bounds)
+    # snap to the CONUS1 lattice with a one cell margin (rows south to north, as the hydroframe tiffs)
+    x0 = conus1_transform.c + (numpy.floor((minx - conus1_transform.c) / 1000.) - 1) * 1000.
+    y0 = conus1_transform.f + (numpy.floor((miny - conus1_transform.f) / 1000.) - 1) * 1000.
+    width  = int(numpy.ceil((maxx - x0) / 1000.)) + 1
+    height = int(numpy.ceil((maxy - y0) / 1000.)) + 1
+    transform = rasterio.transform.Affine(1000., 0., x0, 0., 1000., y0)
+    rng = numpy.random.default_rng([seed, 2])
+    base = 0.2 + 3. * rng.random((height, width))
+    base[0, 0] = numpy.nan
+    os.makedirs(dirname, exist_ok=True)
+    wtd_profile = {'driver': 'GTiff', 'height': height, 'width': width, 'count': 1, 'dtype': 'float32',
+                   'crs': conus1_proj, 'transform': transform, 'nodata': numpy.nan}
+    for i in range(n_days):
+        dt = DT_START + datetime.timedelta(days=i)
+        season = 1.5 * numpy.sin(2. * numpy.pi * (i + 90.) / 365.25)
+        wtd = numpy.clip(base + season + 0.3 * rng.standard_normal(base.shape), 0., None)
+        with rasterio.open(os.path.join(dirname, f'wtd_{dt.strftime("%Y%m%d")}.tiff'), 'w', **wtd_profile) as dst:
+            dst.write(wtd.astype(numpy.float32), 1)
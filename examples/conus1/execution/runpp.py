@@ -13,6 +13,9 @@ if __name__ == "__main__":
             fname_namelist = os.path.join(subdir_full,'namelist.yaml')
             kwargs = {'fname_namelist' : fname_namelist}
             tasks.append(kwargs)
+    twtmain.prepare_sources(fname_namelists=[kwargs['fname_namelist'] for kwargs in tasks], verbose=True, workers=n_cores)
     with multiprocessing.Pool(processes=n_cores) as pool:
         results_async = [pool.apply_async(twtmain.calculate_async_wrapper, kwds=kwargs) for kwargs in tasks]
-        results = [res.get() for res in results_async]
\ No newline at end of file
+        results = [res.get() for res in results_async]
+    twtmain.merge_run_reports(fname_namelists=[kwargs['fname_namelist'] for kwargs in tasks],
+                              fname_output=os.path.join(dir_subdomains,'run_report.csv'), verbose=True)
\ No newline at end of file
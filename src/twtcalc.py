@@ -1,6 +1,12 @@
 import os
+import json
 import shutil
 import datetime
+import tempfile
+import contextlib
+import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory
 import rioxarray
 import xarray as xr
 import zipfile
@@ -8,11 +14,16 @@ from rasterio.enums import Resampling
 import numpy as np
 import rasterio
 from rasterio import warp
+from rasterio.windows import Window
+from twtcube import InundationCube
+import twtreport
+import twtutils
 
 def calculate_strm_permanence(
     *,
     fname_perc_inundation=None,
     fname_strm_mask=None,
+    strm_threshold=None,
     verbose=False,
     overwrite=False,
     atol=1e-6 # tolerance for treating 100% as perennial
@@ -20,6 +31,10 @@ def calculate_strm_permanence(
     """
     In-memory stream permanence computation
 
+    With strm_threshold, fname_strm_mask is a stream mask sweep (see
+    twttopo.calc_stream_mask_sweep) and the streams are those of that
+    threshold.
+
     Outputs (float32, NaN nodata embedded in pixel values):
       - perennial_strms_*.tiff: 1 where perennial (~100%), NaN elsewhere
       - nonperennial_strms_*.tiff: percent where 0 < perc < 100 - atol on streams, NaN elsewhere
@@ -30,13 +45,7 @@ def calculate_strm_permanence(
     if any(v is None for v in [fname_perc_inundation, fname_strm_mask]):
         raise ValueError("Required: fname_perc_inundation and fname_strm_mask")
 
-    # Build output names, robust to .tif/.tiff
-    base = os.path.basename(fname_perc_inundation)
-    stem, _ = os.path.splitext(base)
-    dstr = stem.replace("percent_inundated_grid_", "")
-    out_dir = os.path.dirname(fname_perc_inundation)
-    fname_p  = os.path.join(out_dir, f"perennial_strms_{dstr}.tiff")
-    fname_np = os.path.join(out_dir, f"nonperennial_strms_{dstr}.tiff")
+    fname_p, fname_np = strm_permanence_fnames(fname_perc_inundation)
 
     if (os.path.isfile(fname_p) and os.path.isfile(fname_np)) and not overwrite:
         if verbose:
@@ -77,7 +86,11 @@ def calculate_strm_permanence(
         mask_da = mask_da.where(mask_da != nd_mask, other=np.nan)
 
     # Build boolean stream mask: True where mask == 1 (NaNs -> False)
-    stream_mask_bool = (mask_da == 1)
+    if strm_threshold is None:
+        stream_mask_bool = (mask_da == 1)
+    else:
+        step = stream_sweep_step(fname_strm_mask, strm_threshold)
+        stream_mask_bool = (mask_da >= 1) & (mask_da <= step)
 
     # Restrict perc to streams; outside -> NaN
     perc_on_streams = perc_da.where(stream_mask_bool, other=np.nan)
@@ -108,6 +121,30 @@ def calculate_strm_permanence(
 
     return fname_p, fname_np
 
+def strm_permanence_fnames(fname_perc_inundation):
+    """Perennial and nonperennial stream rasters calculate_strm_permanence writes for a percent inundated grid"""
+    # robust to .tif/.tiff
+    stem, _ = os.path.splitext(os.path.basename(fname_perc_inundation))
+    dstr = stem.replace("percent_inundated_grid_", "")
+    out_dir = os.path.dirname(fname_perc_inundation)
+    return (os.path.join(out_dir, f"perennial_strms_{dstr}.tiff"),
+            os.path.join(out_dir, f"nonperennial_strms_{dstr}.tiff"))
+
+def stream_sweep_step(fname_strm_sweep, threshold):
+    """Step of threshold in a stream mask sweep, its streams are the cells with 1 <= value <= step"""
+    with rasterio.open(fname_strm_sweep) as src:
+        thresholds = json.loads(src.tags().get('stream_thresholds', '[]'))
+    if float(threshold) not in thresholds:
+        raise ValueError(f'stream_sweep_step threshold {threshold} is not one of the thresholds {thresholds} of {fname_strm_sweep}')
+    return thresholds.index(float(threshold)) + 1
+
+def stream_mask_from_sweep(fname_strm_sweep, threshold, window=None):
+    """Boolean stream mask of one threshold of a stream mask sweep (or of a window of it)"""
+    step = stream_sweep_step(fname_strm_sweep, threshold)
+    with rasterio.open(fname_strm_sweep) as src:
+        arr = src.read(1, window=window)
+    return (arr >= 1) & (arr <= step)
+
 def calculate_inundation_slow(
     *,
     dt_start: datetime.datetime,
@@ -181,51 +218,323 @@ def _read_base_grid_and_array(fname):
     - profile: rasterio profile with transform, crs, width, height
     """
     with rasterio.open(fname) as src:
-        profile = src.profile.copy()
-        arr = src.read(1, out_dtype="float32")
-        nodata = src.nodata
-        if nodata is not None and not np.isnan(nodata):
-            arr[arr == nodata] = np.nan
-        # Ensure single band float32; do not store NaN as nodata in metadata
-        profile.update(
-            count=1,
-            dtype="float32",
-        )
-        # Remove nodata key if present; we will keep NaNs in data
-        profile.pop("nodata", None)
+        profile = _base_profile(src)
+        arr = _read_window_as_float(src, None)
     return arr, profile
 
+def _base_profile(src):
+    """Single band float32 profile of an open dataset, without a nodata tag (NaNs are kept in data)"""
+    profile = src.profile.copy()
+    profile.update(
+        count=1,
+        dtype="float32",
+    )
+    profile.pop("nodata", None)
+    return profile
+
+def _read_window_as_float(src, window):
+    """Read band 1 of an open dataset (optionally a window) as float32 with nodata -> np.nan"""
+    arr = src.read(1, window=window, out_dtype="float32")
+    nodata = src.nodata
+    if nodata is not None and not np.isnan(nodata):
+        arr[arr == nodata] = np.nan
+    return arr
+
+def _iter_windows(height, width, blocksize=None):
+    """
+    Windows covering a (height, width) grid. With blocksize None a single full-grid
+    window is returned, otherwise block-aligned tiles of blocksize x blocksize pixels.
+    """
+    if blocksize is None:
+        return [Window(0, 0, width, height)]
+    return [Window(col_off, row_off,
+                   min(blocksize, width - col_off),
+                   min(blocksize, height - row_off))
+            for row_off in range(0, height, blocksize)
+            for col_off in range(0, width, blocksize)]
+
 def _reproject_to_target(src_path, dst_shape, dst_transform, dst_crs,
                          resampling=Resampling.bilinear, num_threads=None, dst_dtype="float32"):
     """
     Reproject a raster (first band) to a given target grid. Returns np.ndarray float32 with NaNs as nodata.
     """
     with rasterio.open(src_path) as src:
-        dst = np.empty(dst_shape, dtype=dst_dtype)
-        warp.reproject(
-            source=rasterio.band(src, 1),
-            destination=dst,
-            src_transform=src.transform,
-            src_crs=src.crs,
-            src_nodata=src.nodata,
-            dst_transform=dst_transform,
-            dst_crs=dst_crs,
-            dst_nodata=np.nan,
-            resampling=resampling,
-            num_threads=(num_threads or os.cpu_count() or 1),
-        )
+        return _reproject_band(src, dst_shape, dst_transform, dst_crs,
+                               resampling=resampling, num_threads=num_threads, dst_dtype=dst_dtype)
+
+def _reproject_band(src, dst_shape, dst_transform, dst_crs,
+                    resampling=Resampling.bilinear, num_threads=None, dst_dtype="float32"):
+    """
+    Reproject the first band of an open dataset to a given target grid (or window of it).
+    GDAL only reads the source blocks the target grid needs.
+    """
+    dst = np.empty(dst_shape, dtype=dst_dtype)
+    warp.reproject(
+        source=rasterio.band(src, 1),
+        destination=dst,
+        src_transform=src.transform,
+        src_crs=src.crs,
+        src_nodata=src.nodata,
+        dst_transform=dst_transform,
+        dst_crs=dst_crs,
+        dst_nodata=np.nan,
+        resampling=resampling,
+        num_threads=(num_threads or os.cpu_count() or 1),
+    )
     return dst
 
-def _write_geotiff(fname, 
-                   arr, 
-                   profile, 
-                   compress="deflate", 
-                   bigtiff="IF_SAFER",
-                   blocksize=512, 
-                   zlevel=1, 
-                   predictor=2):
+class ResamplePlan:
     """
-    Write a single-band float32 GeoTIFF with tiling and compression.
+    Precomputed resampling operator from a (coarse) source grid to a (fine) target grid.
+
+    The coordinate transforms are done once: for every target pixel the plan stores
+    the flat index of its source pixel (nearest) or of the upper-left pixel of its
+    2x2 source neighbourhood plus the fractional offsets (bilinear). apply() is then
+    a NumPy gather / weighted sum, so a daily WTD array can be resampled without
+    calling the GDAL warper. Source nodata (NaN) is handled like GDAL does: the
+    target is nodata if the source pixel containing it is nodata, otherwise the
+    bilinear weights are renormalised over the valid neighbours.
+
+    The source array is padded by one pixel of NaN on each side so that every
+    neighbour index is in range; target pixels outside the source extent point
+    at the upper-left padding cell and so resample to NaN.
+    With scratch_dir the index/weight grids are memory-mapped .npy files.
+    """
+
+    supported = (Resampling.bilinear, Resampling.nearest)
+
+    def __init__(self, src_shape, src_transform, src_crs,
+                 dst_shape, dst_transform, dst_crs,
+                 resampling=Resampling.bilinear, blocksize=512, scratch_dir=None,
+                 approx_step=16):
+        if resampling not in ResamplePlan.supported:
+            raise ValueError(f'ResamplePlan does not support resampling method {resampling}')
+        self.src_shape     = tuple(src_shape)
+        self.src_transform = src_transform
+        self.src_crs       = rasterio.crs.CRS.from_user_input(src_crs)
+        self.dst_shape     = tuple(dst_shape)
+        self.dst_transform = dst_transform
+        self.resampling    = resampling
+        self.bilinear      = resampling == Resampling.bilinear
+        self.approx_step   = max(int(approx_step or 1), 1)
+        self.index = _empty_grid(self.dst_shape, np.int32, scratch_dir, 'plan_index.npy')
+        self.fx    = _empty_grid(self.dst_shape, np.float32, scratch_dir, 'plan_fx.npy') if self.bilinear else None
+        self.fy    = _empty_grid(self.dst_shape, np.float32, scratch_dir, 'plan_fy.npy') if self.bilinear else None
+        dst_crs = rasterio.crs.CRS.from_user_input(dst_crs)
+        for window in _iter_windows(self.dst_shape[0], self.dst_shape[1], blocksize):
+            self._build_window(window, dst_crs)
+
+    def _build_window(self, window, dst_crs):
+        """Source pixel coordinates of the target pixel centres in window"""
+        src_h, src_w = self.src_shape
+        src_c, src_r = self._src_coords(window, dst_crs)
+        inside = (src_c >= 0.0) & (src_c <= src_w) & (src_r >= 0.0) & (src_r <= src_h)
+        if self.bilinear:
+            # upper-left neighbour of the 2x2 stencil (pixel centres at +0.5)
+            c0 = np.floor(src_c - 0.5)
+            r0 = np.floor(src_r - 0.5)
+            self.fx[window.toslices()] = np.where(inside, src_c - 0.5 - c0, 0.0).astype(np.float32)
+            self.fy[window.toslices()] = np.where(inside, src_r - 0.5 - r0, 0.0).astype(np.float32)
+        else:
+            c0 = np.minimum(np.floor(src_c), src_w - 1)
+            r0 = np.minimum(np.floor(src_r), src_h - 1)
+        index = (r0 + 1) * (src_w + 2) + (c0 + 1)
+        # outside the source extent -> the (always NaN) upper-left padding cell with zero offsets
+        self.index[window.toslices()] = np.where(inside, index, 0).astype(np.int32)
+
+    def _src_coords(self, window, dst_crs):
+        """
+        Fractional source (col, row) of the target pixel centres in window. The
+        projection is evaluated exactly on a lattice of every approx_step-th
+        pixel and interpolated bilinearly in between (coarse-to-fine geometry
+        is smooth at this scale, so the error is far below a source pixel).
+        """
+        def lattice(n):
+            return np.unique(np.append(np.arange(0, n, self.approx_step), n - 1))
+
+        def interp_weights(lat, n):
+            k = np.clip(np.searchsorted(lat, np.arange(n), side='right') - 1, 0, max(len(lat) - 2, 0))
+            span = np.diff(lat).astype(np.float64) if len(lat) > 1 else np.ones(1)
+            t = (np.arange(n) - lat[k]) / span[np.minimum(k, len(span) - 1)]
+            k1 = np.minimum(k + 1, len(lat) - 1)
+            return k, k1, t
+
+        lat_r = lattice(window.height)
+        lat_c = lattice(window.width)
+        rows, cols = np.meshgrid(lat_r + window.row_off + 0.5, lat_c + window.col_off + 0.5, indexing='ij')
+        xs, ys = self.dst_transform * (cols.ravel(), rows.ravel())
+        if dst_crs != self.src_crs:
+            xs, ys = warp.transform(dst_crs, self.src_crs, xs, ys)
+        lat_src_c, lat_src_r = ~self.src_transform * (np.asarray(xs), np.asarray(ys))
+        lat_src_c = np.asarray(lat_src_c, dtype=np.float64).reshape(rows.shape)
+        lat_src_r = np.asarray(lat_src_r, dtype=np.float64).reshape(rows.shape)
+        kr, kr1, tr = interp_weights(lat_r, window.height)
+        kc, kc1, tc = interp_weights(lat_c, window.width)
+        tr = tr[:, None]
+        tc = tc[None, :]
+        out = list()
+        for lat_v in (lat_src_c, lat_src_r):
+            top = lat_v[kr][:, kc] * (1.0 - tc) + lat_v[kr][:, kc1] * tc
+            bot = lat_v[kr1][:, kc] * (1.0 - tc) + lat_v[kr1][:, kc1] * tc
+            out.append(top * (1.0 - tr) + bot * tr)
+        return out[0], out[1]
+
+    def block_mean(self, dst_arr, strip_rows=1024):
+        """
+        Mean of the finite pixels of dst_arr (shape dst_shape) in each source
+        cell, as a (src_h, src_w) float32 array (NaN for cells without any).
+        With a nearest plan the index is the label of the source cell that
+        contains each target pixel centre, so the means are exact sums over
+        labels (numpy.bincount) and apply() broadcasts them back.
+        """
+        if self.bilinear:
+            raise ValueError('ResamplePlan.block_mean needs a nearest plan')
+        src_h, src_w = self.src_shape
+        n = (src_h + 2) * (src_w + 2)
+        sums   = np.zeros(n, dtype=np.float64)
+        counts = np.zeros(n, dtype=np.int64)
+        for row_off in range(0, self.dst_shape[0], strip_rows):
+            rows = slice(row_off, min(row_off + strip_rows, self.dst_shape[0]))
+            index = np.asarray(self.index[rows]).ravel()
+            vals  = np.asarray(dst_arr[rows], dtype=np.float64).ravel()
+            ok = np.isfinite(vals) & (index > 0)
+            sums   += np.bincount(index[ok], weights=vals[ok], minlength=n)
+            counts += np.bincount(index[ok], minlength=n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(counts > 0, sums / counts, np.nan)
+        return mean.reshape(src_h + 2, src_w + 2)[1:-1, 1:-1].astype(np.float32)
+
+    def save(self, dirname):
+        """Write the plan to dirname (plan.json and the .npy grids) for ResamplePlan.load"""
+        os.makedirs(dirname, exist_ok=True)
+        for name in ('index', 'fx', 'fy'):
+            arr = getattr(self, name)
+            fname = os.path.join(dirname, f'plan_{name}.npy')
+            if arr is not None and not (isinstance(arr, np.memmap) and os.path.abspath(arr.filename) == os.path.abspath(fname)):
+                np.save(fname, arr)
+        meta = {'src_shape'     : list(self.src_shape),
+                'src_transform' : list(self.src_transform)[:6],
+                'src_crs'       : self.src_crs.to_wkt(),
+                'dst_shape'     : list(self.dst_shape),
+                'dst_transform' : list(self.dst_transform)[:6],
+                'resampling'    : self.resampling.name,
+                'approx_step'   : self.approx_step}
+        with open(os.path.join(dirname, 'plan.json.part'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(os.path.join(dirname, 'plan.json.part'), os.path.join(dirname, 'plan.json'))
+
+    @classmethod
+    def load(cls, dirname):
+        """Plan written by save (grids memory-mapped read only), None if dirname has none"""
+        fname = os.path.join(dirname, 'plan.json')
+        if not os.path.isfile(fname):
+            return None
+        with open(fname, 'r') as f:
+            meta = json.load(f)
+        plan = cls.__new__(cls)
+        plan.src_shape     = tuple(meta['src_shape'])
+        plan.src_transform = rasterio.Affine(*meta['src_transform'])
+        plan.src_crs       = rasterio.crs.CRS.from_wkt(meta['src_crs'])
+        plan.dst_shape     = tuple(meta['dst_shape'])
+        plan.dst_transform = rasterio.Affine(*meta['dst_transform'])
+        plan.resampling    = Resampling[meta['resampling']]
+        plan.bilinear      = plan.resampling == Resampling.bilinear
+        plan.approx_step   = meta['approx_step']
+        grids = dict()
+        for name in ('index', 'fx', 'fy'):
+            fname_grid = os.path.join(dirname, f'plan_{name}.npy')
+            grids[name] = np.load(fname_grid, mmap_mode='r') if os.path.isfile(fname_grid) else None
+        plan.index, plan.fx, plan.fy = grids['index'], grids['fx'], grids['fy']
+        return plan
+
+    def matches_grids(self, src_shape, src_transform, src_crs, dst_shape, dst_transform):
+        """True if the plan maps the source grid to the target grid"""
+        return (tuple(src_shape) == self.src_shape
+                and src_transform.almost_equals(self.src_transform)
+                and rasterio.crs.CRS.from_user_input(src_crs) == self.src_crs
+                and tuple(dst_shape) == self.dst_shape
+                and dst_transform.almost_equals(self.dst_transform))
+
+    def matches(self, src):
+        """True if open dataset src is on the source grid this plan was built for"""
+        return ((src.height, src.width) == self.src_shape
+                and src.transform.almost_equals(self.src_transform)
+                and src.crs == self.src_crs)
+
+    def apply(self, src_arr, window=None, num_threads=None, strip_rows=256):
+        """
+        Resample src_arr (float32, NaN nodata, shape src_shape) to the target
+        grid, or to a window of it. Returns np.ndarray float32. The window is
+        processed in row strips spread over num_threads threads.
+        """
+        src_h, src_w = self.src_shape
+        padded = np.full((src_h + 2, src_w + 2), np.nan, dtype=np.float32)
+        padded[1:-1, 1:-1] = src_arr
+        flat = padded.ravel()
+        if window is None:
+            window = Window(0, 0, self.dst_shape[1], self.dst_shape[0])
+        strips = [Window(window.col_off, row_off, window.width,
+                         min(strip_rows, window.row_off + window.height - row_off))
+                  for row_off in range(window.row_off, window.row_off + window.height, strip_rows)]
+        out = np.empty((window.height, window.width), dtype=np.float32)
+        def run(strip):
+            out[strip.row_off - window.row_off:strip.row_off - window.row_off + strip.height, :] = \
+                self._apply_window(flat, strip)
+        num_threads = num_threads or 1
+        if num_threads > 1 and len(strips) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+                list(executor.map(run, strips))
+        else:
+            for strip in strips:
+                run(strip)
+        return out
+
+    def _apply_window(self, flat, window):
+        """Gather / weighted sum for one window of the target grid from the padded flat source"""
+        src_w = self.src_shape[1]
+        slices = window.toslices()
+        index = np.asarray(self.index[slices])
+        if not self.bilinear:
+            return flat[index]
+        fx = np.asarray(self.fx[slices])
+        fy = np.asarray(self.fy[slices])
+        v00 = flat[index]
+        v01 = flat[index + 1]
+        v10 = flat[index + src_w + 2]
+        v11 = flat[index + src_w + 3]
+        top = v00 + fx * (v01 - v00)
+        bot = v10 + fx * (v11 - v10)
+        out = top + fy * (bot - top)
+        # some neighbour is nodata: like GDAL, the target is nodata when the source pixel
+        # containing it is nodata, otherwise the weights are renormalised over valid neighbours
+        redo = np.flatnonzero(np.isnan(out))
+        if len(redo) > 0:
+            out = out.ravel()
+            rfx, rfy = fx.ravel()[redo], fy.ravel()[redo]
+            rindex = index.ravel()[redo]
+            centre = flat[rindex + (rfx >= 0.5) + (rfy >= 0.5) * (src_w + 2)]
+            num = np.zeros(rfx.shape, dtype=np.float32)
+            den = np.zeros(rfx.shape, dtype=np.float32)
+            for vals, weight in ((v00.ravel()[redo], (1.0 - rfx) * (1.0 - rfy)),
+                                 (v01.ravel()[redo], rfx * (1.0 - rfy)),
+                                 (v10.ravel()[redo], (1.0 - rfx) * rfy),
+                                 (v11.ravel()[redo], rfx * rfy)):
+                valid = ~np.isnan(vals)
+                num += np.where(valid, vals * weight, 0.0)
+                den += np.where(valid, weight, 0.0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                out[redo] = np.where((den > 1e-6) & ~np.isnan(centre), num / den, np.nan)
+            out = out.reshape(index.shape)
+        return out
+
+def _geotiff_profile(profile,
+                     compress="deflate",
+                     bigtiff="IF_SAFER",
+                     blocksize=512,
+                     zlevel=1,
+                     predictor=2):
+    """
+    Tiled/compressed single-band GeoTIFF creation profile.
     """
     out_profile = profile.copy()
     out_profile.update(
@@ -244,8 +553,21 @@ def _write_geotiff(fname,
         out_profile["predictor"] = predictor
 
     # Remove None-valued keys to avoid GDAL warnings
-    out_profile = {k: v for k, v in out_profile.items() if v is not None}
+    return {k: v for k, v in out_profile.items() if v is not None}
 
+def _write_geotiff(fname, 
+                   arr, 
+                   profile, 
+                   compress="deflate", 
+                   bigtiff="IF_SAFER",
+                   blocksize=512, 
+                   zlevel=1, 
+                   predictor=2):
+    """
+    Write a single-band float32 GeoTIFF with tiling and compression.
+    """
+    out_profile = _geotiff_profile(profile, compress=compress, bigtiff=bigtiff,
+                                   blocksize=blocksize, zlevel=zlevel, predictor=predictor)
     with rasterio.open(fname, "w", **out_profile) as dst:
         dst.write(arr, 1)
 
@@ -265,13 +587,56 @@ def calculate_inundation(*,
     compress: str | None = "deflate",
     blocksize: int = 512,
     zlevel: int = 1,
-    predictor: int = 2):
+    predictor: int = 2,
+    windowed: bool = False,
+    resample_plan: bool = True,
+    workers: int = 1,
+    output_format: str = 'tiff',
+    wtd_source=None,
+    labels_dir: str = None,
+    report=None):
+    """
+    Daily inundation rasters (1.0 where -wtd >= threshold, NaN elsewhere).
+
+    With windowed=True the TWI grid is walked in blocksize x blocksize tiles and
+    only the WTD window each tile needs is reprojected, so peak memory is
+    proportional to the tile size instead of the domain size (the threshold grid
+    is kept in a memory-mapped scratch file).
+
+    With resample_plan=True (bilinear or nearest resampling) the WTD-to-TWI
+    coordinate transforms and weights are computed once in a ResamplePlan and
+    reused for every day instead of calling the GDAL warper per day.
+
+    With workers > 1 the days are spread over a process pool; the threshold
+    (and resampling plan) grids are published once through shared memory and
+    each worker writes its own daily rasters.
+
+    With output_format='cube' the days are stored in a bit-packed
+    InundationCube in inundation_out_dir instead of daily GeoTIFFs.
+
+    With a wtd_source (e.g. twtwt.WTDNetCDFSource) the days are read from it
+    instead of the wtd_YYYYMMDD.tiff files in wtd_raw_dir.
+
+    With nearest resampling and labels_dir the plan is the domain's
+    fine-to-coarse label array kept there (see wtd_labels, shared with
+    twttopo.calc_twi_mean) instead of one built for this call.
+
+    With a twtreport.RunReport every day is measured into it (stage
+    'inundation_day').
+    """
 
     if verbose:
         print('calling calculate_inundation')
 
-    need = _check_exist(inundation_out_dir, dt_start, dt_end)
-    if not need:
+    _check_output_format(output_format)
+    if output_format == 'tiff':
+        # one listing of inundation_out_dir gives the days still to compute
+        dates = twtutils.missing_dates(inundation_out_dir, dt_start, dt_end, 'inundation_', overwrite=overwrite)
+        need  = len(dates) > 0
+    else:
+        dates = twtutils.daterange(dt_start, dt_end)
+        need  = _check_exist_cube(inundation_out_dir, dt_start, dt_end)
+    if not need and not overwrite:
         if verbose:
             print(f' found existing inundation calculations in {inundation_out_dir}')
         return
@@ -281,68 +646,557 @@ def calculate_inundation(*,
     # Enable multi-threaded GDAL inside each reprojection
     gdal_env = rasterio.Env(GDAL_NUM_THREADS="ALL_CPUS", NUM_THREADS="ALL_CPUS")
 
-    with gdal_env:
-        # 1) Read/define target grid from TWI
-        twi_arr, base_profile = _read_base_grid_and_array(fname_twi)
-        height = base_profile['height']
-        width  = base_profile['width']
-        dst_transform = base_profile['transform']
-        dst_crs = base_profile['crs']
-        dst_shape = (height, width)
-
-        # 2) Reproject twi_mean and soil_trans to target grid
-        twi_mean_arr = _reproject_to_target(
-            fname_twi_mean, dst_shape, dst_transform, dst_crs,
-            resampling=resampling, num_threads=warp_threads, dst_dtype="float32"
+    with gdal_env, _scratch_dir(inundation_out_dir, windowed) as scratch_dir:
+        # 1) Read target grid from TWI and compute threshold once
+        threshold, base_profile = _read_threshold(
+            fname_twi, fname_twi_mean, fname_soil_trans,
+            resampling=resampling, warp_threads=warp_threads,
+            blocksize=(blocksize if windowed else None), scratch_dir=scratch_dir
         )
-        soil_trans_arr = _reproject_to_target(
-            fname_soil_trans, dst_shape, dst_transform, dst_crs,
-            resampling=resampling, num_threads=warp_threads, dst_dtype="float32"
+        windows = _iter_windows(base_profile['height'], base_profile['width'],
+                                blocksize if windowed else None)
+        out_profile = _geotiff_profile(base_profile, compress=compress, bigtiff="IF_SAFER",
+                                       blocksize=blocksize, zlevel=zlevel, predictor=predictor)
+
+        cube = None
+        if output_format == 'cube':
+            cube = _open_cube(inundation_out_dir, dt_start, dt_end, base_profile, threshold, windows, overwrite)
+
+        # 2) Process each missing day (the resampling plan is built on the first day)
+        days = list()
+        wtd_dates = _wtd_dates(wtd_raw_dir, wtd_source)
+        for idt in dates:
+            dt_str = idt.strftime('%Y%m%d')
+            if cube is not None:
+                cube_day = cube.day_index(idt)
+                if not cube.done[cube_day]:
+                    days.append((dt_str, _wtd_day(idt, wtd_raw_dir, wtd_source, 'calculate_inundation', wtd_dates),
+                                 None, cube_day))
+            else:
+                fname_inund = os.path.join(inundation_out_dir, f'inundation_{dt_str}.tiff')
+                days.append((dt_str, _wtd_day(idt, wtd_raw_dir, wtd_source, 'calculate_inundation', wtd_dates),
+                             fname_inund, None))
+
+        plan = _labels_plan(labels_dir, days, wtd_source, base_profile, resampling, resample_plan, blocksize, verbose)
+        _run_days(days, threshold, windows, base_profile, out_profile, cube=cube, wtd_source=wtd_source,
+                  resampling=resampling, warp_threads=warp_threads, use_plan=resample_plan,
+                  blocksize=blocksize, scratch_dir=scratch_dir, workers=workers, verbose=verbose,
+                  report=report, plan=plan)
+        if cube is not None:
+            cube.close()
+
+def calculate_inundation_summary(*,
+    dt_start: datetime.datetime,
+    dt_end: datetime.datetime,
+    wtd_raw_dir: str,
+    inundation_summary_dir: str,
+    fname_twi: str,
+    fname_twi_mean: str,
+    fname_soil_trans: str,
+    inundation_out_dir: str = None,
+    write_daily: bool = False,
+    verbose: bool = False,
+    overwrite: bool = False,
+    resampling=Resampling.bilinear,
+    warp_threads: int | None = 4,
+    compress: str | None = "deflate",
+    blocksize: int = 512,
+    zlevel: int = 1,
+    predictor: int = 2,
+    windowed: bool = False,
+    resample_plan: bool = True,
+    workers: int = 1,
+    output_format: str = 'tiff',
+    wtd_source=None,
+    labels_dir: str = None,
+    report=None):
+    """
+    Fused single-pass inundation + percent inundated summary.
+
+    Each day's WTD is reprojected, compared against the threshold and folded
+    into a wet-day counter, so daily inundation rasters are not needed to
+    build the summary. Daily rasters are only written to inundation_out_dir
+    when write_daily is True. With windowed=True the threshold and counter
+    grids are memory-mapped scratch files and each day is processed tile by
+    tile. With workers > 1 the days are spread over a process pool (see
+    calculate_inundation), each block of days counting into its own slot of
+    a shared counter that is summed at the end. With output_format='cube' the
+    optional daily output is a bit-packed InundationCube instead of GeoTIFFs.
+    With a twtreport.RunReport every day is measured into it. labels_dir is
+    as for calculate_inundation.
+
+    Returns the percent inundated grid file name (same name and values as
+    calculate_summary_perc_inundated).
+    """
+    if verbose:
+        print('calling calculate_inundation_summary')
+
+    _check_output_format(output_format)
+    if write_daily and inundation_out_dir is None:
+        raise ValueError('calculate_inundation_summary requires inundation_out_dir when write_daily is True')
+
+    fname_output = summary_fname(inundation_summary_dir, dt_start, dt_end)
+    if os.path.isfile(fname_output) and not overwrite:
+        if verbose:
+            print(f' found existing summary percent inundated grid {fname_output}')
+        return fname_output
+
+    os.makedirs(inundation_summary_dir, exist_ok=True)
+    if write_daily:
+        os.makedirs(inundation_out_dir, exist_ok=True)
+
+    gdal_env = rasterio.Env(GDAL_NUM_THREADS="ALL_CPUS", NUM_THREADS="ALL_CPUS")
+
+    with gdal_env, _scratch_dir(inundation_summary_dir, windowed) as scratch_dir:
+        # 1) Read target grid from TWI and compute threshold once
+        threshold, base_profile = _read_threshold(
+            fname_twi, fname_twi_mean, fname_soil_trans,
+            resampling=resampling, warp_threads=warp_threads,
+            blocksize=(blocksize if windowed else None), scratch_dir=scratch_dir
         )
+        windows = _iter_windows(base_profile['height'], base_profile['width'],
+                                blocksize if windowed else None)
+        out_profile = _geotiff_profile(base_profile, compress=compress, bigtiff="IF_SAFER",
+                                       blocksize=blocksize, zlevel=zlevel, predictor=predictor)
 
-        # 3) Compute threshold once: threshold = -(twi - twi_mean) / soil_trans, soil_trans != 0 else NaN
-        with np.errstate(divide='ignore', invalid='ignore'):
-            threshold = np.where(
-                soil_trans_arr != 0.0,
-                -(twi_arr - twi_mean_arr) / soil_trans_arr,
-                np.nan
-            ).astype(np.float32)
+        cube = None
+        if write_daily and output_format == 'cube':
+            cube = _open_cube(inundation_out_dir, dt_start, dt_end, base_profile, threshold, windows, overwrite)
 
-        # 4) Sequentially process each day
+        # 2) Fold each day straight into the wet-day counter
+        days = list()
+        wtd_dates = _wtd_dates(wtd_raw_dir, wtd_source)
+        daily_missing = set()
+        if write_daily and cube is None:
+            daily_missing = set(twtutils.missing_dates(inundation_out_dir, dt_start, dt_end, 'inundation_', overwrite=overwrite))
         idt = dt_start
         while idt <= dt_end:
             dt_str = idt.strftime('%Y%m%d')
-            fname_wtd_mean_raw = os.path.join(wtd_raw_dir, f'wtd_{dt_str}.tiff')
-            fname_inund        = os.path.join(inundation_out_dir, f'inundation_{dt_str}.tiff')
-
-            if not os.path.isfile(fname_wtd_mean_raw):
-                raise FileNotFoundError(f'calculate_inundation could not find {fname_wtd_mean_raw}')
-
-            if not os.path.isfile(fname_inund) or overwrite:
-                if verbose:
-                    print(f' processing {dt_str}')
-
-                # Reproject WTD to target grid
-                wtd_arr = _reproject_to_target(
-                    fname_wtd_mean_raw, dst_shape, dst_transform, dst_crs,
-                    resampling=resampling, num_threads=warp_threads, dst_dtype="float32"
-                )
-
-                # Apply logic: wtd_mean = -wtd; inundation = 1.0 where wtd_mean >= threshold, else NaN
-                wtd_mean = -wtd_arr
-                out = np.full(dst_shape, np.nan, dtype=np.float32)
-                valid = (~np.isnan(wtd_mean)) & (~np.isnan(threshold))
-                out[valid & (wtd_mean >= threshold)] = 1.0
-
-                # Write result
-                _write_geotiff(
-                    fname_inund, out, base_profile,
-                    compress=compress, bigtiff="IF_SAFER",
-                    blocksize=blocksize, zlevel=zlevel, predictor=predictor
-                )
+            wtd_day = _wtd_day(idt, wtd_raw_dir, wtd_source, 'calculate_inundation_summary', wtd_dates)
+
+            fname_inund, cube_day = None, None
+            if cube is not None:
+                cube_day = cube.day_index(idt)
+                if cube.done[cube_day]:
+                    cube_day = None
+            elif idt in daily_missing:
+                fname_inund = os.path.join(inundation_out_dir, f'inundation_{dt_str}.tiff')
+            days.append((dt_str, wtd_day, fname_inund, cube_day))
 
             idt += datetime.timedelta(days=1)
 
+        n_days = len(days)
+        plan = _labels_plan(labels_dir, days, wtd_source, base_profile, resampling, resample_plan, blocksize, verbose)
+        counts = _run_days(days, threshold, windows, base_profile, out_profile, count=True, cube=cube,
+                           wtd_source=wtd_source,
+                           resampling=resampling, warp_threads=warp_threads, use_plan=resample_plan,
+                           blocksize=blocksize, scratch_dir=scratch_dir, workers=workers, verbose=verbose,
+                           report=report, plan=plan)
+        if cube is not None:
+            cube.close()
+
+        if verbose:
+            print(f' writing summary percent inundation grid {fname_output}')
+        with rasterio.open(fname_output, "w", **_geotiff_profile(base_profile)) as dst:
+            for window in windows:
+                dst.write(_counts_to_perc(counts[window.toslices()], n_days), 1, window=window)
+
+    return fname_output
+
+def _process_day(wtd_day, threshold, windows, base_profile,
+                 resampling=Resampling.bilinear, warp_threads=None,
+                 fname_inund=None, out_profile=None, counts=None,
+                 plan=None, use_plan=False, blocksize=512, scratch_dir=None,
+                 cube=None, cube_day=None, wtd_source=None):
+    """
+    Resample one day of WTD (a wtd_YYYYMMDD.tiff file, or a date of
+    wtd_source) window by window, compare with threshold and
+    write the daily inundation raster (if fname_inund), write day index
+    cube_day of an InundationCube (if cube_day is not None) and/or add the
+    wet pixels to counts (if counts is not None).
+
+    With use_plan the WTD is resampled with a ResamplePlan (plan is reused
+    when the day is on its source grid, otherwise a new plan is built),
+    else with the GDAL warper. Returns the plan used (or None).
+    """
+    if resampling not in ResamplePlan.supported:
+        use_plan = False
+    dst = rasterio.open(fname_inund, "w", **out_profile) if fname_inund is not None else None
+    try:
+        with _open_wtd(wtd_day, wtd_source) as src:
+            if use_plan:
+                if plan is None or not plan.matches(src):
+                    plan = _build_plan(src, base_profile, resampling=resampling,
+                                       blocksize=blocksize, scratch_dir=scratch_dir)
+                wtd_src = _read_window_as_float(src, None)
+            for window in windows:
+                slices = window.toslices()
+                if use_plan:
+                    wtd_arr = plan.apply(wtd_src, window, num_threads=warp_threads)
+                else:
+                    wtd_arr = _reproject_band(
+                        src, (window.height, window.width),
+                        rasterio.windows.transform(window, base_profile['transform']), base_profile['crs'],
+                        resampling=resampling, num_threads=warp_threads, dst_dtype="float32"
+                    )
+                wet = _calc_wet(wtd_arr, threshold[slices])
+                if counts is not None:
+                    counts[slices] += wet
+                if dst is not None:
+                    dst.write(_wet_to_float(wet), 1, window=window)
+                if cube_day is not None:
+                    cube.write_day(cube_day, wet, window=window)
+        if cube_day is not None:
+            cube.set_done(cube_day)
+    finally:
+        if dst is not None:
+            dst.close()
+    return plan if use_plan else None
+
+def _wtd_dates(wtd_raw_dir, wtd_source):
+    """Dates of the wtd_YYYYMMDD.tiff files in wtd_raw_dir (None with a wtd_source)"""
+    if wtd_source is not None:
+        return None
+    return twtutils.dates_in_dir(wtd_raw_dir, 'wtd_')
+
+def _wtd_day(dt, wtd_raw_dir, wtd_source, caller, wtd_dates=None):
+    """Reference to the WTD of day dt: its wtd_raw_dir file, or dt itself with a wtd_source"""
+    if wtd_source is not None:
+        if not wtd_source.has_day(dt):
+            raise FileNotFoundError(f'{caller} could not find {dt.strftime("%Y-%m-%d")} in WTD source {wtd_source.savedir}')
+        return dt
+    fname = os.path.join(wtd_raw_dir, f'wtd_{dt.strftime("%Y%m%d")}.tiff')
+    # wtd_dates are midnights (twtutils.dates_in_dir), dt may carry a time of day
+    found = dt.replace(hour=0, minute=0, second=0, microsecond=0) in wtd_dates if wtd_dates is not None else os.path.isfile(fname)
+    if not found:
+        raise FileNotFoundError(f'{caller} could not find {fname}')
+    return fname
+
+def _open_wtd(wtd_day, wtd_source=None):
+    """Open one day of WTD as a rasterio dataset"""
+    if wtd_source is not None:
+        return wtd_source.open_day(wtd_day)
+    return rasterio.open(wtd_day)
+
+def _build_plan(src, base_profile, resampling=Resampling.bilinear, blocksize=512, scratch_dir=None):
+    """ResamplePlan from the grid of open dataset src to the base grid"""
+    return ResamplePlan(src.shape, src.transform, src.crs,
+                        (base_profile['height'], base_profile['width']),
+                        base_profile['transform'], base_profile['crs'],
+                        resampling=resampling, blocksize=blocksize, scratch_dir=scratch_dir)
+
+def wtd_labels(dirname, src_shape, src_transform, src_crs, base_profile, blocksize=512, verbose=False):
+    """
+    Fine-to-coarse label array of a domain: a nearest ResamplePlan from the
+    WTD grid to the base (TWI) grid whose index is, for every fine pixel, the
+    label of the WTD cell containing it. It is built once and kept in
+    dirname, and reloaded as long as both grids are unchanged.
+    """
+    dst_shape = (base_profile['height'], base_profile['width'])
+    plan = ResamplePlan.load(dirname) if os.path.isdir(dirname) else None
+    if (plan is not None and plan.resampling == Resampling.nearest
+            and plan.matches_grids(src_shape, src_transform, src_crs, dst_shape, base_profile['transform'])):
+        if verbose: print(f' using existing wtd labels in {dirname}')
+        return plan
+    if verbose: print(f' building wtd labels in {dirname}')
+    os.makedirs(dirname, exist_ok=True)
+    fname_meta = os.path.join(dirname, 'plan.json')
+    if os.path.isfile(fname_meta): os.remove(fname_meta)
+    plan = ResamplePlan(src_shape, src_transform, src_crs, dst_shape, base_profile['transform'], base_profile['crs'],
+                        resampling=Resampling.nearest, blocksize=blocksize, scratch_dir=dirname)
+    plan.index.flush()
+    plan.save(dirname)
+    return plan
+
+def _labels_plan(labels_dir, days, wtd_source, base_profile, resampling, use_plan, blocksize, verbose=False):
+    """wtd_labels of the grid of the first day when they can stand in for a nearest ResamplePlan, else None"""
+    if labels_dir is None or not use_plan or resampling != Resampling.nearest or len(days) == 0:
+        return None
+    with _open_wtd(days[0][1], wtd_source) as src:
+        return wtd_labels(labels_dir, src.shape, src.transform, src.crs, base_profile,
+                          blocksize=blocksize, verbose=verbose)
+
+def _run_days(days, threshold, windows, base_profile, out_profile, count=False, cube=None, wtd_source=None,
+              resampling=Resampling.bilinear, warp_threads=None, use_plan=False,
+              blocksize=512, scratch_dir=None, workers=1, verbose=False, report=None, plan=None):
+    """
+    Process days [(dt_str, wtd_day, fname_inund or None, cube_day or None), ...] sequentially or,
+    with workers > 1, over a process pool. Returns the wet-day counts grid (uint16)
+    when count is True, else None. Days are measured into report (a
+    twtreport.RunReport) if given; pool workers send their records back.
+    A given plan (e.g. from wtd_labels) is used while the days are on its
+    source grid.
+    """
+    dst_shape = (base_profile['height'], base_profile['width'])
+    workers = max(1, min(int(workers or 1), len(days)))
+    if workers > 1 and multiprocessing.current_process().daemon:
+        # e.g. already inside a runpp.py pool worker, which cannot have children
+        if verbose:
+            print(' WARNING running days sequentially - daemonic processes cannot start a worker pool')
+        workers = 1
+    if workers == 1:
+        counts = _empty_grid(dst_shape, np.uint16, scratch_dir, 'counts.npy', fill=0) if count else None
+        for dt_str, wtd_day, fname_inund, cube_day in days:
+            if verbose:
+                print(f' processing {dt_str}')
+            with twtreport.measure(report, 'inundation_day', day=dt_str):
+                plan = _process_day(wtd_day, threshold, windows, base_profile,
+                                    resampling=resampling, warp_threads=warp_threads,
+                                    fname_inund=fname_inund, out_profile=out_profile, counts=counts,
+                                    plan=plan, use_plan=use_plan,
+                                    blocksize=blocksize, scratch_dir=scratch_dir,
+                                    cube=cube, cube_day=cube_day, wtd_source=wtd_source)
+        return counts
+
+    if verbose:
+        print(f' processing {len(days)} days with {workers} worker processes')
+    owned = list()
+    try:
+        # publish the big grids once; workers attach to them instead of receiving copies per task
+        state = {'windows'      : windows,
+                 'base_profile' : base_profile,
+                 'out_profile'  : out_profile,
+                 'resampling'   : resampling,
+                 'warp_threads' : max(1, (warp_threads or 1) // workers),
+                 'use_plan'     : use_plan and resampling in ResamplePlan.supported,
+                 'blocksize'    : blocksize,
+                 'cube'         : cube.dirname if cube is not None else None,
+                 'wtd_source'   : wtd_source,
+                 'report'       : report is not None,
+                 'verbose'      : verbose}
+        state['threshold'] = _share_array(threshold, owned)
+        state['plan'] = None
+        if state['use_plan']:
+            with _open_wtd(days[0][1], wtd_source) as src:
+                if plan is None or not plan.matches(src):
+                    plan = _build_plan(src, base_profile, resampling=resampling,
+                                       blocksize=blocksize, scratch_dir=scratch_dir)
+            plan_state = dict(plan.__dict__)
+            for name in ('index', 'fx', 'fy'):
+                if plan_state[name] is not None:
+                    plan_state[name] = _share_array(plan_state[name], owned)
+            state['plan'] = plan_state
+        slots = None
+        if count:
+            slots, state['counts'] = _shared_grid((workers,) + dst_shape, np.uint16,
+                                                  scratch_dir, 'counts_slots.npy', owned)
+        blocks = [block for block in np.array_split(np.arange(len(days)), workers) if len(block) > 0]
+        tasks = [(slot, [days[i] for i in block]) for slot, block in enumerate(blocks)]
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(processes=workers, initializer=_init_day_worker, initargs=(state,)) as pool:
+            records = pool.map(_day_worker, tasks, chunksize=1)
+        if report is not None:
+            report.add([record for block in records for record in block])
+        if not count:
+            return None
+        counts = _empty_grid(dst_shape, np.uint16, scratch_dir, 'counts.npy', fill=0)
+        for window in windows:
+            slices = window.toslices()
+            counts[slices] = slots[(slice(None),) + slices].sum(axis=0, dtype=np.uint16)
+        return counts
+    finally:
+        for shm in owned:
+            shm.close()
+            shm.unlink()
+
+_worker_state = dict()
+
+def _init_day_worker(state):
+    """Pool initializer: attach to the shared grids published by _run_days"""
+    _worker_state.clear()
+    _worker_state.update(state)
+    _worker_state['attached'] = list()
+    _worker_state['threshold'] = _attach_array(state['threshold'], _worker_state['attached'])
+    if state['plan'] is not None:
+        plan = ResamplePlan.__new__(ResamplePlan)
+        plan.__dict__.update(state['plan'])
+        for name in ('index', 'fx', 'fy'):
+            if state['plan'][name] is not None:
+                setattr(plan, name, _attach_array(state['plan'][name], _worker_state['attached']))
+        _worker_state['plan'] = plan
+    if state.get('counts') is not None:
+        _worker_state['counts'] = _attach_array(state['counts'], _worker_state['attached'])
+    if state['cube'] is not None:
+        # days are disjoint, so every worker writes its own slabs of the cube
+        _worker_state['cube'] = InundationCube(state['cube'], mode='r+')
+
+def _day_worker(task):
+    """
+    Process a block of days in a pool worker, counting into its own slot of
+    the shared counter. Returns the report records of the days.
+    """
+    slot, days = task
+    state = _worker_state
+    counts = state['counts'][slot] if state.get('counts') is not None else None
+    plan = state['plan']
+    report = twtreport.RunReport() if state['report'] else None
+    for dt_str, wtd_day, fname_inund, cube_day in days:
+        if state['verbose']:
+            print(f' processing {dt_str}', flush=True)
+        with twtreport.measure(report, 'inundation_day', day=dt_str):
+            plan = _process_day(wtd_day, state['threshold'], state['windows'], state['base_profile'],
+                                resampling=state['resampling'], warp_threads=state['warp_threads'],
+                                fname_inund=fname_inund, out_profile=state['out_profile'], counts=counts,
+                                plan=plan, use_plan=state['use_plan'], blocksize=state['blocksize'],
+                                cube=state['cube'], cube_day=cube_day, wtd_source=state['wtd_source'])
+    if isinstance(counts, np.memmap):
+        counts.flush()
+    return report.records if report is not None else list()
+
+def _shared_grid(shape, dtype, scratch_dir, name, owned):
+    """
+    Zero-filled grid that worker processes can attach to (memmap in scratch_dir,
+    else a new shared memory block appended to owned). Returns (array, handle).
+    """
+    if scratch_dir is not None:
+        arr = _empty_grid(shape, dtype, scratch_dir, name, fill=0)
+        arr.flush()
+        return arr, ('memmap', arr.filename, 'r+')
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    owned.append(shm)
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    arr[:] = 0
+    return arr, ('shm', shm.name, tuple(shape), np.dtype(dtype).str)
+
+def _share_array(arr, owned):
+    """
+    Read-only handle for publishing arr to worker processes: memory-mapped .npy
+    files by file name, anything else is copied once into a new shared memory
+    block (appended to owned, to be unlinked by the caller).
+    """
+    if isinstance(arr, np.memmap) and arr.filename is not None:
+        arr.flush()
+        return ('memmap', arr.filename, 'r')
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    owned.append(shm)
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+    return ('shm', shm.name, arr.shape, arr.dtype.str)
+
+def _attach_array(handle, attached):
+    """Array view of a handle from _share_array (shared memory blocks are kept alive in attached)"""
+    if handle[0] == 'memmap':
+        return np.load(handle[1], mmap_mode=handle[2])
+    _, name, shape, dtype = handle
+    # spawned workers share the parent's resource tracker, the creating process unlinks the block
+    shm = shared_memory.SharedMemory(name=name)
+    attached.append(shm)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+def _read_threshold(fname_twi, fname_twi_mean, fname_soil_trans,
+                    resampling=Resampling.bilinear, warp_threads=None,
+                    blocksize=None, scratch_dir=None):
+    """
+    Read the base grid (TWI), reproject twi_mean and soil_trans onto it and return:
+    - threshold: np.ndarray float32, -(twi - twi_mean) / soil_trans, NaN where soil_trans == 0
+    - profile: rasterio profile of the base grid
+
+    With blocksize the grid is processed tile by tile and, with scratch_dir,
+    threshold is a memory-mapped .npy file in scratch_dir.
+    """
+    with rasterio.open(fname_twi) as src:
+        base_profile = _base_profile(src)
+        dst_shape = (base_profile['height'], base_profile['width'])
+        dst_crs = base_profile['crs']
+        threshold = _empty_grid(dst_shape, np.float32, scratch_dir, 'threshold.npy')
+        for window in _iter_windows(dst_shape[0], dst_shape[1], blocksize):
+            win_shape = (window.height, window.width)
+            win_transform = src.window_transform(window)
+            twi_arr = _read_window_as_float(src, window)
+            twi_mean_arr = _reproject_to_target(
+                fname_twi_mean, win_shape, win_transform, dst_crs,
+                resampling=resampling, num_threads=warp_threads, dst_dtype="float32"
+            )
+            soil_trans_arr = _reproject_to_target(
+                fname_soil_trans, win_shape, win_transform, dst_crs,
+                resampling=resampling, num_threads=warp_threads, dst_dtype="float32"
+            )
+            threshold[window.toslices()] = _calc_threshold(twi_arr, twi_mean_arr, soil_trans_arr)
+    return threshold, base_profile
+
+def _empty_grid(shape, dtype, scratch_dir=None, name=None, fill=None):
+    """In-memory array, or a memory-mapped .npy file in scratch_dir when scratch_dir is set"""
+    if scratch_dir is None:
+        arr = np.empty(shape, dtype=dtype)
+    else:
+        arr = np.lib.format.open_memmap(os.path.join(scratch_dir, name), mode='w+', dtype=dtype, shape=shape)
+    if fill is not None:
+        arr[:] = fill
+    return arr
+
+def _scratch_dir(parent_dir, enabled):
+    """Temporary scratch directory under parent_dir (removed on exit) or a null context"""
+    if not enabled:
+        return contextlib.nullcontext(None)
+    os.makedirs(parent_dir, exist_ok=True)
+    return tempfile.TemporaryDirectory(prefix='_scratch_', dir=parent_dir, ignore_cleanup_errors=True)
+
+def _calc_threshold(twi_arr, twi_mean_arr, soil_trans_arr):
+    """threshold = -(twi - twi_mean) / soil_trans where soil_trans != 0, else NaN"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(
+            soil_trans_arr != 0.0,
+            -(twi_arr - twi_mean_arr) / soil_trans_arr,
+            np.nan
+        ).astype(np.float32)
+
+def _calc_wet(wtd_arr, threshold):
+    """Boolean wet mask: -wtd >= threshold (NaNs in either input evaluate to False)"""
+    with np.errstate(invalid='ignore'):
+        return (-wtd_arr) >= threshold
+
+def _wet_to_float(wet):
+    """Daily inundation raster values: 1.0 where wet, NaN elsewhere"""
+    out = np.full(wet.shape, np.nan, dtype=np.float32)
+    out[wet] = 1.0
+    return out
+
+def _counts_to_perc(counts, n_days):
+    """Convert wet-day counts to percent of days inundated (NaN where never inundated)"""
+    perc_inun = counts.astype(np.float32) * (100.0 / float(n_days))
+    perc_inun[perc_inun <= 0.0] = np.nan
+    return perc_inun
+
+def summary_fname(inundation_summary_dir, dt_start, dt_end):
+    """Percent inundated grid of the days dt_start to dt_end in inundation_summary_dir"""
+    dt_fmt = "%Y%m%d"
+    return os.path.join(
+        inundation_summary_dir,
+        f"percent_inundated_grid_{dt_start.strftime(dt_fmt)}_to_{dt_end.strftime(dt_fmt)}.tiff"
+    )
+
+def _check_output_format(output_format):
+    if output_format not in ('tiff', 'cube'):
+        raise ValueError(f"invalid inundation output_format {output_format} - must be 'tiff' or 'cube'")
+
+def _cube_dirname(inundation_out_dir, dt_start, dt_end):
+    dt_fmt = "%Y%m%d"
+    return os.path.join(
+        inundation_out_dir,
+        f"inundation_cube_{dt_start.strftime(dt_fmt)}_to_{dt_end.strftime(dt_fmt)}"
+    )
+
+def _open_cube(inundation_out_dir, dt_start, dt_end, base_profile, threshold, windows, overwrite=False):
+    """Open (or create) the inundation cube of a date range and write its validity mask"""
+    cube = InundationCube.open_or_create(_cube_dirname(inundation_out_dir, dt_start, dt_end),
+                                         dt_start, dt_end, base_profile, overwrite=overwrite)
+    for window in windows:
+        cube.write_valid(~np.isnan(threshold[window.toslices()]), window=window)
+    return cube
+
+def _check_exist_cube(inundation_out_dir, dt_start, dt_end):
+    """True if the inundation cube of the date range is missing or has unwritten days"""
+    dirname = _cube_dirname(inundation_out_dir, dt_start, dt_end)
+    if not os.path.isfile(os.path.join(dirname, 'meta.json')):
+        return True
+    try:
+        cube = InundationCube(dirname)
+    except ValueError:
+        return True # older cube layout, recreated by _open_cube
+    need = len(cube.missing_days()) > 0
+    cube.close()
+    return need
+
 def calculate_summary_perc_inundated(**kwargs):
     dt_start           = kwargs.get('dt_start',               None)
     dt_end             = kwargs.get('dt_end',                 None)
@@ -351,19 +1205,16 @@ def calculate_summary_perc_inundated(**kwargs):
     fname_dem          = kwargs.get('fname_dem',              None)
     verbose            = kwargs.get('verbose',                False)
     overwrite          = kwargs.get('overwrite',              False)
+    inundation_format  = kwargs.get('inundation_format',      'tiff')
 
     if verbose:
         print('calling calculate_summary_perc_inundated')
+    _check_output_format(inundation_format)
     os.makedirs(inundation_sum_dir, exist_ok=True)
 
     dt_fmt = "%Y%m%d"
-    start_s = dt_start.strftime(dt_fmt)
-    end_s   = dt_end.strftime(dt_fmt)
     n_days = (dt_end - dt_start).days + 1
-    fname_output = os.path.join(
-        inundation_sum_dir,
-        f"percent_inundated_grid_{start_s}_to_{end_s}.tiff"
-    )
+    fname_output = summary_fname(inundation_sum_dir, dt_start, dt_end)
     if os.path.isfile(fname_output) and not overwrite:
         if verbose:
             print(f' found existing summary percent inundated grid {fname_output}')
@@ -377,6 +1228,13 @@ def calculate_summary_perc_inundated(**kwargs):
         sumgrid_data = src.read(1, out_dtype="int32")
         sumgrid_data[:] = 0  # Initialize to zeros
 
+    if inundation_format == 'cube':
+        cube = InundationCube(_cube_dirname(inundation_raw_dir, dt_start, dt_end))
+        perc_inun = _counts_to_perc(cube.count_wet(dt_start, dt_end), n_days)
+        cube.close()
+        _write_geotiff(fname_output, perc_inun, base_profile)
+        return fname_output
+
     # Accumulate inundation counts
     idt = dt_start
     while idt <= dt_end:
@@ -392,9 +1250,7 @@ def calculate_summary_perc_inundated(**kwargs):
         idt += datetime.timedelta(days=1)
 
     # Convert to percentage
-    scale = 100.0 / float(n_days)
-    perc_inun = sumgrid_data.astype(np.float32) * scale
-    perc_inun[perc_inun <= 0.0] = np.nan
+    perc_inun = _counts_to_perc(sumgrid_data, n_days)
 
     # Write output
     _write_geotiff(fname_output, perc_inun, base_profile)
@@ -436,11 +1292,4 @@ def _zip_inundation(raw_dir, compression=zipfile.ZIP_LZMA, compresslevel=9):
     return zip_path
 
 def _check_exist(inundation_out_dir:str,dt_start:datetime.datetime,dt_end:datetime.datetime):
-    idt = dt_start
-    while idt <= dt_end:
-        dt_str = idt.strftime('%Y%m%d')
-        fname  = f'inundation_{dt_str}.tiff'
-        if not os.path.isfile(os.path.join(inundation_out_dir,fname)):
-            return True
-        idt += datetime.timedelta(days=1)
-    return False
\ No newline at end of file
+    return len(twtutils.missing_dates(inundation_out_dir, dt_start, dt_end, 'inundation_')) > 0
\ No newline at end of file
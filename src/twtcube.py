@@ -0,0 +1,355 @@
+import os
+import bz2
+import json
+import zlib
+import shutil
+import datetime
+import numpy as np
+import rasterio
+
+# codecs of the compressed chunks: name -> (compress, decompress)
+_CODECS = {'bz2'  : (lambda b: bz2.compress(b, 9),  bz2.decompress),
+           'zlib' : (lambda b: zlib.compress(b, 6), zlib.decompress)}
+
+_LAYOUT = 2
+_CACHE_BYTES = 2**28 # decoded chunks kept by a reader
+
+class InundationCube:
+    """
+    Bit-packed, compressed daily inundation cube.
+
+    Daily inundation is binary, so instead of one float32 GeoTIFF per day the
+    days are stored with one bit per pixel per day (numpy.packbits along x).
+    The wet area changes little from one day to the next, so the days are
+    grouped in blocks of block_days, every day of a block is stored as its
+    XOR with the day before, and the block is compressed in chunks of
+    chunk_rows rows. A cube is a directory:
+
+      meta.json            - first date, number of days, grid shape, transform,
+                             crs, block_days, chunk_rows and codec
+      wet/block_NNNNN.bin  - a complete block of days: uint64 offsets of its
+                             chunks, then the compressed chunks, each the
+                             (days, chunk_rows, ceil(width/8)) XOR deltas
+      wet/day_NNNNN.npy    - scratch (height, ceil(width/8)) packed day, while
+                             it is written and until its block is complete
+      valid.npy            - (height, ceil(width/8)) packed validity mask (pixels
+                             where the inundation threshold is defined)
+      done.npy             - (n_days,) uint8, 1 once a day has been completely written
+
+    A block is compressed by the set_done of its last day (processes
+    writing different days of one block take a lock file for it) or else
+    by close. Windows passed to the writers must start on a multiple of 8
+    columns (the 512 px processing tiles do).
+    """
+
+    def __init__(self, dirname, mode='r'):
+        self.dirname = dirname
+        meta = self._read_meta(dirname)
+        if meta.get('layout') != _LAYOUT:
+            raise ValueError(f'InundationCube {dirname} has an older layout, recreate it')
+        self.mode       = mode
+        self.dt_start   = datetime.datetime.strptime(meta['dt_start'], '%Y%m%d')
+        self.n_days     = int(meta['n_days'])
+        self.shape      = (int(meta['height']), int(meta['width']))
+        self.transform  = rasterio.transform.Affine(*meta['transform'])
+        self.crs        = rasterio.crs.CRS.from_wkt(meta['crs']) if meta['crs'] else None
+        self.block_days = int(meta['block_days'])
+        self.chunk_rows = int(meta['chunk_rows'])
+        self.codec      = meta['codec']
+        self.valid = np.load(os.path.join(dirname, 'valid.npy'), mmap_mode=mode)
+        self.done  = np.load(os.path.join(dirname, 'done.npy'),  mmap_mode=mode)
+        self._scratch = dict() # day index -> packed day memmap open for writing
+        self._cache   = dict() # (block, chunk) -> decoded packed days, oldest first
+
+    @staticmethod
+    def _read_meta(dirname):
+        fname_meta = os.path.join(dirname, 'meta.json')
+        if not os.path.isfile(fname_meta):
+            raise FileNotFoundError(f'InundationCube could not find {fname_meta}')
+        with open(fname_meta, 'r') as f:
+            return json.load(f)
+
+    @classmethod
+    def create(cls, dirname, dt_start, dt_end, profile, block_days=32, chunk_rows=128, codec='bz2'):
+        """Create an empty cube for days dt_start..dt_end on the grid of a rasterio profile"""
+        if codec not in _CODECS:
+            raise ValueError(f'InundationCube invalid codec {codec}, must be one of {", ".join(_CODECS)}')
+        os.makedirs(dirname, exist_ok=True)
+        for name in ('wet', 'wet.npy'):
+            path = os.path.join(dirname, name)
+            if os.path.isdir(path): shutil.rmtree(path)
+            elif os.path.isfile(path): os.remove(path)
+        os.makedirs(os.path.join(dirname, 'wet'))
+        n_days = (dt_end - dt_start).days + 1
+        height, width = profile['height'], profile['width']
+        packed_width = (width + 7) // 8
+        np.save(os.path.join(dirname, 'valid.npy'), np.zeros((height, packed_width), dtype=np.uint8))
+        np.save(os.path.join(dirname, 'done.npy'), np.zeros((n_days,), dtype=np.uint8))
+        crs = profile.get('crs')
+        meta = {'layout'     : _LAYOUT,
+                'dt_start'   : dt_start.strftime('%Y%m%d'),
+                'n_days'     : n_days,
+                'height'     : height,
+                'width'      : width,
+                'transform'  : list(profile['transform'])[:6],
+                'crs'        : crs.to_wkt() if crs is not None else None,
+                'block_days' : int(block_days),
+                'chunk_rows' : int(chunk_rows),
+                'codec'      : codec}
+        # meta.json is written last, a cube without it is incomplete
+        with open(os.path.join(dirname, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        return cls(dirname, mode='r+')
+
+    @classmethod
+    def open_or_create(cls, dirname, dt_start, dt_end, profile, overwrite=False):
+        """Open an existing cube matching the dates and grid, else (re)create it"""
+        fname_meta = os.path.join(dirname, 'meta.json')
+        if not overwrite and os.path.isfile(fname_meta) and cls._read_meta(dirname).get('layout') == _LAYOUT:
+            cube = cls(dirname, mode='r+')
+            if (cube.dt_start == dt_start and cube.dt_end == dt_end
+                    and cube.shape == (profile['height'], profile['width'])
+                    and cube.transform.almost_equals(profile['transform'])):
+                return cube
+            cube.close()
+        if os.path.isfile(fname_meta):
+            os.remove(fname_meta)
+        return cls.create(dirname, dt_start, dt_end, profile)
+
+    @property
+    def dt_end(self):
+        return self.dt_start + datetime.timedelta(days=self.n_days - 1)
+
+    @property
+    def dates(self):
+        return [self.dt_start + datetime.timedelta(days=i) for i in range(self.n_days)]
+
+    @property
+    def profile(self):
+        """Profile of a float32 single band GeoTIFF on the cube grid"""
+        return {'driver'    : 'GTiff',
+                'height'    : self.shape[0],
+                'width'     : self.shape[1],
+                'count'     : 1,
+                'dtype'     : 'float32',
+                'crs'       : self.crs,
+                'transform' : self.transform}
+
+    @property
+    def packed_width(self):
+        return (self.shape[1] + 7) // 8
+
+    def day_index(self, dt):
+        """Index of date dt in the cube"""
+        i = (dt - self.dt_start).days
+        if i < 0 or i >= self.n_days:
+            raise KeyError(f'InundationCube date {dt} is outside {self.dt_start} to {self.dt_end}')
+        return i
+
+    def missing_days(self):
+        """Indices of days that have not been completely written"""
+        return np.flatnonzero(np.asarray(self.done) == 0)
+
+    def close(self):
+        """Flush the open days and, if writable, compress every complete block that is not yet"""
+        for arr in list(self._scratch.values()) + [self.valid, self.done]:
+            if isinstance(arr, np.memmap):
+                arr.flush()
+        self._scratch.clear()
+        if self.mode != 'r' and self.done is not None:
+            for b in range(self._n_blocks()):
+                if not os.path.isfile(self._block_fname(b)) and self._block_complete(b):
+                    self._pack_block(b)
+        self.valid = self.done = None
+        self._cache.clear()
+
+    # writers
+
+    def write_day(self, i, wet, window=None):
+        """Write boolean wet flags of day index i (whole grid or a window)"""
+        if i not in self._scratch:
+            self._scratch[i] = np.lib.format.open_memmap(self._day_fname(i), mode='w+', dtype=np.uint8,
+                                                         shape=(self.shape[0], self.packed_width))
+        self._scratch[i][self._packed_slices(window)] = np.packbits(wet, axis=-1)
+
+    def write_valid(self, valid, window=None):
+        """Write the boolean validity mask (whole grid or a window)"""
+        self.valid[self._packed_slices(window)] = np.packbits(valid, axis=-1)
+
+    def set_done(self, i):
+        """Mark day index i as completely written, compressing its block if that completes it"""
+        day = self._scratch.pop(i, None)
+        if day is None and not os.path.isfile(self._day_fname(i)):
+            # a day never written is all dry
+            day = np.lib.format.open_memmap(self._day_fname(i), mode='w+', dtype=np.uint8,
+                                            shape=(self.shape[0], self.packed_width))
+        if day is not None:
+            day.flush()
+            del day
+        self.done[i] = 1
+        if isinstance(self.done, np.memmap):
+            self.done.flush()
+        b = i // self.block_days
+        if self._block_complete(b):
+            fname_lock = self._block_fname(b) + '.lock'
+            try:
+                fd = os.open(fname_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return # another process is compressing the block
+            os.close(fd)
+            try:
+                if not os.path.isfile(self._block_fname(b)):
+                    self._pack_block(b)
+            finally:
+                os.remove(fname_lock)
+
+    # readers
+
+    def read_day(self, dt, window=None, as_bool=False):
+        """
+        One day as float32 (1.0 wet, NaN elsewhere - the values of the daily
+        GeoTIFFs) or as a boolean array with as_bool.
+        """
+        i = self.day_index(dt)
+        wet = self._unpack(self._read_packed(i, i, *self._packed_slices(window))[0], window)
+        if as_bool:
+            return wet
+        out = np.full(wet.shape, np.nan, dtype=np.float32)
+        out[wet] = 1.0
+        return out
+
+    def read_range(self, dt_start, dt_end, window=None):
+        """Boolean (n_days, height, width) wet flags for dt_start..dt_end"""
+        i0, i1 = self.day_index(dt_start), self.day_index(dt_end)
+        return self._unpack(self._read_packed(i0, i1, *self._packed_slices(window)), window)
+
+    def read_pixel(self, row, col, dt_start=None, dt_end=None):
+        """Boolean wet time series of one pixel"""
+        i0 = self.day_index(dt_start) if dt_start is not None else 0
+        i1 = self.day_index(dt_end) if dt_end is not None else self.n_days - 1
+        byte = self._read_packed(i0, i1, slice(row, row + 1), slice(col // 8, col // 8 + 1))[:, 0, 0]
+        return ((byte >> (7 - col % 8)) & 1).astype(bool)
+
+    def pixel_index(self, x, y):
+        """(row, col) of map coordinates x, y in the cube crs"""
+        return rasterio.transform.rowcol(self.transform, x, y)
+
+    def read_valid(self, window=None):
+        return self._unpack(self.valid[self._packed_slices(window)], window)
+
+    def count_wet(self, dt_start=None, dt_end=None, window=None):
+        """uint16 number of wet days per pixel over dt_start..dt_end"""
+        i0 = self.day_index(dt_start) if dt_start is not None else 0
+        i1 = self.day_index(dt_end) if dt_end is not None else self.n_days - 1
+        rows, cols = self._packed_slices(window)
+        row0, row1, _ = rows.indices(self.shape[0])
+        width = self.shape[1] if window is None else window.width
+        counts = np.zeros((row1 - row0, width), dtype=np.uint16)
+        for _, r0, packed in self._iter_packed(i0, i1, rows, cols):
+            for day in packed:
+                counts[r0:r0 + packed.shape[1]] += self._unpack(day, window)
+        return counts
+
+    # storage
+
+    def _n_blocks(self):
+        return (self.n_days + self.block_days - 1) // self.block_days
+
+    def _block_days_range(self, b):
+        return b * self.block_days, min((b + 1) * self.block_days, self.n_days)
+
+    def _block_fname(self, b):
+        return os.path.join(self.dirname, 'wet', f'block_{b:05d}.bin')
+
+    def _day_fname(self, i):
+        return os.path.join(self.dirname, 'wet', f'day_{i:05d}.npy')
+
+    def _block_complete(self, b):
+        d0, d1 = self._block_days_range(b)
+        return bool(np.all(np.asarray(self.done[d0:d1]) == 1))
+
+    def _pack_block(self, b):
+        """Compress the scratch days of complete block b into its block file and remove them"""
+        d0, d1 = self._block_days_range(b)
+        compress = _CODECS[self.codec][0]
+        days = [np.load(self._day_fname(i), mmap_mode='r') for i in range(d0, d1)]
+        chunks = list()
+        for row0 in range(0, self.shape[0], self.chunk_rows):
+            packed = np.stack([day[row0:row0 + self.chunk_rows] for day in days])
+            packed[1:] ^= packed[:-1].copy()
+            chunks.append(compress(packed.tobytes()))
+        del days
+        offsets = np.cumsum([0] + [len(chunk) for chunk in chunks], dtype='<u8')
+        fname_block = self._block_fname(b)
+        with open(fname_block + '.tmp', 'wb') as f:
+            f.write(offsets.tobytes())
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(fname_block + '.tmp', fname_block)
+        for i in range(d0, d1):
+            os.remove(self._day_fname(i))
+
+    def _read_chunk(self, b, k):
+        """Decoded packed days (days, rows, packed width) of chunk k of block file b"""
+        if (b, k) in self._cache:
+            return self._cache[(b, k)]
+        n_chunks = (self.shape[0] + self.chunk_rows - 1) // self.chunk_rows
+        d0, d1 = self._block_days_range(b)
+        with open(self._block_fname(b), 'rb') as f:
+            offsets = np.frombuffer(f.read(8 * (n_chunks + 1)), dtype='<u8')
+            f.seek(8 * (n_chunks + 1) + int(offsets[k]))
+            data = _CODECS[self.codec][1](f.read(int(offsets[k + 1] - offsets[k])))
+        rows = min(self.chunk_rows, self.shape[0] - k * self.chunk_rows)
+        packed = np.frombuffer(data, dtype=np.uint8).reshape(d1 - d0, rows, self.packed_width)
+        chunk = np.bitwise_xor.accumulate(packed, axis=0)
+        self._cache[(b, k)] = chunk
+        while len(self._cache) > 1 and sum(c.nbytes for c in self._cache.values()) > _CACHE_BYTES:
+            del self._cache[next(iter(self._cache))]
+        return chunk
+
+    def _iter_packed(self, i0, i1, rows, cols):
+        """
+        Packed days i0..i1 of rows x (packed) cols in pieces (day offset, row
+        offset, (days, rows, cols) array), one chunk or scratch day at a time
+        """
+        row0, row1, _ = rows.indices(self.shape[0])
+        n_cols = len(range(*cols.indices(self.packed_width)))
+        for b in range(i0 // self.block_days, i1 // self.block_days + 1):
+            d0, d1 = self._block_days_range(b)
+            d0, d1 = max(d0, i0), min(d1, i1 + 1)
+            if os.path.isfile(self._block_fname(b)):
+                day0 = d0 - b * self.block_days
+                for k in range(row0 // self.chunk_rows, (row1 - 1) // self.chunk_rows + 1):
+                    chunk_row0 = k * self.chunk_rows
+                    r0, r1 = max(row0, chunk_row0), min(row1, chunk_row0 + self.chunk_rows)
+                    packed = self._read_chunk(b, k)[day0:day0 + d1 - d0, r0 - chunk_row0:r1 - chunk_row0, cols]
+                    yield d0 - i0, r0 - row0, packed
+                continue
+            for i in range(d0, d1):
+                if i in self._scratch:
+                    day = self._scratch[i][row0:row1, cols]
+                elif os.path.isfile(self._day_fname(i)):
+                    day = np.load(self._day_fname(i), mmap_mode='r')[row0:row1, cols]
+                else:
+                    day = np.zeros((row1 - row0, n_cols), dtype=np.uint8)
+                yield i - i0, 0, np.asarray(day)[None]
+
+    def _read_packed(self, i0, i1, rows, cols):
+        """Packed days i0..i1 of rows x (packed) cols as one (days, rows, cols) array"""
+        row0, row1, _ = rows.indices(self.shape[0])
+        out = np.zeros((i1 - i0 + 1, row1 - row0, len(range(*cols.indices(self.packed_width)))), dtype=np.uint8)
+        for d, r, packed in self._iter_packed(i0, i1, rows, cols):
+            out[d:d + packed.shape[0], r:r + packed.shape[1]] = packed
+        return out
+
+    def _packed_slices(self, window):
+        if window is None:
+            return (slice(None), slice(None))
+        if window.col_off % 8 != 0:
+            raise ValueError(f'InundationCube window column offset {window.col_off} is not a multiple of 8')
+        rows, cols = window.toslices()
+        return (rows, slice(cols.start // 8, (cols.stop + 7) // 8))
+
+    def _unpack(self, packed, window):
+        width = self.shape[1] if window is None else window.width
+        return np.unpackbits(np.asarray(packed), axis=-1, count=width).astype(bool)
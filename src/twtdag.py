@@ -0,0 +1,203 @@
+import os
+import time
+import asyncio
+import inspect
+import concurrent.futures
+import twtmanifest
+import twtreport
+
+class Stage:
+    """
+    One step of a domain calculation.
+
+    func is called with a single argument, overwrite (stages share state
+    through the context dict of the StageGraph they belong to), and must
+    recompute its outputs when it is True. inputs and outputs are
+    artifact names - file names or logical names like 'domain' - and a stage
+    is ready once every stage producing one of its inputs has finished.
+    cpus is the number of cores the stage keeps busy; None means it uses
+    all of them (e.g. multithreaded whitebox tools) and runs alone, 0 marks
+    an I/O bound stage (downloads) that does not count against the budget.
+    Coroutine functions are run in their own event loop. params (a dict of
+    the options the stage depends on) and code (the functions doing the
+    work) go into the stage key of a twtmanifest.Manifest.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), cpus=1, params=None, code=()):
+        self.name    = name
+        self.func    = func
+        self.inputs  = tuple(i for i in inputs if i is not None)
+        self.outputs = tuple(o for o in outputs if o is not None)
+        self.cpus    = cpus
+        self.params  = dict(params or dict())
+        self.code    = (func,) + tuple(code)
+
+    def __repr__(self):
+        return f'Stage({self.name})'
+
+    def run(self, overwrite=False):
+        if inspect.iscoroutinefunction(self.func):
+            return asyncio.run(self.func(overwrite))
+        return self.func(overwrite)
+
+class StageGraph:
+    """
+    Dependency graph of Stages, run by a scheduler that starts every ready
+    stage as soon as it fits in the cpu budget. With max_cpus=1 the stages
+    run one at a time in the order they were added (dependencies allowing),
+    i.e. like a plain sequential script.
+
+    Without a manifest every stage is called with the overwrite of the
+    graph, i.e. the stages skip outputs that already exist. With a
+    twtmanifest.Manifest a stage is called with overwrite=True whenever its
+    key (parameters, code and input artifacts) changed, its outputs were
+    modified, or its last run did not complete. Stages the manifest has no
+    entry for are trusted if all their output files exist, so projects
+    calculated before the manifest existed are not recomputed.
+    """
+
+    def __init__(self, manifest=None, overwrite=False):
+        self.stages    = list()
+        self.context   = dict()
+        self.manifest  = manifest
+        self.overwrite = overwrite
+
+    def add(self, name, func, inputs=(), outputs=(), cpus=1, params=None, code=()):
+        if name in [s.name for s in self.stages]:
+            raise ValueError(f'StageGraph already has a stage named {name}')
+        stage = Stage(name, func, inputs=inputs, outputs=outputs, cpus=cpus, params=params, code=code)
+        self.stages.append(stage)
+        return stage
+
+    def dependencies(self):
+        """Dict of stage name -> set of names of the stages it depends on"""
+        producers = dict()
+        for stage in self.stages:
+            for output in stage.outputs:
+                if output in producers:
+                    raise ValueError(f'StageGraph output {output} is produced by both {producers[output]} and {stage.name}')
+                producers[output] = stage.name
+        deps = dict()
+        for stage in self.stages:
+            deps[stage.name] = set(producers[i] for i in stage.inputs if i in producers and producers[i] != stage.name)
+        self._check_cycles(deps)
+        return deps
+
+    def producers(self):
+        """Dict of artifact name -> name of the stage producing it"""
+        return {output: stage.name for stage in self.stages for output in stage.outputs}
+
+    def _check_cycles(self, deps):
+        done, visiting = set(), set()
+        def visit(name, path):
+            if name in done: return
+            if name in visiting:
+                raise ValueError(f'StageGraph has a dependency cycle {" -> ".join(path + [name])}')
+            visiting.add(name)
+            for dep in sorted(deps[name]):
+                visit(dep, path + [name])
+            visiting.discard(name)
+            done.add(name)
+        for name in deps:
+            visit(name, [])
+
+    def critical_path(self, durations):
+        """Longest chain of stages given a dict of stage name -> duration (s), as (duration, [names])"""
+        deps  = self.dependencies()
+        best  = dict()
+        order = [s.name for s in self.stages]
+        def finish(name):
+            if name not in best:
+                chain = max([finish(d) for d in deps[name]], default=(0., []), key=lambda c: c[0])
+                best[name] = (chain[0] + durations.get(name, 0.), chain[1] + [name])
+            return best[name]
+        return max([finish(n) for n in order], default=(0., []), key=lambda c: c[0])
+
+    def run(self, max_cpus=1, verbose=False, report=None):
+        """
+        Run all stages. Returns a dict of stage name -> wall time (s). The
+        first stage exception stops the scheduling of new stages and is
+        raised once the running stages have finished. With a
+        twtreport.RunReport every stage is measured into it.
+        """
+        max_cpus = max(1, int(max_cpus or os.cpu_count() or 1))
+        deps     = self.dependencies()
+        keys     = dict() # stage name -> manifest key
+        pending  = list(self.stages)
+        running  = dict() # future -> stage
+        finished = set()
+        durations, started = dict(), dict()
+        error = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.stages))) as pool:
+            while pending or running:
+                if error is None:
+                    used = sum(self._cpus(s, max_cpus) for s in running.values())
+                    for stage in list(pending):
+                        if not deps[stage.name] <= finished:
+                            continue
+                        if running and max_cpus == 1:
+                            break # keep the declared order when running sequentially
+                        cpus = self._cpus(stage, max_cpus)
+                        if running and used + cpus > max_cpus:
+                            continue
+                        if verbose and max_cpus > 1:
+                            print(f' starting stage {stage.name}', flush=True)
+                        pending.remove(stage)
+                        overwrite = self._begin(stage, keys)
+                        if verbose and overwrite and not self.overwrite:
+                            print(f' stage {stage.name} is out of date, recomputing its outputs', flush=True)
+                        started[stage.name] = time.perf_counter()
+                        running[pool.submit(self._run_stage, stage, overwrite, report)] = stage
+                        used += cpus
+                    if not running and pending:
+                        blocked = ', '.join(s.name for s in pending)
+                        raise RuntimeError(f'StageGraph could not schedule stages {blocked}')
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    durations[stage.name] = time.perf_counter() - started[stage.name]
+                    try:
+                        future.result()
+                    except BaseException as e:
+                        if error is None: error = e
+                        continue
+                    if self.manifest is not None:
+                        self.manifest.complete(stage.name, keys[stage.name], stage.outputs)
+                    finished.add(stage.name)
+        if error is not None:
+            raise error
+        if verbose and max_cpus > 1:
+            length, path = self.critical_path(durations)
+            print(f' stage wall time {sum(durations.values()):.1f} s, critical path {length:.1f} s ({" -> ".join(path)})')
+        return durations
+
+    def _begin(self, stage, keys):
+        """Manifest key of a stage that is about to run, returns its overwrite"""
+        if self.manifest is None:
+            return self.overwrite
+        producers = self.producers()
+        inputs = dict()
+        for name in stage.inputs:
+            path_fp = twtmanifest.fingerprint(name) if twtmanifest.is_path(name) else None
+            inputs[name] = f'{keys.get(producers[name])}:{path_fp}' if name in producers else path_fp
+        key = twtmanifest.stage_key(stage.name, params=stage.params, code=stage.code, inputs=inputs)
+        keys[stage.name] = key
+        if self.manifest.is_current(stage.name, key):
+            return self.overwrite
+        paths = [o for o in stage.outputs if twtmanifest.is_path(o)]
+        if stage.name not in self.manifest.entries and paths and all(os.path.exists(p) for p in paths):
+            return self.overwrite
+        self.manifest.start(stage.name, key)
+        return True
+
+    @staticmethod
+    def _run_stage(stage, overwrite, report):
+        with twtreport.measure(report, stage.name):
+            return stage.run(overwrite)
+
+    @staticmethod
+    def _cpus(stage, max_cpus):
+        if stage.cpus is None: return max_cpus
+        return max(0, min(int(stage.cpus), max_cpus))
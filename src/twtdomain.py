@@ -1,4 +1,4 @@
-import os,pygeohydro,geopandas,shapely
+import os,geopandas,shapely,twtproviders
     
 def set_domain(**kwargs):
     fname_domain  = kwargs.get('fname_domain',  None)
@@ -61,9 +61,9 @@ def _set_domain_byhucid(**kwargs):
         raise TypeError('_set_domain_byhucid domain_hucid must be type str') 
     if len(domain_hucid) not in (2,4,6,8,10,12):
         raise ValueError(f'_set_domain_byhucid domain_hucid {domain_hucid} is invalid, must be of len 2, 4, 6, 8, 10, 12')
+    provider = kwargs.get('provider', None) or twtproviders.WBDHUC()
     colnam = f'huc{len(domain_hucid)}'
-    hucs   = pygeohydro.WBD(colnam) 
-    domain = hucs.byids(colnam, domain_hucid, return_geom=True)
+    domain = provider.byids(len(domain_hucid), domain_hucid)
     domain = domain.drop(columns=[col for col in domain.columns if col not in [colnam,'geometry']]) 
     domain = domain.rename(columns = {colnam : 'domain_id'})
     domain.geometry = domain.geometry.force_2d()
@@ -96,9 +96,9 @@ def _set_domain_bylatlonandhuclvl(**kwargs):
     if not isinstance(domain_latlon,list) or not all(isinstance(v, float) for v in domain_latlon) or len(domain_latlon) != 2:
         raise ValueError(f'_set_domain_bylatlonandhuclvl invalid domain_latlon')
     geom = shapely.geometry.Point(domain_latlon[1],domain_latlon[0]).buffer(0.01)
+    provider = kwargs.get('provider', None) or twtproviders.WBDHUC()
     colnam = f'huc{huc_lvl}'
-    hucs   = pygeohydro.WBD(colnam)
-    domain = hucs.bygeom(geom)
+    domain = provider.bygeom(huc_lvl, geom)
     domain = domain.drop(columns=[col for col in domain.columns if col not in [colnam,'geometry']]) 
     domain.geometry = domain.geometry.force_2d()
     os.makedirs(name=os.path.dirname(fname_domain),exist_ok=True)
@@ -110,13 +110,14 @@ def get_conus1_hucs(**kwargs):
     fname_domain_hucs = kwargs.get('fname_domain_hucs', None)
     huc_lvl           = kwargs.get('huc_lvl',           8)
     verbose           = kwargs.get('verbose',           False)
+    provider          = kwargs.get('provider',          None) or twtproviders.WBDHUC()
     if not os.path.isfile(fname_domain_hucs):
         fname_wb_full_temp = str(os.path.join(os.path.dirname(fname_domain_hucs),
                                               f'wb_full_huc{str(huc_lvl)}.gpkg'))
         if os.path.isfile(fname_wb_full_temp): 
             wb_full = geopandas.read_file(fname_wb_full_temp)
         else:
-            wb_full = pygeohydro.watershed.huc_wb_full(huc_lvl)
+            wb_full = provider.wb_full(huc_lvl)
             wb_full.to_file(fname_wb_full_temp)
         domain      = geopandas.read_file(fname_domain)
         domain_hucs = geopandas.clip(gdf=wb_full,mask=domain.to_crs(wb_full.crs))
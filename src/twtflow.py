@@ -0,0 +1,261 @@
+"""
+Flow directions (D8 and D-infinity) and flow accumulation over a breached
+DEM in numpy, in place of the WhiteboxTools d_inf_flow_accumulation calls.
+Flow only goes to strictly lower neighbours, so cells sorted by descending
+elevation are in topological order; with numba the accumulation walks that
+order cell by cell, without it the cells are processed as a sequence of
+fronts (cells whose upslope cells are all done) with vectorized numpy.
+"""
+import os
+import numpy
+import rasterio
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# neighbour offsets (row, col), counterclockwise from east
+_E, _NE, _N, _NW, _W, _SW, _S, _SE = (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1), (1, 0), (1, 1)
+_D8 = [_E, _NE, _N, _NW, _W, _SW, _S, _SE]
+# Tarboton (1997) facets: (cardinal neighbour e1, diagonal neighbour e2)
+_FACETS = [(_E, _NE), (_N, _NE), (_N, _NW), (_W, _NW), (_W, _SW), (_S, _SW), (_S, _SE), (_E, _SE)]
+
+def cell_sizes(transform, crs, height):
+    """Cell width and height in meters (degrees converted at the mid latitude of a geographic grid)"""
+    dx, dy = abs(transform.a), abs(transform.e)
+    if crs is not None and rasterio.crs.CRS.from_user_input(crs).is_geographic:
+        lat = numpy.radians(transform.f + transform.e * height / 2.)
+        dx, dy = dx * 111320. * numpy.cos(lat), dy * 111320.
+    return float(dx), float(dy)
+
+# cells per row band of the direction calculations, which only hold band sized temporaries
+_BAND_CELLS = 2**20
+
+def _shifted(z, drow, dcol):
+    """z[row+drow, col+dcol] for every cell, NaN outside the grid"""
+    out = numpy.full(z.shape, numpy.nan, dtype=z.dtype)
+    rows, cols = z.shape
+    out[max(0, -drow):rows - max(0, drow), max(0, -dcol):cols - max(0, dcol)] = \
+        z[max(0, drow):rows - max(0, -drow), max(0, dcol):cols - max(0, -dcol)]
+    return out
+
+def _index_dtype(n):
+    """Smallest signed integer type for flat indices into n cells"""
+    return numpy.int32 if n < 2**31 else numpy.int64
+
+def _bands(z, band_cells=_BAND_CELLS):
+    """
+    Yield (row0, row1, zb) for bands of about band_cells cells: zb is rows
+    row0:row1 of z as float64, with the rows above and below (if any) as a halo
+    """
+    rows, cols = z.shape
+    band_rows = max(1, band_cells // max(1, cols))
+    for row0 in range(0, rows, band_rows):
+        row1 = min(row0 + band_rows, rows)
+        yield row0, row1, numpy.asarray(z[max(0, row0 - 1):min(rows, row1 + 1)], dtype=numpy.float64)
+
+def _core(arr, row0, row1):
+    """Rows of a halo band array that belong to the band row0:row1"""
+    top = 1 if row0 > 0 else 0
+    return arr[top:top + row1 - row0]
+
+def _band_index(row0, row1, cols, drow, dcol, dtype):
+    """Flat index of the (drow, dcol) neighbour of every cell of rows row0:row1"""
+    return (numpy.arange(row0 * cols, row1 * cols, dtype=dtype).reshape(row1 - row0, cols) + (drow * cols + dcol))
+
+def d8_directions(z, dx=1., dy=1.):
+    """
+    D8 receiver (flat index, -1 for none) of each cell of z (NaN is nodata):
+    the neighbour with the steepest drop per unit distance, if any is lower.
+    The grid is processed in row bands, so besides the result (int32 unless
+    the grid has 2**31 cells or more) only band sized arrays are allocated.
+    """
+    rows, cols = z.shape
+    best = numpy.full(z.shape, -1, dtype=_index_dtype(z.size))
+    for row0, row1, zb in _bands(z):
+        best_slope = numpy.zeros(zb.shape)
+        best_dir   = numpy.full(zb.shape, -1, dtype=numpy.int8)
+        for k, (drow, dcol) in enumerate(_D8):
+            slope = (zb - _shifted(zb, drow, dcol)) / numpy.hypot(drow * dy, dcol * dx)
+            steeper = slope > best_slope # False for NaN
+            best_slope[steeper] = slope[steeper]
+            best_dir[steeper] = k
+        best_dir = _core(best_dir, row0, row1)
+        out = best[row0:row1]
+        for k, (drow, dcol) in enumerate(_D8):
+            in_dir = best_dir == k
+            out[in_dir] = _band_index(row0, row1, cols, drow, dcol, best.dtype)[in_dir]
+    return best.ravel()
+
+def dinf_directions(z, dx=1., dy=1.):
+    """
+    D-infinity flow (Tarboton 1997) of each cell of z (NaN is nodata) as two
+    receivers and their proportions (recv1, p1, recv2, p2), flat indices and
+    -1 for none. Of the 8 triangular facets around a cell the one with the
+    steepest downslope gradient is taken, and the flow is split between its
+    cardinal and diagonal neighbour by the angle of the gradient in it.
+    The grid is processed in row bands, so besides the results (int32
+    receivers unless the grid has 2**31 cells or more, float32 proportions)
+    only band sized arrays are allocated.
+    """
+    rows, cols = z.shape
+    recv1 = numpy.full(z.shape, -1, dtype=_index_dtype(z.size))
+    recv2 = numpy.full(z.shape, -1, dtype=recv1.dtype)
+    p2    = numpy.zeros(z.shape, dtype=numpy.float32)
+    for row0, row1, zb in _bands(z):
+        best_slope = numpy.zeros(zb.shape)
+        best_facet = numpy.full(zb.shape, -1, dtype=numpy.int8)
+        best_r     = numpy.zeros(zb.shape)
+        for k, ((r1, c1), (r2, c2)) in enumerate(_FACETS):
+            d1 = dx if c1 != 0 else dy # distance to the cardinal neighbour
+            d2 = dy if c1 != 0 else dx # distance from it to the diagonal one
+            e1, e2 = _shifted(zb, r1, c1), _shifted(zb, r2, c2)
+            s1 = (zb - e1) / d1
+            s2 = (e1 - e2) / d2
+            r  = numpy.arctan2(s2, s1)
+            s  = numpy.hypot(s1, s2)
+            r_max = numpy.arctan2(d2, d1)
+            low, high = r < 0., r > r_max
+            r = numpy.clip(r, 0., r_max)
+            s = numpy.where(low, s1, numpy.where(high, (zb - e2) / numpy.hypot(d1, d2), s))
+            steeper = (s > best_slope) & numpy.isfinite(e1) & numpy.isfinite(e2)
+            best_slope[steeper] = s[steeper]
+            best_facet[steeper] = k
+            best_r[steeper] = r[steeper] / r_max
+        best_facet = _core(best_facet, row0, row1)
+        p2[row0:row1] = _core(best_r, row0, row1)
+        for k, ((r1, c1), (r2, c2)) in enumerate(_FACETS):
+            in_facet = best_facet == k
+            recv1[row0:row1][in_facet] = _band_index(row0, row1, cols, r1, c1, recv1.dtype)[in_facet]
+            recv2[row0:row1][in_facet] = _band_index(row0, row1, cols, r2, c2, recv2.dtype)[in_facet]
+    p2 = p2.ravel()
+    p1 = 1. - p2
+    recv1, recv2 = recv1.ravel(), recv2.ravel()
+    recv1[p1 <= 0.] = -1
+    recv2[p2 <= 0.] = -1
+    return recv1, p1, recv2, p2
+
+def accumulate(z, recv1, p1, recv2=None, p2=None):
+    """
+    Flow accumulation: every valid (finite) cell of z starts with 1 (so the
+    result counts cells, the cell itself included) and passes its total on
+    to its receivers recv1 and recv2 (flat indices, -1 for none) in the
+    proportions p1 and p2.
+    """
+    n = z.size
+    valid = numpy.isfinite(z).ravel()
+    acc = valid.astype(numpy.float64)
+    p1 = numpy.broadcast_to(numpy.asarray(p1, dtype=numpy.result_type(p1, numpy.float32)), (n,))
+    if recv2 is None:
+        recv2, p2 = numpy.full(n, -1, dtype=recv1.dtype), numpy.zeros(n, dtype=numpy.float32)
+    p2 = numpy.broadcast_to(numpy.asarray(p2, dtype=numpy.result_type(p2, numpy.float32)), (n,))
+    if numba is not None:
+        order = numpy.argsort(-numpy.where(valid, z.ravel(), -numpy.inf), kind='stable')[:int(valid.sum())]
+        _accumulate_order_jit(order, recv1, numpy.ascontiguousarray(p1), recv2, numpy.ascontiguousarray(p2), acc)
+    else:
+        _accumulate_fronts([(recv1, p1), (recv2, p2)], acc)
+    acc[~valid] = numpy.nan
+    return acc.reshape(z.shape)
+
+def _accumulate_order(order, recv1, p1, recv2, p2, acc):
+    """Cell by cell accumulation in topological order (compiled with numba)"""
+    for k in range(order.size):
+        i = order[k]
+        a = acc[i]
+        if recv1[i] >= 0: acc[recv1[i]] += a * p1[i]
+        if recv2[i] >= 0: acc[recv2[i]] += a * p2[i]
+
+_accumulate_order_jit = numba.njit(cache=True)(_accumulate_order) if numba is not None else _accumulate_order
+
+def _accumulate_fronts(receivers, acc):
+    """Accumulation front by front: a cell is passed on once all its upslope cells are"""
+    n = acc.size
+    indeg = numpy.zeros(n, dtype=numpy.int64)
+    for recv, _ in receivers:
+        indeg += numpy.bincount(recv[recv >= 0], minlength=n)
+    front = numpy.flatnonzero(indeg == 0)
+    while front.size > 0:
+        reached = list()
+        for recv, p in receivers:
+            r = recv[front]
+            has = r >= 0
+            src, dst = front[has], r[has]
+            numpy.add.at(acc, dst, acc[src] * p[src])
+            numpy.subtract.at(indeg, dst, 1)
+            reached.append(dst)
+        reached = numpy.unique(numpy.concatenate(reached))
+        front = reached[indeg[reached] == 0]
+
+def flow_accumulation(z, dx=1., dy=1., method='dinf'):
+    """
+    Flow accumulation of a DEM array (NaN is nodata) by D-infinity ('dinf')
+    or D8 ('d8') flow directions. Returns (cells, sca): the number of cells
+    draining through each cell (itself included) and the specific
+    contributing area, cells * cell area / cell width (m).
+    """
+    z = numpy.asarray(z, dtype=numpy.result_type(z, numpy.float32))
+    if method == 'dinf':
+        recv1, p1, recv2, p2 = dinf_directions(z, dx, dy)
+        cells = accumulate(z, recv1, p1, recv2, p2)
+    elif method == 'd8':
+        cells = accumulate(z, d8_directions(z, dx, dy), 1.)
+    else:
+        raise ValueError(f'flow_accumulation invalid method {method}, must be dinf or d8')
+    sca = cells * (dx * dy) / ((dx + dy) / 2.)
+    return cells, sca
+
+def write_flow_acc(**kwargs):
+    """
+    Read fname_dem once and write its flow accumulation as cells
+    (fname_cells) and specific contributing area (fname_sca), either may be
+    None. Nodata cells keep the DEM nodata value (-32768 if it has none).
+    """
+    fname_dem   = kwargs.get('fname_dem',   None)
+    fname_cells = kwargs.get('fname_cells', None)
+    fname_sca   = kwargs.get('fname_sca',   None)
+    method      = kwargs.get('method',      'dinf')
+    verbose     = kwargs.get('verbose',     False)
+    with rasterio.open(fname_dem) as src:
+        z = src.read(1, masked=True).astype(numpy.result_type(src.dtypes[0], numpy.float32)).filled(numpy.nan)
+        profile = src.profile.copy()
+        dx, dy = cell_sizes(src.transform, src.crs, src.height)
+    if verbose: print(f' calculating {method} flow accumulation of {fname_dem} ({z.shape[0]} x {z.shape[1]}, numba {"on" if numba is not None else "off"})')
+    cells, sca = flow_accumulation(z, dx, dy, method=method)
+    nodata = profile.get('nodata')
+    nodata = -32768. if nodata is None or not numpy.isfinite(nodata) else nodata
+    profile.update(driver='GTiff', dtype='float32', count=1, nodata=nodata, compress='deflate', tiled=True,
+                   blockxsize=512, blockysize=512, bigtiff='IF_SAFER')
+    for fname, arr in ((fname_cells, cells), (fname_sca, sca)):
+        if fname is None: continue
+        with rasterio.open(fname, 'w', **profile) as dst:
+            dst.write(numpy.where(numpy.isnan(arr), nodata, arr).astype(numpy.float32), 1)
+
+def compare_with_whitebox(**kwargs):
+    """
+    Run whitebox d_inf_flow_accumulation and write_flow_acc on fname_dem
+    (into dirname) and return, per output type, the fraction of cells that
+    agree within rtol and the largest relative difference.
+    """
+    import whitebox
+    fname_dem = kwargs.get('fname_dem', None)
+    dirname   = kwargs.get('dirname',   None)
+    rtol      = kwargs.get('rtol',      1e-3)
+    os.makedirs(dirname, exist_ok=True)
+    fnames = {out_type: (os.path.join(dirname, f'wbt_{out_type}.tiff'), os.path.join(dirname, f'twt_{out_type}.tiff'))
+              for out_type in ('cells', 'sca')}
+    wbt = whitebox.WhiteboxTools()
+    for out_type, (fname_wbt, _) in fnames.items():
+        wbt.d_inf_flow_accumulation(i=fname_dem, output=fname_wbt, out_type=out_type, log=False)
+    write_flow_acc(fname_dem=fname_dem, fname_cells=fnames['cells'][1], fname_sca=fnames['sca'][1])
+    stats = dict()
+    for out_type, (fname_wbt, fname_twt) in fnames.items():
+        with rasterio.open(fname_wbt) as a, rasterio.open(fname_twt) as b:
+            wbt_arr = a.read(1, masked=True).astype(numpy.float64).filled(numpy.nan)
+            twt_arr = b.read(1, masked=True).astype(numpy.float64).filled(numpy.nan)
+        both = numpy.isfinite(wbt_arr) & numpy.isfinite(twt_arr)
+        rel  = numpy.abs(twt_arr[both] - wbt_arr[both]) / numpy.maximum(numpy.abs(wbt_arr[both]), 1e-12)
+        stats[out_type] = {'n_cells'       : int(both.sum()),
+                           'n_nodata_diff' : int((numpy.isfinite(wbt_arr) != numpy.isfinite(twt_arr)).sum()),
+                           'frac_within'   : float((rel <= rtol).mean()) if rel.size else 1.,
+                           'max_rel_diff'  : float(rel.max()) if rel.size else 0.}
+    return stats
@@ -8,8 +8,12 @@ import twttopo
 import twtsoils
 import twtstreams
 import twtcalc
+import twtdag
+import twtmanifest
+import twtreport
+import twtproviders
+import twtflow
 import datetime
-import hf_hydrodata
 
 async def calculate(fname_namelist):
     #
@@ -26,183 +30,474 @@ async def calculate(fname_namelist):
     #    print(f'using dask with chunks {chunks}')
     #
     #
-    kwargs = {'fname_domain' : namelist.fnames.domain,
-              'verbose'      : namelist.options.verbose,
-              'overwrite'    : namelist.options.overwrite,
-              'conus1_domain': namelist.fnames.conus1_domain}
-    if namelist.options.domain_hucid is not None:
-        kwargs.update({'domain_hucid'     : namelist.options.domain_hucid})
-    elif namelist.options.domain_latlon is not None:
-        kwargs.update({'domain_latlon' : namelist.options.domain_latlon})
-    elif namelist.options.domain_bbox is not None:
-        kwargs.update({'domain_bbox'   : namelist.options.domain_bbox})
-    else:
-        if not os.path.isfile(namelist.fnames.domain):
-            raise ValueError(f'calculate could not set domain from namelist options, and domain file {namelist.fnames.domain} does not exist')
-    domain = twtdomain.set_domain(**kwargs)
-    #
-    #
-    kwargs = {'domain'           : domain,
-              'fname_domain_buf' : namelist.fnames.domain_buf,
-              'buf_dist_m'       : namelist.options.domain_buf_dist_m,
-              'verbose'          : namelist.options.verbose,
-              'overwrite'        : namelist.options.overwrite}
-    domain_buf = twtdomain.set_domain_buf(**kwargs)
-    #
-    #
-    kwargs = {'dt_start'  : namelist.time.start_date,
-              'dt_end'    : namelist.time.end_date,
-              'dir_wtd'   : namelist.dirnames.wtd_raw,
-              'verbose'   : namelist.options.verbose}
-    wtd_get_flag = twtwt.set_wtd_get_flag(**kwargs)
-    if namelist.options.verbose and not wtd_get_flag:
-        print(f' found water table depth data for all dates in range in {namelist.dirnames.wtd_raw}')
-    if wtd_get_flag and namelist.options.conus1_download_dir is None:
+    report = twtreport.RunReport(domain=os.path.basename(namelist.dirnames.project))
+    graph = build_stage_graph(namelist)
+    graph.context['report'] = report
+    try:
+        await asyncio.to_thread(graph.run, max_cpus=namelist.options.stage_cpus,
+                                verbose=namelist.options.verbose, report=report)
+    finally:
+        report.write(namelist.fnames.run_report, os.path.splitext(namelist.fnames.run_report)[0] + '.csv')
+        if namelist.options.verbose:
+            print(f' wrote run report {namelist.fnames.run_report}')
+    #
+    #
+    return None
+
+def build_stage_graph(namelist:twtnamelist.Namelist):
+    """
+    Stages of a domain calculation as a twtdag.StageGraph. Inputs and outputs
+    are the namelist file names (or logical names for in-memory results), so
+    e.g. the WTD download, the soils branch and the DEM branch are
+    independent until the inundation stages.
+    """
+    manifest = twtmanifest.Manifest(namelist.fnames.manifest) if namelist.options.stage_manifest else None
+    graph = twtdag.StageGraph(manifest=manifest, overwrite=namelist.options.overwrite)
+    ctx   = graph.context
+    fnames, options = namelist.fnames, namelist.options
+    providers = twtproviders.get_providers(mode         = options.data_provider,
+                                           mirror       = options.data_mirror,
+                                           cache_dir    = options.data_cache or os.path.join(namelist.dirnames.project, 'cache'),
+                                           cache_max_gb = options.data_cache_max_gb,
+                                           dem_tiles    = options.dem_tile_cache,
+                                           dem_tile_m   = options.dem_tile_size_m)
+    #
+    #
+    def stage_domain(overwrite):
+        kwargs = {'fname_domain' : namelist.fnames.domain,
+                  'verbose'      : namelist.options.verbose,
+                  'overwrite'    : overwrite,
+                  'conus1_domain': namelist.fnames.conus1_domain,
+                  'provider'     : providers['huc']}
+        if namelist.options.domain_hucid is not None:
+            kwargs.update({'domain_hucid'     : namelist.options.domain_hucid})
+        elif namelist.options.domain_latlon is not None:
+            kwargs.update({'domain_latlon' : namelist.options.domain_latlon})
+        elif namelist.options.domain_bbox is not None:
+            kwargs.update({'domain_bbox'   : namelist.options.domain_bbox})
+        else:
+            if not os.path.isfile(namelist.fnames.domain):
+                raise ValueError(f'calculate could not set domain from namelist options, and domain file {namelist.fnames.domain} does not exist')
+        ctx['domain'] = twtdomain.set_domain(**kwargs)
+    graph.add('domain', stage_domain, inputs=[fnames.conus1_domain], outputs=['domain', fnames.domain],
+              params={'domain_hucid'  : options.domain_hucid,
+                      'domain_latlon' : options.domain_latlon,
+                      'domain_bbox'   : options.domain_bbox},
+              code=[twtdomain.set_domain])
+    #
+    #
+    def stage_domain_buf(overwrite):
+        kwargs = {'domain'           : ctx['domain'],
+                  'fname_domain_buf' : namelist.fnames.domain_buf,
+                  'buf_dist_m'       : namelist.options.domain_buf_dist_m,
+                  'verbose'          : namelist.options.verbose,
+                  'overwrite'        : overwrite}
+        ctx['domain_buf'] = twtdomain.set_domain_buf(**kwargs)
+    graph.add('domain_buf', stage_domain_buf, inputs=['domain'], outputs=['domain_buf', fnames.domain_buf],
+              params={'buf_dist_m' : options.domain_buf_dist_m},
+              code=[twtdomain.set_domain_buf])
+    #
+    #
+    def stage_wtd(overwrite):
+        domain_buf = ctx['domain_buf']
         kwargs = {'dt_start'  : namelist.time.start_date,
                   'dt_end'    : namelist.time.end_date,
                   'dir_wtd'   : namelist.dirnames.wtd_raw,
-                  'domain'    : domain_buf,
-                  'verbose'   : namelist.options.verbose,
-                  'overwrite' : namelist.options.overwrite}
-        hf_hydrodata.register_api_pin(namelist.options.hf_hydrodata_un, namelist.options.hf_hydrodata_pin)
-        twtwt.download_hydroframe_data(**kwargs)
-    elif wtd_get_flag and namelist.options.conus1_download_dir is not None:
-        kwargs = {'dt_start'  : namelist.time.start_date,
-                  'dt_end'    : namelist.time.end_date,
-                  'wtd_in_dir': namelist.options.conus1_download_dir,
-                  'wtd_out_dir': namelist.dirnames.wtd_raw,
-                  'domain'    : domain_buf,
-                  'verbose'   : namelist.options.verbose,
-                  'overwrite' : namelist.options.overwrite}
-        twtwt.break_conus1_tiffs(**kwargs)
-    #
-    #
-    if namelist.fnames.dem_namelist_input is not None and os.path.isfile(namelist.fnames.dem_namelist_input):
-        kwargs = {'fname_dem_parent' : namelist.fnames.dem_namelist_input,
-                  'fname_dem_child'  : namelist.fnames.dem,
-                  'fname_boundary'   : namelist.fnames.domain,
-                  'verbose'          : namelist.options.verbose,
-                  'overwrite'        : namelist.options.overwrite}
-        twttopo.break_dem(**kwargs)
-    else:
-        kwargs = {'domain'    : domain,
-                'dem_rez'   : namelist.options.dem_rez,
-                'fname_dem' : namelist.fnames.dem,
-                'verbose'   : namelist.options.verbose,
-                'overwrite' : namelist.options.overwrite}
-        await twttopo.download_dem(**kwargs)
-    #
-    #
-    kwargs = {'fname_dem_breached' : namelist.fnames.dem_breached,
-              'fname_dem'          : namelist.fnames.dem,
-              'verbose'            : namelist.options.verbose,
-              'overwrite'          : namelist.options.overwrite}
-    twttopo.breach_dem(**kwargs)
-    #
-    #
-    kwargs = {'fname_dem_breached' : namelist.fnames.dem_breached,
-              'fname_facc_ncells'  : namelist.fnames.facc_ncells,
-              'fname_facc_sca'     : namelist.fnames.facc_sca,
-              'verbose'            : namelist.options.verbose,
-              'overwrite'          : namelist.options.overwrite}
-    twttopo.set_flow_acc(**kwargs)
-    #
-    #
-    kwargs = {'fname_facc_ncells'     : namelist.fnames.facc_ncells,
-              'facc_threshold_ncells' : namelist.options.facc_strm_thresh_ncells,
-              'fname_strm_mask'       : namelist.fnames.stream_mask,
-              'verbose'               : namelist.options.verbose,
-              'overwrite'             : namelist.options.overwrite}
-    twttopo.calc_stream_mask(**kwargs)
-    #
-    #
-    kwargs = {'fname_dem_breached' : namelist.fnames.dem_breached,
-              'fname_slope'        : namelist.fnames.slope,
-              'verbose'            : namelist.options.verbose,
-              'overwrite'          : namelist.options.overwrite}
-    twttopo.calc_slope(**kwargs)
-    #
-    #
-    kwargs = {'fname_facc_sca' : namelist.fnames.facc_sca,
-              'fname_twi'      : namelist.fnames.twi,
-              'fname_slope'    : namelist.fnames.slope,
-              'verbose'        : namelist.options.verbose,
-              'overwrite'      : namelist.options.overwrite}
-    twttopo.calc_twi(**kwargs)
-    #
-    #
-    kwargs = {'fname_twi_mean' : namelist.fnames.twi_mean,
-              'fname_twi'      : namelist.fnames.twi,
-              'wtd_raw_dir'    : namelist.dirnames.wtd_raw,
-              'verbose'        : namelist.options.verbose,
-              'overwrite'      : namelist.options.overwrite}
-    twttopo.calc_twi_mean(**kwargs)
-    #
-    #
-    if os.path.isfile(namelist.fnames.soil_texture_namelist_input):
-        kwargs = {'fname_texture_parent' : namelist.fnames.soil_texture_namelist_input,
-                'fname_texture_child'    : namelist.fnames.soil_texture,
-                'fname_domain'           : namelist.fnames.domain,
-                'verbose'                : namelist.options.verbose,
-                'overwrite'              : namelist.options.overwrite}
-        twtsoils.break_soil_texture(**kwargs)
-    else:
-        kwargs = {'fname_texture'  : namelist.fnames.soil_texture,
-                'domain'         : domain,
-                'domain_buf'     : domain_buf,
-                'verbose'        : namelist.options.verbose,
-                'overwrite'      : namelist.options.overwrite}
-        await twtsoils.download_soil_texture(**kwargs)
-    #
-    #
-    kwargs = {'fname_texture'        : namelist.fnames.soil_texture,
-              'fname_transmissivity' : namelist.fnames.soil_transmissivity,
-              'fname_dem'            : namelist.fnames.dem_breached,
-              'verbose'              : namelist.options.verbose,
-              'overwrite'            : namelist.options.overwrite}
-    twtsoils.set_soil_transmissivity(**kwargs)
-    #
-    #
-    kwargs = {'fname_streams' : namelist.fnames.nhdp,
-              'domain'        : domain,
-              'verbose'       : namelist.options.verbose,
-              'overwrite'     : namelist.options.overwrite}
+                  'verbose'   : namelist.options.verbose}
+        wtd_source = None
+        if namelist.options.wtd_format == 'netcdf':
+            wtd_get_flag = False
+            if twtwt.set_wtd_nc_get_flag(**kwargs):
+                kwargs = {'dt_start'  : namelist.time.start_date,
+                          'dt_end'    : namelist.time.end_date,
+                          'savedir'   : namelist.dirnames.wtd_raw,
+                          'domain'    : domain_buf,
+                          'provider'  : providers['wtd'],
+                          'verbose'   : namelist.options.verbose}
+                providers['wtd'].login(namelist.options.hf_hydrodata_un, namelist.options.hf_hydrodata_pin)
+                twtwt.hf_query_nc(**kwargs)
+            elif namelist.options.verbose:
+                print(f' found water table depth netcdf files for all water years in range in {namelist.dirnames.wtd_raw}')
+            wtd_source = twtwt.WTDNetCDFSource.from_domain(namelist.dirnames.wtd_raw, domain_buf,
+                                                           dt_start=namelist.time.start_date)
+        else:
+            wtd_get_flag = twtwt.set_wtd_get_flag(**kwargs)
+        if namelist.options.verbose and not wtd_get_flag and wtd_source is None:
+            print(f' found water table depth data for all dates in range in {namelist.dirnames.wtd_raw}')
+        if wtd_get_flag and namelist.options.conus1_download_dir is None:
+            kwargs = {'dt_start'  : namelist.time.start_date,
+                      'dt_end'    : namelist.time.end_date,
+                      'dir_wtd'   : namelist.dirnames.wtd_raw,
+                      'domain'    : domain_buf,
+                      'provider'  : providers['wtd'],
+                      'verbose'   : namelist.options.verbose,
+                      'overwrite' : overwrite}
+            providers['wtd'].login(namelist.options.hf_hydrodata_un, namelist.options.hf_hydrodata_pin)
+            twtwt.download_hydroframe_data(**kwargs)
+        elif wtd_get_flag and namelist.options.conus1_download_dir is not None:
+            kwargs = {'dt_start'  : namelist.time.start_date,
+                      'dt_end'    : namelist.time.end_date,
+                      'wtd_in_dir': namelist.options.conus1_download_dir,
+                      'wtd_out_dir': namelist.dirnames.wtd_raw,
+                      'domain'    : domain_buf,
+                      'verbose'   : namelist.options.verbose,
+                      'overwrite' : overwrite}
+            twtwt.break_conus1_tiffs(**kwargs)
+        ctx['wtd_source'] = wtd_source
+    # the wtd stage downloads only the dates it is missing, so the date range is not a parameter
+    graph.add('wtd', stage_wtd, inputs=['domain_buf'], outputs=['wtd', namelist.dirnames.wtd_raw], cpus=0,
+              params={'wtd_format'          : options.wtd_format,
+                      'conus1_download_dir' : options.conus1_download_dir},
+              code=[twtwt.download_hydroframe_data, twtwt.break_conus1_tiffs, twtwt.split_conus1_tiffs,
+                    twtwt.hf_query_nc])
+    #
+    #
+    async def stage_dem(overwrite):
+        domain = ctx['domain']
+        if namelist.fnames.dem_namelist_input is not None and os.path.isfile(namelist.fnames.dem_namelist_input):
+            kwargs = {'fname_dem_parent' : namelist.fnames.dem_namelist_input,
+                      'fname_dem_child'  : namelist.fnames.dem,
+                      'fname_boundary'   : namelist.fnames.domain,
+                      'verbose'          : namelist.options.verbose,
+                      'overwrite'        : overwrite}
+            twttopo.break_dem(**kwargs)
+        else:
+            kwargs = {'domain'    : domain,
+                    'dem_rez'   : namelist.options.dem_rez,
+                    'fname_dem' : namelist.fnames.dem,
+                    'provider'  : providers['dem'],
+                    'verbose'   : namelist.options.verbose,
+                    'overwrite' : overwrite}
+            await twttopo.download_dem(**kwargs)
+    graph.add('dem', stage_dem, inputs=['domain', fnames.domain, fnames.dem_namelist_input], outputs=[fnames.dem], cpus=0,
+              params={'dem_rez' : options.dem_rez},
+              code=[twttopo.break_dem, twttopo.download_dem])
+    #
+    #
+    def stage_breach_dem(overwrite):
+        kwargs = {'fname_dem_breached' : namelist.fnames.dem_breached,
+                  'fname_dem'          : namelist.fnames.dem,
+                  'mode'               : namelist.options.breach_mode,
+                  'tile_size'          : namelist.options.breach_tile_size,
+                  'tile_overlap'       : namelist.options.breach_tile_overlap,
+                  'verbose'            : namelist.options.verbose,
+                  'overwrite'          : overwrite}
+        twttopo.breach_dem(**kwargs)
+    graph.add('breach_dem', stage_breach_dem, inputs=[fnames.dem], outputs=[fnames.dem_breached], cpus=None,
+              params={'mode'         : options.breach_mode,
+                      'tile_size'    : options.breach_tile_size,
+                      'tile_overlap' : options.breach_tile_overlap},
+              code=[twttopo.breach_dem, twttopo._breach_least_cost, twttopo._breach_tiled, twttopo._breach_windows,
+                    twttopo._count_pits])
+    #
+    #
+    def stage_flow_acc(overwrite):
+        kwargs = {'fname_dem_breached' : namelist.fnames.dem_breached,
+                  'fname_facc_ncells'  : namelist.fnames.facc_ncells,
+                  'fname_facc_sca'     : namelist.fnames.facc_sca,
+                  'engine'             : namelist.options.flow_acc_engine,
+                  'method'             : namelist.options.flow_acc_method,
+                  'verbose'            : namelist.options.verbose,
+                  'overwrite'          : overwrite}
+        twttopo.set_flow_acc(**kwargs)
+    graph.add('flow_acc', stage_flow_acc, inputs=[fnames.dem_breached],
+              outputs=[fnames.facc_ncells, fnames.facc_sca], cpus=None,
+              params={'engine' : options.flow_acc_engine, 'method' : options.flow_acc_method},
+              code=[twttopo.set_flow_acc, twtflow.write_flow_acc, twtflow.dinf_directions,
+                    twtflow.d8_directions, twtflow._bands, twtflow._core, twtflow._band_index,
+                    twtflow.accumulate])
+    #
+    #
+    sweep = options.facc_strm_thresholds_ncells is not None
+    def stage_stream_mask(overwrite):
+        kwargs = {'fname_facc_ncells'     : namelist.fnames.facc_ncells,
+                  'facc_threshold_ncells' : namelist.options.facc_strm_thresh_ncells,
+                  'fname_strm_mask'       : namelist.fnames.stream_mask,
+                  'facc_thresholds'       : namelist.options.facc_strm_thresholds_ncells,
+                  'fname_strm_sweep'      : namelist.fnames.stream_mask_sweep,
+                  'verbose'               : namelist.options.verbose,
+                  'overwrite'             : overwrite}
+        twttopo.calc_stream_mask(**kwargs)
+    # a sweep covers every threshold, so changing facc_strm_threshold_ncells only reruns strm_permanence
+    graph.add('stream_mask', stage_stream_mask, inputs=[fnames.facc_ncells],
+              outputs=[fnames.stream_mask_sweep if sweep else fnames.stream_mask],
+              params={'facc_thresholds' : options.facc_strm_thresholds_ncells} if sweep else
+                     {'facc_threshold_ncells' : options.facc_strm_thresh_ncells},
+              code=[twttopo.calc_stream_mask, twttopo.calc_stream_mask_sweep])
+    #
+    #
+    def stage_twi(overwrite):
+        kwargs = {'fname_dem_breached' : namelist.fnames.dem_breached,
+                  'fname_facc_sca'     : namelist.fnames.facc_sca,
+                  'fname_twi'          : namelist.fnames.twi,
+                  'fname_slope'        : namelist.fnames.slope if namelist.options.write_slope else None,
+                  'verbose'            : namelist.options.verbose,
+                  'overwrite'          : overwrite}
+        twttopo.calc_slope_twi(**kwargs)
+    graph.add('twi', stage_twi, inputs=[fnames.dem_breached, fnames.facc_sca],
+              outputs=[fnames.twi] + ([fnames.slope] if options.write_slope else []), cpus=None,
+              params={'write_slope' : options.write_slope},
+              code=[twttopo.calc_slope_twi, twttopo._slope_twi_tile])
+    #
+    #
+    def stage_twi_mean(overwrite):
+        kwargs = {'fname_twi_mean' : namelist.fnames.twi_mean,
+                  'fname_twi'      : namelist.fnames.twi,
+                  'wtd_raw_dir'    : namelist.dirnames.wtd_raw,
+                  'wtd_source'     : ctx['wtd_source'],
+                  'dir_labels'     : namelist.dirnames.wtd_labels,
+                  'verbose'        : namelist.options.verbose,
+                  'overwrite'      : overwrite}
+        twttopo.calc_twi_mean(**kwargs)
+    graph.add('twi_mean', stage_twi_mean, inputs=[fnames.twi, 'wtd'], outputs=[fnames.twi_mean],
+              code=[twttopo.calc_twi_mean, twtcalc.wtd_labels, twtcalc.ResamplePlan])
+    #
+    #
+    async def stage_soil_texture(overwrite):
+        domain, domain_buf = ctx['domain'], ctx['domain_buf']
+        if os.path.isfile(namelist.fnames.soil_texture_namelist_input):
+            kwargs = {'fname_texture_parent' : namelist.fnames.soil_texture_namelist_input,
+                    'fname_texture_child'    : namelist.fnames.soil_texture,
+                    'fname_domain'           : namelist.fnames.domain,
+                    'dir_soil_store'         : namelist.options.soil_store,
+                    'verbose'                : namelist.options.verbose,
+                    'overwrite'              : overwrite}
+            twtsoils.break_soil_texture(**kwargs)
+        else:
+            kwargs = {'fname_texture'  : namelist.fnames.soil_texture,
+                    'domain'         : domain,
+                    'domain_buf'     : domain_buf,
+                    'fname_soil_cache': namelist.options.soil_cache,
+                    'backend'        : providers['soil'],
+                    'verbose'        : namelist.options.verbose,
+                    'overwrite'      : overwrite}
+            await twtsoils.download_soil_texture(**kwargs)
+    graph.add('soil_texture', stage_soil_texture, inputs=['domain', 'domain_buf', fnames.soil_texture_namelist_input],
+              outputs=[fnames.soil_texture], cpus=0,
+              params={'soil_store' : options.soil_store},
+              code=[twtsoils.break_soil_texture, twtsoils.download_soil_texture])
+    #
+    #
+    def stage_soil_transmissivity(overwrite):
+        kwargs = {'fname_texture'        : namelist.fnames.soil_texture,
+                  'fname_transmissivity' : namelist.fnames.soil_transmissivity,
+                  'fname_dem'            : namelist.fnames.dem_breached,
+                  'verbose'              : namelist.options.verbose,
+                  'overwrite'            : overwrite}
+        twtsoils.set_soil_transmissivity(**kwargs)
+    graph.add('soil_transmissivity', stage_soil_transmissivity,
+              inputs=[fnames.soil_texture, fnames.dem_breached], outputs=[fnames.soil_transmissivity],
+              code=[twtsoils.set_soil_transmissivity])
+    #
+    #
+    #kwargs = {'fname_streams' : namelist.fnames.nhdp,
+    #          'domain'        : domain,
+    #          'verbose'       : namelist.options.verbose,
+    #          'overwrite'     : overwrite}
     #try:
     #    twtstreams.set_streams(**kwargs)
     #except Exception as e:
     #    print(f'WARNING: failed to get NHD stream lines with error {e}')
     #
     #
-    kwargs = {'dt_start'                  : namelist.time.start_date,
-              'dt_end'                    : namelist.time.end_date,
-              'wtd_raw_dir'               : namelist.dirnames.wtd_raw,
-              'inundation_out_dir'        : namelist.dirnames.output_raw,
-              'fname_soil_trans'          : namelist.fnames.soil_transmissivity,
-              'fname_twi'                 : namelist.fnames.twi,
-              'fname_twi_mean'            : namelist.fnames.twi_mean,
-              'verbose'                   : namelist.options.verbose,
-              'overwrite'                 : namelist.options.overwrite}
-    twtcalc.calculate_inundation(**kwargs)
+    def stage_inundation(overwrite):
+        wtd_source = ctx['wtd_source']
+        if namelist.options.fuse_inundation_summary:
+            kwargs = {'dt_start'                  : namelist.time.start_date,
+                      'dt_end'                    : namelist.time.end_date,
+                      'wtd_raw_dir'               : namelist.dirnames.wtd_raw,
+                      'inundation_out_dir'        : namelist.dirnames.output_raw,
+                      'inundation_summary_dir'    : namelist.dirnames.output_summary,
+                      'write_daily'               : namelist.options.write_daily_inundation,
+                      'fname_soil_trans'          : namelist.fnames.soil_transmissivity,
+                      'fname_twi'                 : namelist.fnames.twi,
+                      'fname_twi_mean'            : namelist.fnames.twi_mean,
+                      'windowed'                  : namelist.options.windowed_inundation,
+                      'resample_plan'             : namelist.options.wtd_resample_plan,
+                      'workers'                   : namelist.options.inundation_workers,
+                      'output_format'             : namelist.options.inundation_format,
+                      'wtd_source'                : wtd_source,
+                      'resampling'                : namelist.options.resample_method,
+                      'labels_dir'                : namelist.dirnames.wtd_labels,
+                      'report'                    : ctx.get('report'),
+                      'verbose'                   : namelist.options.verbose,
+                      'overwrite'                 : overwrite}
+            fname_perc_inundated = twtcalc.calculate_inundation_summary(**kwargs)
+        else:
+            kwargs = {'dt_start'                  : namelist.time.start_date,
+                      'dt_end'                    : namelist.time.end_date,
+                      'wtd_raw_dir'               : namelist.dirnames.wtd_raw,
+                      'inundation_out_dir'        : namelist.dirnames.output_raw,
+                      'fname_soil_trans'          : namelist.fnames.soil_transmissivity,
+                      'fname_twi'                 : namelist.fnames.twi,
+                      'fname_twi_mean'            : namelist.fnames.twi_mean,
+                      'windowed'                  : namelist.options.windowed_inundation,
+                      'resample_plan'             : namelist.options.wtd_resample_plan,
+                      'workers'                   : namelist.options.inundation_workers,
+                      'output_format'             : namelist.options.inundation_format,
+                      'wtd_source'                : wtd_source,
+                      'resampling'                : namelist.options.resample_method,
+                      'labels_dir'                : namelist.dirnames.wtd_labels,
+                      'report'                    : ctx.get('report'),
+                      'verbose'                   : namelist.options.verbose,
+                      'overwrite'                 : overwrite}
+            twtcalc.calculate_inundation(**kwargs)
+            #
+            #
+            kwargs = {'dt_start'                  : namelist.time.start_date,
+                      'dt_end'                    : namelist.time.end_date,
+                      'inundation_raw_dir'        : namelist.dirnames.output_raw,
+                      'inundation_summary_dir'    : namelist.dirnames.output_summary,
+                      'fname_dem'                 : namelist.fnames.dem_breached,
+                      'inundation_format'         : namelist.options.inundation_format,
+                      'verbose'                   : namelist.options.verbose,
+                      'overwrite'                 : overwrite}
+            fname_perc_inundated = twtcalc.calculate_summary_perc_inundated(**kwargs)
+        ctx['fname_perc_inundated'] = fname_perc_inundated
+    # the percent inundated grid itself, not output_summary - strm_permanence writes there too
+    fname_perc = twtcalc.summary_fname(namelist.dirnames.output_summary, namelist.time.start_date,
+                                       namelist.time.end_date)
+    write_raw = not options.fuse_inundation_summary or options.write_daily_inundation
+    graph.add('inundation', stage_inundation,
+              inputs=['wtd', fnames.twi, fnames.twi_mean, fnames.soil_transmissivity, fnames.dem_breached],
+              outputs=['fname_perc_inundated', fname_perc, namelist.dirnames.output_raw if write_raw else None],
+              cpus=options.inundation_workers,
+              params={'dt_start'                : namelist.time.start_date,
+                      'dt_end'                  : namelist.time.end_date,
+                      'fuse_inundation_summary' : options.fuse_inundation_summary,
+                      'write_daily_inundation'  : options.write_daily_inundation,
+                      'wtd_resample_plan'       : options.wtd_resample_plan,
+                      'wtd_resample_method'     : options.resample_method.name,
+                      'inundation_format'       : options.inundation_format},
+              code=[twtcalc.calculate_inundation, twtcalc.calculate_inundation_summary,
+                    twtcalc.calculate_summary_perc_inundated, twtcalc.summary_fname, twtcalc._labels_plan,
+                    twtcalc.wtd_labels, twtcalc._run_days, twtcalc._process_day, twtcalc._init_day_worker,
+                    twtcalc._day_worker, twtcalc.ResamplePlan, twtcalc._build_plan, twtcalc._read_threshold,
+                    twtcalc._calc_threshold, twtcalc._calc_wet, twtcalc._wet_to_float, twtcalc._counts_to_perc,
+                    twtcalc._reproject_band, twtcalc._reproject_to_target, twtcalc._read_window_as_float,
+                    twtcalc._wtd_dates, twtcalc._wtd_day, twtcalc._open_wtd, twtcalc._open_cube,
+                    twtcalc._check_exist_cube, twtcalc._cube_dirname, twtcalc._check_output_format,
+                    twtcalc._geotiff_profile, twtcalc._base_profile, twtcalc._iter_windows, twtcalc._empty_grid,
+                    twtcalc._scratch_dir, twtcalc._shared_grid, twtcalc._share_array, twtcalc._attach_array,
+                    twtcalc.InundationCube])
+    #
+    #
+    def stage_strm_permanence(overwrite):
+        kwargs = {'fname_perc_inundation'     : ctx['fname_perc_inundated'],
+                  'fname_strm_mask'           : namelist.fnames.stream_mask_sweep if sweep else namelist.fnames.stream_mask,
+                  'strm_threshold'            : namelist.options.facc_strm_thresh_ncells if sweep else None,
+                  'verbose'                   : namelist.options.verbose,
+                  'overwrite'                 : overwrite}
+        twtcalc.calculate_strm_permanence(**kwargs)
+    graph.add('strm_permanence', stage_strm_permanence,
+              inputs=['fname_perc_inundated', fnames.stream_mask_sweep if sweep else fnames.stream_mask],
+              outputs=list(twtcalc.strm_permanence_fnames(fname_perc)),
+              params={'strm_threshold' : options.facc_strm_thresh_ncells if sweep else None},
+              code=[twtcalc.calculate_strm_permanence, twtcalc.strm_permanence_fnames, twtcalc.stream_sweep_step])
+    #
+    #
+    return graph
+
+def prepare_sources(**kwargs):
+    """
+    One-time preparation of the shared DEM, soil and water table depth
+    sources for a set of subdomains (e.g. before runpp.py): the child DEMs of
+    all subdomains that share a parent DEM are extracted in one pass over
+    it, the parent soil texture layer is split into a partitioned store
+    (namelist soil_store) so break_soil_texture only reads the partitions of
+    its domain, and each daily CONUS1 file in a conus1_download_dir is cut
+    for all subdomains at once (spread over workers processes). Subdomain
+    domain files must already exist.
+    """
+    #
+    #
+    fname_namelists = kwargs.get('fname_namelists', None)
+    verbose         = kwargs.get('verbose',         False)
+    overwrite       = kwargs.get('overwrite',       False)
+    workers         = kwargs.get('workers',         1)
+    if fname_namelists is None:
+        raise KeyError('prepare_sources requires fname_namelists in kwargs')
+    if verbose: print('calling prepare_sources')
+    #
+    #
+    dem_jobs, soil_jobs, wtd_jobs = dict(), dict(), dict()
+    for fname_namelist in fname_namelists:
+        namelist = twtnamelist.Namelist(filename=os.path.abspath(str(fname_namelist)))
+        if not os.path.isfile(namelist.fnames.domain):
+            print(f'WARNING prepare_sources skipping {fname_namelist} - domain file {namelist.fnames.domain} does not exist')
+            continue
+        if namelist.fnames.dem_namelist_input is not None:
+            dem_jobs.setdefault(namelist.fnames.dem_namelist_input, list()).append((namelist.fnames.domain,
+                                                                                    namelist.fnames.dem))
+        if namelist.fnames.soil_texture_namelist_input is not None and namelist.options.soil_store is not None:
+            key = (namelist.fnames.soil_texture_namelist_input, namelist.options.soil_store)
+            soil_jobs.setdefault(key, list()).append((os.path.basename(namelist.dirnames.project),
+                                                      namelist.fnames.domain))
+        if namelist.options.conus1_download_dir is not None and namelist.options.wtd_format == 'tiff':
+            kwargs = {'domain'           : twtdomain.set_domain(fname_domain=namelist.fnames.domain),
+                      'fname_domain_buf' : namelist.fnames.domain_buf,
+                      'buf_dist_m'       : namelist.options.domain_buf_dist_m}
+            domain_buf = twtdomain.set_domain_buf(**kwargs)
+            wtd_jobs.setdefault(namelist.options.conus1_download_dir, list()).append((domain_buf,
+                                                                                     namelist.dirnames.wtd_raw,
+                                                                                     namelist.time.start_date,
+                                                                                     namelist.time.end_date))
+    #
+    #
+    for fname_dem_parent, boundaries in dem_jobs.items():
+        kwargs = {'fname_dem_parent' : fname_dem_parent,
+                  'boundaries'       : boundaries,
+                  'verbose'          : verbose,
+                  'overwrite'        : overwrite}
+        twttopo.break_dems(**kwargs)
+    #
+    #
+    for (fname_texture_parent, dir_store), partitions in soil_jobs.items():
+        kwargs = {'fname_texture_parent' : fname_texture_parent,
+                  'dir_store'            : dir_store,
+                  'partitions'           : partitions,
+                  'verbose'              : verbose,
+                  'overwrite'            : overwrite}
+        twtsoils.prepare_soil_store(**kwargs)
+    #
+    #
+    for wtd_in_dir, jobs in wtd_jobs.items():
+        kwargs = {'wtd_in_dir' : wtd_in_dir,
+                  'jobs'       : jobs,
+                  'workers'    : workers,
+                  'verbose'    : verbose,
+                  'overwrite'  : overwrite}
+        twtwt.split_conus1_tiffs(**kwargs)
     #
     #
-    kwargs = {'dt_start'                  : namelist.time.start_date,
-              'dt_end'                    : namelist.time.end_date,
-              'inundation_raw_dir'        : namelist.dirnames.output_raw,
-              'inundation_summary_dir'    : namelist.dirnames.output_summary,
-              'fname_dem'                 : namelist.fnames.dem_breached,
-              'verbose'                   : namelist.options.verbose,
-              'overwrite'                 : namelist.options.overwrite}
-    fname_perc_inundated = twtcalc.calculate_summary_perc_inundated(**kwargs)
+    return None
+
+def merge_run_reports(**kwargs):
+    """
+    Merge the run reports (namelist run_report) of a set of subdomains, e.g.
+    after runpp.py, into fname_output (csv of all stage and day records) and
+    a per-stage summary next to it (<fname_output>_summary.csv).
+    """
     #
     #
-    kwargs = {'fname_perc_inundation'     : fname_perc_inundated,
-              'fname_strm_mask'           : namelist.fnames.stream_mask,
-              'verbose'                   : namelist.options.verbose,
-              'overwrite'                 : namelist.options.overwrite}
-    twtcalc.calculate_strm_permanence(**kwargs)
+    fname_namelists = kwargs.get('fname_namelists', None)
+    fname_output    = kwargs.get('fname_output',    None)
+    verbose         = kwargs.get('verbose',         False)
+    if fname_namelists is None:
+        raise KeyError('merge_run_reports requires fname_namelists in kwargs')
+    if fname_output is None:
+        raise KeyError('merge_run_reports requires fname_output in kwargs')
+    if verbose: print('calling merge_run_reports')
     #
     #
-    return None
+    fnames_report = list()
+    for fname_namelist in fname_namelists:
+        namelist = twtnamelist.Namelist(filename=os.path.abspath(str(fname_namelist)))
+        fnames_report.append(namelist.fnames.run_report)
+    #
+    #
+    records, summary = twtreport.merge_reports(fnames_report, fname_csv=fname_output, verbose=verbose)
+    return summary
 
 def calculate_async_wrapper(**kwargs):
     """async wrapper for calculation"""
@@ -0,0 +1,108 @@
+import os
+import json
+import hashlib
+import inspect
+import datetime
+import threading
+
+class Manifest:
+    """
+    Per-domain record of the stages that produced each artifact.
+
+    Every stage gets a key - a hash of its parameters, the source code of
+    its functions and the keys of its inputs - and its entry in the
+    manifest (a json file) stores that key, a 'running'/'complete' state and
+    a fingerprint (size and mtime) of each output file. A stage is current
+    when its entry is complete, has the same key and its outputs still
+    match their fingerprints; otherwise it is rerun with overwrite. A stage
+    that was interrupted mid-write stays 'running' and is rerun.
+    """
+
+    def __init__(self, fname):
+        self.fname   = fname
+        self._lock   = threading.Lock()
+        self.entries = dict()
+        if os.path.isfile(fname):
+            try:
+                with open(fname, 'r') as f:
+                    self.entries = json.load(f).get('stages', dict())
+            except (ValueError, OSError):
+                print(f'WARNING could not read manifest {fname} - rerunning all stages')
+                self.entries = dict()
+
+    def is_current(self, name, key):
+        entry = self.entries.get(name)
+        if entry is None or entry.get('state') != 'complete' or entry.get('key') != key:
+            return False
+        return all(fingerprint(path) == fp for path, fp in entry.get('outputs', dict()).items())
+
+    def start(self, name, key):
+        with self._lock:
+            self.entries[name] = {'key'     : key,
+                                  'state'   : 'running',
+                                  'started' : datetime.datetime.now().isoformat(timespec='seconds')}
+            self._save()
+
+    def complete(self, name, key, outputs):
+        with self._lock:
+            entry = self.entries.get(name, dict())
+            entry.update({'key'      : key,
+                          'state'    : 'complete',
+                          'finished' : datetime.datetime.now().isoformat(timespec='seconds'),
+                          'outputs'  : {path: fingerprint(path) for path in outputs if is_path(path)}})
+            self.entries[name] = entry
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.fname)), exist_ok=True)
+        fname_tmp = f'{self.fname}.{os.getpid()}.tmp'
+        with open(fname_tmp, 'w') as f:
+            json.dump({'stages': self.entries}, f, indent=1, sort_keys=True)
+        os.replace(fname_tmp, self.fname)
+
+def stage_key(name, params=None, code=(), inputs=None):
+    """Hash of a stage name, its parameters, the source of its code and its input keys"""
+    blob = {'name'   : name,
+            'params' : _jsonable(params or dict()),
+            'code'   : [code_version(c) for c in code],
+            'inputs' : inputs or dict()}
+    return hashlib.sha256(json.dumps(blob, sort_keys=True).encode()).hexdigest()
+
+def code_version(obj):
+    """Hash of the source code of a function (or module)"""
+    try:
+        source = inspect.getsource(obj)
+    except (OSError, TypeError):
+        source = getattr(obj, '__qualname__', repr(obj))
+    return hashlib.sha256(source.encode()).hexdigest()[:16]
+
+def fingerprint(path):
+    """
+    Cheap fingerprint of a file (size and mtime) or directory (names, sizes
+    and mtimes of its files, not recursive); None if it does not exist.
+    """
+    if os.path.isfile(path):
+        st = os.stat(path)
+        return f'{st.st_size}:{st.st_mtime_ns}'
+    if os.path.isdir(path):
+        h = hashlib.sha256()
+        for entry in sorted(os.scandir(path), key=lambda e: e.name):
+            if entry.is_file():
+                st = entry.stat()
+                h.update(f'{entry.name}:{st.st_size}:{st.st_mtime_ns};'.encode())
+        return h.hexdigest()
+    return None
+
+def is_path(name):
+    return isinstance(name, str) and (os.sep in name or (os.altsep is not None and os.altsep in name))
+
+def _jsonable(obj):
+    if isinstance(obj, dict):
+        return {str(k): _jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_jsonable(v) for v in obj]
+    if isinstance(obj, (str, int, float, bool)) or obj is None:
+        return obj
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    return repr(obj)
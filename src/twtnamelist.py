@@ -8,6 +8,7 @@ class Namelist:
         output                  = None
         wtd_raw                 = None
         wtd_resampled           = None
+        wtd_labels              = None
         output_raw              = None
         output_summary          = None
 
@@ -30,9 +31,12 @@ class Namelist:
         facc_ncells             = None
         facc_sca                = None
         stream_mask             = None
+        stream_mask_sweep       = None
         slope                   = None
         conus1_domain           = None
         soil_texture_namelist_input = None
+        manifest                = None
+        run_report              = None
 
     class Options:
         domain_hucid            = None    
@@ -44,6 +48,7 @@ class Namelist:
         resample_method         = None
         facc_strm_thresh_ncells = 1000
         facc_strm_thresh_sca    = None
+        facc_strm_thresholds_ncells = None
         write_wtd_resampled     = False
         hf_hydrodata_un         = None
         hf_hydrodata_pin        = None
@@ -51,6 +56,29 @@ class Namelist:
         conus1_download_dir     = None
         domain_buf_dist_m       = 1000
         usedask                 = False
+        fuse_inundation_summary = False
+        write_daily_inundation  = True
+        windowed_inundation     = False
+        wtd_resample_plan       = True
+        inundation_workers      = 1
+        inundation_format       = 'tiff'
+        wtd_format              = 'tiff'
+        soil_cache              = None
+        soil_store              = None
+        stage_cpus              = 1
+        stage_manifest          = True
+        data_provider           = 'remote'
+        data_mirror             = None
+        data_cache              = None
+        data_cache_max_gb       = 20.
+        dem_tile_cache          = None
+        dem_tile_size_m         = 10000.
+        flow_acc_engine         = 'whitebox'
+        flow_acc_method         = 'dinf'
+        write_slope             = False
+        breach_mode             = 'single'
+        breach_tile_size        = 4096
+        breach_tile_overlap     = 256
 
     def __init__(self,filename:str):
         self._init_vars()
@@ -72,6 +100,7 @@ class Namelist:
         self.dirnames.output            = os.path.join(self.dirnames.project, 'output')
         self.dirnames.wtd_raw           = os.path.join(self.dirnames.input,'wtd','raw')
         self.dirnames.wtd_resampled     = os.path.join(self.dirnames.input,'wtd','resampled')
+        self.dirnames.wtd_labels        = os.path.join(self.dirnames.input,'wtd','labels')
         self.dirnames.output_raw        = os.path.join(self.dirnames.output,'raw')
         self.dirnames.output_summary    = os.path.join(self.dirnames.output,'summary')
 
@@ -87,8 +116,11 @@ class Namelist:
         self.fnames.facc_ncells         = os.path.join(self.dirnames.input, 'facc_ncells.tiff')
         self.fnames.facc_sca            = os.path.join(self.dirnames.input, 'facc_sca.tiff')
         self.fnames.stream_mask         = os.path.join(self.dirnames.input, 'stream_mask.tiff')
+        self.fnames.stream_mask_sweep   = os.path.join(self.dirnames.input, 'stream_mask_sweep.tiff')
         self.fnames.slope               = os.path.join(self.dirnames.input, 'slope.tiff')
         self.fnames.nhdp                = os.path.join(self.dirnames.input, 'nhdp_flowlines.gpkg')
+        self.fnames.manifest            = os.path.join(self.dirnames.project, 'manifest.json')
+        self.fnames.run_report          = os.path.join(self.dirnames.output, 'run_report.json')
 
     def read_inputyaml(self,fname:str):
         self.fnames.namlistyaml = fname
@@ -161,6 +193,54 @@ class Namelist:
                 sys.exit(f'ERROR invalid entry for {name_var} of {userinput[name_var]} in {fname_yaml_input}')
         #
         #
+        name_var = 'breach_mode'
+        if name_var in userinput:
+            if str(userinput[name_var]).lower() not in ['auto','single','tiled']:
+                sys.exit(f'ERROR invalid entry for {name_var} of {userinput[name_var]} in {fname_yaml_input} - must be auto, single or tiled')
+            self.options.breach_mode = str(userinput[name_var]).lower()
+        #
+        #
+        name_var = 'breach_tile_size'
+        if name_var in userinput:
+            try:
+                self.options.breach_tile_size = int(userinput[name_var])
+            except ValueError:
+                sys.exit(f'ERROR invalid entry for {name_var} of {userinput[name_var]} in {fname_yaml_input}')
+        #
+        #
+        name_var = 'breach_tile_overlap'
+        if name_var in userinput:
+            try:
+                self.options.breach_tile_overlap = int(userinput[name_var])
+            except ValueError:
+                sys.exit(f'ERROR invalid entry for {name_var} of {userinput[name_var]} in {fname_yaml_input}')
+        #
+        #
+        name_var = 'flow_acc_engine'
+        if name_var in userinput:
+            if str(userinput[name_var]).lower() not in ['twtflow','whitebox']:
+                sys.exit(f'ERROR invalid entry for {name_var} of {userinput[name_var]} in {fname_yaml_input} - must be twtflow or whitebox')
+            self.options.flow_acc_engine = str(userinput[name_var]).lower()
+        #
+        #
+        name_var = 'flow_acc_method'
+        if name_var in userinput:
+            if str(userinput[name_var]).lower() not in ['dinf','d8']:
+                sys.exit(f'ERROR invalid entry for {name_var} of {userinput[name_var]} in {fname_yaml_input} - must be dinf or d8')
+            self.options.flow_acc_method = str(userinput[name_var]).lower()
+        #
+        #
+        name_var = 'facc_strm_thresholds_ncells'
+        if name_var in userinput:
+            values = userinput[name_var]
+            if isinstance(values, str): values = values.split(',')
+            try:
+                values = [int(v) for v in values]
+            except (TypeError, ValueError):
+                sys.exit(f'ERROR invalid entry for {name_var} of {userinput[name_var]} in {fname_yaml_input} - must be a list of integers')
+            self.options.facc_strm_thresholds_ncells = sorted(set(values + [self.options.facc_strm_thresh_ncells]))
+        #
+        #
         name_var = 'facc_strm_threshold_sca'
         if name_var in userinput:
             try:
@@ -260,6 +340,127 @@ class Namelist:
             self.options.usedask = True
         #
         #
+        name_var = 'fuse_inundation_summary'
+        if name_var in userinput and str(userinput[name_var]).upper().find('TRUE') != -1:
+            self.options.fuse_inundation_summary = True
+        #
+        #
+        name_var = 'write_slope'
+        if name_var in userinput and str(userinput[name_var]).upper().find('TRUE') != -1:
+            self.options.write_slope = True
+        #
+        #
+        name_var = 'write_daily_inundation'
+        if name_var in userinput and str(userinput[name_var]).upper().find('FALSE') != -1:
+            self.options.write_daily_inundation = False
+        #
+        #
+        name_var = 'windowed_inundation'
+        if name_var in userinput and str(userinput[name_var]).upper().find('TRUE') != -1:
+            self.options.windowed_inundation = True
+        #
+        #
+        name_var = 'wtd_resample_plan'
+        if name_var in userinput and str(userinput[name_var]).upper().find('FALSE') != -1:
+            self.options.wtd_resample_plan = False
+        #
+        #
+        name_var = 'inundation_workers'
+        if name_var in userinput:
+            try:
+                self.options.inundation_workers = int(userinput[name_var])
+            except ValueError:
+                sys.exit(f'ERROR invalid entry for {name_var} of {userinput[name_var]} in {fname_yaml_input}')
+        #
+        #
+        name_var = 'inundation_format'
+        if name_var in userinput:
+            self.options.inundation_format = str(userinput[name_var]).lower()
+            if self.options.inundation_format not in ['tiff','cube']:
+                sys.exit(f'ERROR invalid entry for {name_var} of {userinput[name_var]} in {fname_yaml_input} - must be tiff or cube')
+        #
+        #
+        name_var = 'wtd_format'
+        if name_var in userinput:
+            self.options.wtd_format = str(userinput[name_var]).lower()
+            if self.options.wtd_format not in ['tiff','netcdf']:
+                sys.exit(f'ERROR invalid entry for {name_var} of {userinput[name_var]} in {fname_yaml_input} - must be tiff or netcdf')
+        #
+        #
+        name_var = 'soil_cache'
+        if name_var in userinput:
+            try:
+                self.options.soil_cache = os.path.abspath(str(userinput[name_var]))
+            except ValueError:
+                sys.exit(f'ERROR invalid {name_var} {userinput[name_var]} in {fname_yaml_input}')
+        #
+        #
+        name_var = 'soil_store'
+        if name_var in userinput:
+            try:
+                self.options.soil_store = os.path.abspath(str(userinput[name_var]))
+            except ValueError:
+                sys.exit(f'ERROR invalid {name_var} {userinput[name_var]} in {fname_yaml_input}')
+        #
+        #
+        name_var = 'stage_cpus'
+        if name_var in userinput:
+            try:
+                self.options.stage_cpus = int(userinput[name_var])
+            except ValueError:
+                sys.exit(f'ERROR invalid entry for {name_var} of {userinput[name_var]} in {fname_yaml_input}')
+        #
+        #
+        name_var = 'stage_manifest'
+        if name_var in userinput and str(userinput[name_var]).upper().find('FALSE') != -1:
+            self.options.stage_manifest = False
+        #
+        #
+        name_var = 'data_provider'
+        if name_var in userinput:
+            modes = userinput[name_var] if isinstance(userinput[name_var], dict) else {'all': userinput[name_var]}
+            for kind, mode in modes.items():
+                if str(mode).lower() not in ['remote','local','cache'] or kind not in ['all','wtd','dem','soil','huc','flowlines']:
+                    sys.exit(f'ERROR invalid entry for {name_var} of {userinput[name_var]} in {fname_yaml_input} - must be remote, local or cache (for all or per wtd, dem, soil, huc, flowlines)')
+            if isinstance(userinput[name_var], dict):
+                self.options.data_provider = {kind: str(mode).lower() for kind, mode in modes.items()}
+            else:
+                self.options.data_provider = str(userinput[name_var]).lower()
+        #
+        #
+        name_var = 'data_mirror'
+        if name_var in userinput:
+            self.options.data_mirror = os.path.abspath(str(userinput[name_var]))
+            if not os.path.isdir(self.options.data_mirror):
+                sys.exit(f'ERROR specified {name_var} directory {self.options.data_mirror} does not exist {fname_yaml_input}')
+        #
+        #
+        name_var = 'data_cache'
+        if name_var in userinput:
+            self.options.data_cache = os.path.abspath(str(userinput[name_var]))
+        #
+        #
+        name_var = 'data_cache_max_gb'
+        if name_var in userinput:
+            try:
+                self.options.data_cache_max_gb = float(userinput[name_var])
+            except ValueError:
+                sys.exit(f'ERROR invalid entry for {name_var} of {userinput[name_var]} in {fname_yaml_input}')
+        #
+        #
+        name_var = 'dem_tile_cache'
+        if name_var in userinput:
+            self.options.dem_tile_cache = os.path.abspath(str(userinput[name_var]))
+        #
+        #
+        name_var = 'dem_tile_size_m'
+        if name_var in userinput:
+            try:
+                self.options.dem_tile_size_m = float(userinput[name_var])
+            except ValueError:
+                sys.exit(f'ERROR invalid entry for {name_var} of {userinput[name_var]} in {fname_yaml_input}')
+        #
+        #
         name_var = 'dem'
         if name_var in userinput:
             try:
@@ -0,0 +1,476 @@
+"""
+Data providers - one interface per dataset type with a remote backend (the
+web service), a local mirror backend (files in {mirror}/{kind}) and a
+read-through cache backend (any provider plus an on-disk cache with least
+recently used eviction). The modules take a provider argument and default
+to the remote backend.
+
+  wtd       get_gridded_data(options), get_gridded_files(options, variables, filename_template), login(un, pin)
+  dem       resolutions(bbox, crs), get_dem(geometry, resolution, crs)
+  soil      fetch_mupolygons(bbox), fetch_components(mukeys), fetch_horizons(cokeys) (async, see twtsoils)
+  huc       byids(level, ids), bygeom(level, geom), wb_full(level)
+  flowlines bygeom(bbox, crs)
+
+Local mirror layout:
+
+  {mirror}/wtd/conus1_baseline_mod_water_table_depth_YYYYMMDD.tiff   (e.g. from twtwt.get_conus1_tiffs)
+  {mirror}/dem/*.tif[f]|*.vrt                                        (tiles in one crs)
+  {mirror}/soil/mupolygon.gpkg, component.csv, chorizon.csv          (twtsoils.LocalSoilBackend)
+  {mirror}/huc/<file>                                                (national WBD, layers WBDHU2 ... WBDHU12)
+  {mirror}/flowlines/<file>                                          (NHDPlus HR flowlines)
+"""
+
+import os
+import glob
+import time
+import pickle
+import shutil
+import sqlite3
+import hashlib
+import inspect
+import datetime
+import contextlib
+import numpy
+import rasterio
+import rasterio.merge
+import rasterio.windows
+import geopandas
+import shapely
+
+KINDS = ['wtd', 'dem', 'soil', 'huc', 'flowlines']
+MODES = ['remote', 'local', 'cache']
+
+def get_providers(**kwargs):
+    """
+    Provider of each dataset kind. mode is 'remote', 'local' or 'cache', or
+    a dict of kind -> mode (kinds not in it use its 'all' entry, else
+    remote). 'local' reads the mirror directory, 'cache' puts a cache of
+    cache_max_gb in cache_dir in front of the remote backend (in front of
+    the mirror with mirror set). With dem_tiles the dem provider is wrapped
+    in a TiledDEMCache of dem_tile_m tiles in that directory.
+    """
+    mode         = kwargs.get('mode',         'remote')
+    mirror       = kwargs.get('mirror',       None)
+    cache_dir    = kwargs.get('cache_dir',    None)
+    cache_max_gb = kwargs.get('cache_max_gb', 20.)
+    dem_tiles    = kwargs.get('dem_tiles',    None)
+    dem_tile_m   = kwargs.get('dem_tile_m',   10000.)
+    modes = mode if isinstance(mode, dict) else {kind: mode for kind in KINDS}
+    providers = dict()
+    for kind in KINDS:
+        kind_mode = modes.get(kind, modes.get('all', 'remote'))
+        if kind_mode not in MODES:
+            raise ValueError(f'get_providers invalid mode {kind_mode} for {kind}, must be one of {MODES}')
+        if kind_mode == 'local' and mirror is None:
+            raise ValueError(f'get_providers mode local for {kind} requires a mirror directory')
+        if kind_mode == 'cache' and cache_dir is None:
+            raise ValueError(f'get_providers mode cache for {kind} requires a cache directory')
+        if kind_mode == 'remote' or (kind_mode == 'cache' and mirror is None):
+            provider = remote_provider(kind)
+        else:
+            provider = local_provider(kind, os.path.join(mirror, kind))
+        if kind_mode == 'cache':
+            provider = CachedProvider(provider, os.path.join(cache_dir, kind), max_bytes=cache_max_gb * 2**30)
+        if kind == 'dem' and dem_tiles is not None:
+            provider = TiledDEMCache(provider, dem_tiles, tile_size=dem_tile_m)
+        providers[kind] = provider
+    return providers
+
+def remote_provider(kind):
+    if kind == 'wtd':       return HFHydrodataWTD()
+    if kind == 'dem':       return Py3depDEM()
+    if kind == 'huc':       return WBDHUC()
+    if kind == 'flowlines': return NHDPlusHRFlowlines()
+    if kind == 'soil':
+        import twtsoils
+        return twtsoils.SoildbBackend()
+    raise ValueError(f'remote_provider unknown dataset kind {kind}')
+
+def local_provider(kind, path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'local_provider could not find mirror {path} for {kind}')
+    if kind == 'wtd':       return LocalWTD(path)
+    if kind == 'dem':       return LocalDEM(path)
+    if kind == 'huc':       return LocalHUC(path)
+    if kind == 'flowlines': return LocalFlowlines(path)
+    if kind == 'soil':
+        import twtsoils
+        return twtsoils.LocalSoilBackend(mupolygons = os.path.join(path, 'mupolygon.gpkg'),
+                                         components = os.path.join(path, 'component.csv'),
+                                         chorizons  = os.path.join(path, 'chorizon.csv'))
+    raise ValueError(f'local_provider unknown dataset kind {kind}')
+
+class HFHydrodataWTD:
+    """ParFlow CONUS1 water table depth from the HydroFrame service (hf_hydrodata)"""
+
+    def login(self, un, pin):
+        import hf_hydrodata
+        hf_hydrodata.register_api_pin(un, pin)
+
+    def get_gridded_data(self, options):
+        import hf_hydrodata
+        return hf_hydrodata.get_gridded_data(options)
+
+    def get_gridded_files(self, options, variables, filename_template, verbose=False):
+        import hf_hydrodata
+        hf_hydrodata.get_gridded_files(options, variables=variables, filename_template=filename_template, verbose=verbose)
+
+class LocalWTD:
+    """
+    ParFlow CONUS1 daily water table depth served from a directory of the
+    national daily tiffs (conus1_baseline_mod_water_table_depth_YYYYMMDD.tiff,
+    rows south to north as hf_hydrodata returns them). Supports grid_bounds
+    subsets of daily data and daily ({ymd}) file templates.
+    """
+
+    prefix = 'conus1_baseline_mod_water_table_depth_'
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def login(self, un, pin):
+        pass
+
+    def _days(self, options):
+        if options.get('temporal_resolution', 'daily') != 'daily':
+            raise NotImplementedError(f'LocalWTD only serves daily data')
+        dt_start = datetime.datetime.strptime(options['start_time'], '%Y-%m-%d')
+        dt_end   = datetime.datetime.strptime(options['end_time'],   '%Y-%m-%d') # exclusive, as hf_hydrodata
+        return [dt_start + datetime.timedelta(days=i) for i in range(max(1, (dt_end - dt_start).days))]
+
+    def _fname(self, idt):
+        fname = os.path.join(self.dirname, f'{self.prefix}{idt.strftime("%Y%m%d")}.tiff')
+        if not os.path.isfile(fname):
+            raise FileNotFoundError(f'LocalWTD could not find {fname}')
+        return fname
+
+    def get_gridded_data(self, options):
+        if 'grid_bounds' not in options:
+            raise NotImplementedError(f'LocalWTD requires grid_bounds')
+        x0, y0, x1, y1 = options['grid_bounds']
+        window = rasterio.windows.Window(x0, y0, x1 - x0, y1 - y0)
+        days = self._days(options)
+        data = None
+        for i, idt in enumerate(days):
+            with rasterio.open(self._fname(idt)) as src:
+                arr = src.read(1, window=window, boundless=True, fill_value=numpy.nan)
+            if data is None:
+                data = numpy.empty((len(days),) + arr.shape, dtype=arr.dtype)
+            data[i] = arr
+        return data
+
+    def get_gridded_files(self, options, variables, filename_template, verbose=False):
+        if '{ymd}' not in filename_template:
+            raise NotImplementedError(f'LocalWTD only writes daily files ({{ymd}} templates)')
+        for idt in self._days(options):
+            fname = filename_template.format(dataset   = options.get('dataset', 'conus1_baseline_mod'),
+                                             variable  = variables[0],
+                                             ymd       = idt.strftime('%Y%m%d'))
+            if verbose: print(f' copying {self._fname(idt)} to {fname}')
+            shutil.copyfile(self._fname(idt), fname)
+
+class Py3depDEM:
+    """USGS 3DEP elevation through py3dep"""
+
+    def resolutions(self, bbox, crs):
+        import py3dep
+        avail = py3dep.check_3dep_availability(bbox=tuple(bbox), crs=crs)
+        vals  = list()
+        for k in avail.keys():
+            try: vals.append(int(k.replace('m','')))
+            except: pass
+        return sorted(vals)
+
+    def get_dem(self, geometry, resolution, crs):
+        import py3dep
+        return py3dep.get_dem(geometry=geometry, resolution=resolution, crs=crs)
+
+class LocalDEM:
+    """
+    Elevation served from local DEM rasters (a file, a directory or a list
+    of tiff/vrt tiles in one crs). get_dem mosaics the tiles over the geometry
+    bounds, clips to the geometry and reprojects to crs when it differs
+    from the tiles.
+    """
+
+    def __init__(self, path):
+        self.fnames = list(path) if isinstance(path, (list, tuple)) else _raster_files(path)
+        if len(self.fnames) == 0:
+            raise FileNotFoundError(f'LocalDEM could not find rasters in {path}')
+        with rasterio.open(self.fnames[0]) as src:
+            self.crs = src.crs
+            self.res = src.res
+
+    def resolutions(self, bbox, crs):
+        return [int(round(self.res[0]))]
+
+    def get_dem(self, geometry, resolution, crs):
+        import rioxarray
+        geom = geopandas.GeoSeries([geometry], crs=crs).to_crs(self.crs)
+        bounds = tuple(geom.total_bounds)
+        mosaic, transform = rasterio.merge.merge(self.fnames, bounds=bounds)
+        with rasterio.open(self.fnames[0]) as src:
+            profile = src.profile.copy()
+        profile.update(driver='GTiff', height=mosaic.shape[1], width=mosaic.shape[2], count=1, transform=transform)
+        for k in ('blockxsize', 'blockysize', 'tiled', 'compress', 'photometric', 'interleave'):
+            profile.pop(k, None)
+        with rasterio.io.MemoryFile() as memfile:
+            with memfile.open(**profile) as dst:
+                dst.write(mosaic[:1])
+            dem = rioxarray.open_rasterio(memfile.name, masked=True).squeeze('band', drop=True).load()
+        dem = dem.rio.clip(geom.values, geom.crs, all_touched=True)
+        crs = rasterio.crs.CRS.from_user_input(crs)
+        if crs != self.crs:
+            # resolution is in meters (as py3dep), so it only applies to a projected crs
+            dem = dem.rio.reproject(crs, resolution=resolution if crs.is_projected else None)
+        return dem
+
+class TiledDEMCache:
+    """
+    DEM provider that fetches from another DEM provider (e.g. Py3depDEM) in
+    tiles of a fixed grid - tile_size x tile_size squares of tile_crs
+    (default 10 km in EPSG:5070) - and keeps them in
+    cache_dir/{resolution}m/dem_{col}_{row}.tiff. A request is assembled
+    from the tiles its geometry touches (a windowed mosaic, see LocalDEM),
+    fetching only the tiles not cached yet, so neighbouring and overlapping
+    domains share their downloads. Tiles are resampled onto the tile grid
+    and written atomically; processes sharing cache_dir may at worst fetch
+    the same missing tile twice.
+    """
+
+    def __init__(self, provider, cache_dir, tile_size=10000., tile_crs='EPSG:5070', verbose=False):
+        self.provider  = provider
+        self.cache_dir = cache_dir
+        self.tile_size = float(tile_size)
+        self.tile_crs  = tile_crs
+        self.verbose   = verbose
+
+    def resolutions(self, bbox, crs):
+        return self.provider.resolutions(bbox, crs)
+
+    def tiles(self, geometry, crs):
+        """(col, row) of the tiles a geometry in crs touches"""
+        geom = geopandas.GeoSeries([geometry], crs=crs).to_crs(self.tile_crs).iloc[0]
+        minx, miny, maxx, maxy = geom.bounds
+        cols = range(int(numpy.floor(minx / self.tile_size)), int(numpy.floor(maxx / self.tile_size)) + 1)
+        rows = range(int(numpy.floor(miny / self.tile_size)), int(numpy.floor(maxy / self.tile_size)) + 1)
+        return [(col, row) for row in rows for col in cols if geom.intersects(self.tile_box(col, row))]
+
+    def tile_box(self, col, row):
+        return shapely.geometry.box(col * self.tile_size, row * self.tile_size,
+                                    (col + 1) * self.tile_size, (row + 1) * self.tile_size)
+
+    def tile_fname(self, col, row, resolution):
+        return os.path.join(self.cache_dir, f'{resolution:g}m', f'dem_{col}_{row}.tiff')
+
+    def get_dem(self, geometry, resolution, crs):
+        tiles  = self.tiles(geometry, crs)
+        fnames = [self.tile_fname(col, row, resolution) for col, row in tiles]
+        for (col, row), fname in zip(tiles, fnames):
+            if not os.path.isfile(fname):
+                self._fetch_tile(col, row, resolution, fname)
+        return LocalDEM(fnames).get_dem(geometry, resolution, crs)
+
+    def _fetch_tile(self, col, row, resolution, fname):
+        from rasterio.enums import Resampling
+        if self.verbose: print(f' fetching dem tile {col} {row} at {resolution:g} m')
+        # a couple of cells of margin so the resampling onto the tile grid has data at the edges
+        box = self.tile_box(col, row).buffer(2 * resolution, join_style='mitre')
+        dem = self.provider.get_dem(geometry=box, resolution=resolution, crs=self.tile_crs)
+        n = int(round(self.tile_size / resolution))
+        transform = rasterio.transform.from_origin(col * self.tile_size, (row + 1) * self.tile_size, resolution, resolution)
+        dem = dem.astype('float32').rio.write_nodata(numpy.nan, encoded=False)
+        dem = dem.rio.reproject(self.tile_crs, shape=(n, n), transform=transform, resampling=Resampling.bilinear)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        fname_part = f'{fname}.{os.getpid()}.part'
+        dem.rio.to_raster(fname_part, driver='GTiff', compress='deflate', tiled=True)
+        os.replace(fname_part, fname)
+
+class WBDHUC:
+    """Watershed Boundary Dataset hydrologic units through pygeohydro"""
+
+    def byids(self, level, ids):
+        import pygeohydro
+        colnam = f'huc{level}'
+        return pygeohydro.WBD(colnam).byids(colnam, ids, return_geom=True)
+
+    def bygeom(self, level, geom):
+        import pygeohydro
+        return pygeohydro.WBD(f'huc{level}').bygeom(geom)
+
+    def wb_full(self, level):
+        import pygeohydro
+        return pygeohydro.watershed.huc_wb_full(level)
+
+class LocalHUC:
+    """Hydrologic units served from a national WBD file (gpkg/gdb with layers WBDHU2 ... WBDHU12)"""
+
+    def __init__(self, path):
+        self.fname = path if path.endswith('.gdb') else _single_file(path)
+
+    def byids(self, level, ids):
+        ids = [ids] if isinstance(ids, str) else list(ids)
+        where = f"huc{level} IN ({','.join(repr(str(i)) for i in ids)})"
+        return geopandas.read_file(self.fname, layer=f'WBDHU{level}', where=where)
+
+    def bygeom(self, level, geom):
+        mask  = geopandas.GeoSeries([geom], crs='EPSG:4326')
+        hucs  = geopandas.read_file(self.fname, layer=f'WBDHU{level}', mask=mask)
+        return hucs.loc[hucs.intersects(mask.to_crs(hucs.crs).iloc[0])].reset_index(drop=True)
+
+    def wb_full(self, level):
+        return geopandas.read_file(self.fname, layer=f'WBDHU{level}')
+
+class NHDPlusHRFlowlines:
+    """NHDPlus HR flowlines through pynhd"""
+
+    def bygeom(self, bbox, crs):
+        import pynhd
+        return pynhd.NHDPlusHR("flowline").bygeom(geom=tuple(bbox), geo_crs=crs)
+
+class LocalFlowlines:
+    """Flowlines served from a local vector file (e.g. an NHDPlus HR flowline extract)"""
+
+    def __init__(self, path):
+        self.fname = _single_file(path)
+
+    def bygeom(self, bbox, crs):
+        box = geopandas.GeoSeries([shapely.geometry.box(*bbox)], crs=crs)
+        return geopandas.read_file(self.fname, bbox=box)
+
+class CachedProvider:
+    """
+    Read-through cache in front of a provider. The results of its query
+    methods are pickled into cache_dir under a hash of the provider, method
+    and arguments, so repeated runs and overlapping subdomains asking the
+    same question do not go back to the service. An SQLite index records
+    the size and last use of each entry; the least recently used entries
+    are evicted when the cache grows past max_bytes. Methods that write
+    files themselves (e.g. get_gridded_files) are passed through. Every call
+    opens its own connection, so one cache can be shared by concurrent
+    processes.
+    """
+
+    cached = {'get_gridded_data', 'resolutions', 'get_dem', 'byids', 'bygeom', 'wb_full',
+              'fetch_mupolygons', 'fetch_components', 'fetch_horizons'}
+
+    def __init__(self, provider, cache_dir, max_bytes=20 * 2**30, timeout=120.):
+        self.provider  = provider
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.timeout   = timeout
+        self.n_hits    = 0
+        self.n_misses  = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._connect() as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute("""CREATE TABLE IF NOT EXISTS entries (
+                               key       TEXT PRIMARY KEY,
+                               size      INTEGER,
+                               last_used REAL)""")
+
+    def __getattr__(self, name):
+        if name.startswith('_') or 'provider' not in self.__dict__:
+            raise AttributeError(name)
+        if name not in CachedProvider.cached:
+            return getattr(self.provider, name)
+        func = getattr(self.provider, name)
+        if inspect.iscoroutinefunction(func):
+            async def cached_call(*args, **kwargs):
+                key = self._key(name, args, kwargs)
+                found, value = self.get(key)
+                if not found:
+                    value = await func(*args, **kwargs)
+                    self.put(key, value)
+                return value
+        else:
+            def cached_call(*args, **kwargs):
+                key = self._key(name, args, kwargs)
+                found, value = self.get(key)
+                if not found:
+                    value = func(*args, **kwargs)
+                    self.put(key, value)
+                return value
+        return cached_call
+
+    def _connect(self):
+        return contextlib.closing(sqlite3.connect(os.path.join(self.cache_dir, 'index.sqlite'),
+                                                  timeout=self.timeout, isolation_level=None))
+
+    def _key(self, name, args, kwargs):
+        blob = repr((type(self.provider).__name__, _identity(self.provider), name,
+                     [_key_part(a) for a in args], sorted((k, _key_part(v)) for k, v in kwargs.items())))
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def _fname(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.pkl')
+
+    def get(self, key):
+        """(True, value) of a cached entry, (False, None) if it is not cached"""
+        fname = self._fname(key)
+        try:
+            with open(fname, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.n_misses += 1
+            return False, None
+        with self._connect() as con:
+            con.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+        self.n_hits += 1
+        return True, value
+
+    def put(self, key, value):
+        fname = self._fname(key)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        fname_tmp = f'{fname}.{os.getpid()}.tmp'
+        with open(fname_tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fname_tmp, fname)
+        with self._connect() as con:
+            con.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?)', (key, os.path.getsize(fname), time.time()))
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache is at most max_bytes"""
+        with self._connect() as con:
+            total = con.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total <= self.max_bytes: return
+            for key, size in con.execute('SELECT key, size FROM entries ORDER BY last_used').fetchall():
+                if total <= self.max_bytes: break
+                if key == keep: continue
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._fname(key))
+                con.execute('DELETE FROM entries WHERE key = ?', (key,))
+                total -= size
+
+def _identity(provider):
+    """What distinguishes two providers of the same class (e.g. their mirror path)"""
+    return {k: _key_part(v) for k, v in sorted(vars(provider).items()) if isinstance(v, (str, int, float, tuple, list))}
+
+def _key_part(obj):
+    if isinstance(obj, shapely.geometry.base.BaseGeometry):
+        return obj.wkb_hex
+    if isinstance(obj, dict):
+        return sorted((str(k), _key_part(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, numpy.ndarray)):
+        return [_key_part(v) for v in obj]
+    if isinstance(obj, numpy.generic):
+        return obj.item()
+    if hasattr(obj, 'to_wkt'):
+        return obj.to_wkt()
+    return obj if isinstance(obj, (str, int, float, bool)) or obj is None else repr(obj)
+
+def _raster_files(path):
+    if os.path.isfile(path): return [path]
+    return sorted(f for ext in ('*.tif', '*.tiff', '*.vrt') for f in glob.glob(os.path.join(path, ext)))
+
+def _single_file(path, names=None):
+    """path itself, or the file named one of names (or the only file) in directory path"""
+    if os.path.isfile(path): return path
+    for name in names or ():
+        if os.path.exists(os.path.join(path, name)):
+            return os.path.join(path, name)
+    fnames = [f for f in sorted(os.listdir(path)) if not f.startswith('.')]
+    if len(fnames) != 1:
+        raise FileNotFoundError(f'expected one data file in {path}, found {len(fnames)}')
+    return os.path.join(path, fnames[0])
@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+import contextlib
+import pandas as pd
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+FIELDS = ['domain', 'stage', 'day', 'start', 'wall_s', 'cpu_s', 'peak_rss_mb', 'read_mb', 'write_mb', 'status']
+
+class RunReport:
+    """
+    Wall time, cpu time, peak resident memory and bytes read/written of the
+    stages of a run (and of the days inside calculate_inundation), written
+    as a json and csv report.
+
+    cpu time includes finished child processes (e.g. whitebox tools), and
+    cpu time and i/o are counted for the whole process, so stages that run
+    concurrently (stage_cpus > 1) are charged for each other's work. Peak
+    memory is sampled while the stage runs; it includes child processes
+    only when psutil is installed.
+    """
+
+    def __init__(self, domain=None):
+        self.domain  = domain
+        self.records = list()
+        self._lock   = threading.Lock()
+
+    @contextlib.contextmanager
+    def measure(self, stage, day=None):
+        record = {'domain' : self.domain,
+                  'stage'  : stage,
+                  'day'    : day,
+                  'start'  : datetime.datetime.now().isoformat(timespec='seconds'),
+                  'status' : 'ok'}
+        sampler = _PeakRSS()
+        cpu0, io0, t0 = _cpu_seconds(), _io_bytes(), time.perf_counter()
+        sampler.start()
+        try:
+            yield record
+        except BaseException:
+            record['status'] = 'error'
+            raise
+        finally:
+            record['wall_s'] = time.perf_counter() - t0
+            record['cpu_s']  = _cpu_seconds() - cpu0
+            record['peak_rss_mb'] = sampler.stop() / 2**20
+            io1 = _io_bytes()
+            if io0 is not None and io1 is not None:
+                record['read_mb']  = (io1[0] - io0[0]) / 2**20
+                record['write_mb'] = (io1[1] - io0[1]) / 2**20
+            self.add([record])
+
+    def add(self, records):
+        with self._lock:
+            for record in records:
+                record = dict(record)
+                if record.get('domain') is None:
+                    record['domain'] = self.domain
+                self.records.append(record)
+
+    def to_frame(self):
+        return pd.DataFrame(self.records, columns=FIELDS)
+
+    def write(self, fname_json, fname_csv=None):
+        """Write the report as json (and csv if fname_csv)"""
+        os.makedirs(os.path.dirname(os.path.abspath(fname_json)), exist_ok=True)
+        with open(fname_json, 'w') as f:
+            json.dump({'domain'  : self.domain,
+                       'python'  : sys.version.split()[0],
+                       'cpus'    : os.cpu_count(),
+                       'records' : self.records}, f, indent=1)
+        if fname_csv is not None:
+            self.to_frame().to_csv(fname_csv, index=False)
+
+    @classmethod
+    def read(cls, fname_json):
+        with open(fname_json, 'r') as f:
+            data = json.load(f)
+        report = cls(domain=data.get('domain'))
+        report.add(data.get('records', list()))
+        return report
+
+def measure(report, stage, day=None):
+    """report.measure(stage, day), or a no-op context when report is None"""
+    if report is None:
+        return contextlib.nullcontext(None)
+    return report.measure(stage, day=day)
+
+def merge_reports(fnames_json, fname_csv=None, verbose=False):
+    """
+    Concatenate the records of several run reports (e.g. all subdomains of
+    a runpp.py run) into one DataFrame, optionally written to fname_csv.
+    Returns (records, summary) where summary has per-stage totals, means
+    and maxima across domains (the per-day rows are summarized as one stage).
+    """
+    frames = list()
+    for fname in fnames_json:
+        if not os.path.isfile(fname):
+            print(f'WARNING merge_reports could not find {fname}')
+            continue
+        frames.append(RunReport.read(fname).to_frame())
+    records = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=FIELDS)
+    numeric = ['wall_s', 'cpu_s', 'peak_rss_mb', 'read_mb', 'write_mb']
+    records[numeric] = records[numeric].apply(pd.to_numeric, errors='coerce')
+    grouped = records.groupby('stage', sort=False)
+    summary = pd.concat([grouped[['wall_s', 'cpu_s', 'read_mb', 'write_mb']].sum().add_suffix('_total'),
+                         grouped[['wall_s', 'cpu_s']].mean().add_suffix('_mean'),
+                         grouped[['wall_s', 'peak_rss_mb']].max().add_suffix('_max'),
+                         grouped['domain'].nunique().rename('n_domains'),
+                         grouped['status'].apply(lambda s: int((s != 'ok').sum())).rename('n_errors')], axis=1)
+    summary = summary.sort_values('wall_s_total', ascending=False)
+    if fname_csv is not None:
+        records.to_csv(fname_csv, index=False)
+        summary.to_csv(os.path.splitext(fname_csv)[0] + '_summary.csv')
+    if verbose:
+        print(summary.to_string(float_format=lambda v: f'{v:.1f}'))
+    return records, summary
+
+def _cpu_seconds():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+def _io_bytes():
+    """(read, written) bytes of this process, None if the platform does not say"""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            io = dict(line.split(':') for line in f.read().splitlines() if ':' in line)
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        pass
+    if psutil is not None:
+        try:
+            io = psutil.Process().io_counters()
+            return io.read_bytes, io.write_bytes
+        except (AttributeError, psutil.Error):
+            pass
+    return None
+
+def _rss_bytes():
+    """Current resident memory of this process (and its children with psutil)"""
+    if psutil is not None:
+        try:
+            proc = psutil.Process()
+            rss = proc.memory_info().rss
+            for child in proc.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            return rss
+        except psutil.Error:
+            pass
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+class _PeakRSS(threading.Thread):
+    """Background thread sampling the resident memory until stop() returns its peak"""
+
+    def __init__(self, interval=0.1):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak     = _rss_bytes()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, _rss_bytes())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, _rss_bytes())
+        return self.peak
@@ -1,94 +1,433 @@
-import os,numpy,geopandas,soiltexture,soildb,rioxarray,sys,subprocess,sqlite3,pyogrio
+import os,numpy,pandas,geopandas,soiltexture,soildb,rioxarray,sys,subprocess,sqlite3,pyogrio,tempfile,rasterio,shapely,contextlib
+import rasterio.features
 from geocube.api.core import make_geocube
 #from urllib import response
 
+TRANSMISSIVITY_F = {'clay heavy'    :3.2,
+                    'silty clay'     :3.1,
+                    'clay'           :2.8,
+                    'silty clay loam':2.9,
+                    'clay loam'      :2.7,
+                    'silt'           :3.4,
+                    'silt loam'      :2.6,
+                    'sandy clay'     :2.5,
+                    'loam'           :2.5,
+                    'sandy clay loam':2.4,
+                    'sandy loam'     :2.3,
+                    'loamy sand'     :2.2,
+                    'sand'           :2.1,
+                    'organic'        :2.5}
+
+NODATA_CODE = numpy.iinfo(numpy.uint16).max # transmissivity category code of cells with no polygon and no dem
+
 def break_soil_texture(**kwargs):
     fname_texture_parent = kwargs.get('fname_texture_parent', None)
     fname_texture_child = kwargs.get('fname_texture_child',   None)
     fname_domain        = kwargs.get('fname_domain',        None)
+    dir_soil_store      = kwargs.get('dir_soil_store',      None)
     verbose       = kwargs.get('verbose',       False)
     overwrite     = kwargs.get('overwrite',     False)
     if verbose: print('calling break_soil_texture')
     if not os.path.isfile(fname_texture_child) or overwrite:
-        crs = pyogrio.read_info(fname_texture_parent)['crs']
-        domain = geopandas.read_file(fname_domain).to_crs(crs)
-        soil_texture = geopandas.read_file(fname_texture_parent, 
-                                           bbox=tuple(domain.geometry.total_bounds), 
-                                           engine="pyogrio")
+        if dir_soil_store is not None and os.path.isfile(os.path.join(dir_soil_store,'index.parquet')):
+            if verbose: print(f' reading soil texture from partitioned store {dir_soil_store}')
+            domain = geopandas.read_file(fname_domain)
+            soil_texture = read_soil_store(dir_soil_store, domain)
+            domain = domain.to_crs(soil_texture.crs)
+        else:
+            crs = pyogrio.read_info(fname_texture_parent)['crs']
+            domain = geopandas.read_file(fname_domain).to_crs(crs)
+            soil_texture = geopandas.read_file(fname_texture_parent, 
+                                               bbox=tuple(domain.geometry.total_bounds), 
+                                               engine="pyogrio")
         soil_texture = geopandas.clip(gdf=soil_texture,mask=domain)
         soil_texture.to_file(fname_texture_child, driver="GPKG")
     else:
         if verbose: print(f' found existing soil texture file {fname_texture_child}')
 
+def prepare_soil_store(**kwargs):
+    """
+    One-time split of a national soil texture layer (e.g. SSURGO GeoPackage)
+    into a GeoParquet store partitioned by subdomain, so that
+    break_soil_texture only reads the partitions that intersect its domain.
+
+    partitions is a list of (partition id, domain file) tuples. The parent is
+    read once in chunks of chunk_size features; every feature is appended to
+    each partition it intersects ({dir_store}/{partition id}/part_*.parquet,
+    with per-row bbox covering columns). index.parquet holds the partition
+    polygons with feature counts and the bbox of their features, and is
+    written last - a store without it is incomplete.
+    """
+    fname_texture_parent = kwargs.get('fname_texture_parent', None)
+    dir_store            = kwargs.get('dir_store',            None)
+    partitions           = kwargs.get('partitions',           None)
+    chunk_size           = kwargs.get('chunk_size',           100000)
+    verbose              = kwargs.get('verbose',              False)
+    overwrite            = kwargs.get('overwrite',            False)
+    if verbose: print('calling prepare_soil_store')
+    fname_index = os.path.join(dir_store,'index.parquet')
+    if os.path.isfile(fname_index) and not overwrite:
+        if verbose: print(f' found existing soil store {dir_store}')
+        return fname_index
+    info = pyogrio.read_info(fname_texture_parent)
+    index = pandas.concat([geopandas.read_file(fname).to_crs(info['crs']).dissolve().assign(partition=str(pid))[['partition','geometry']]
+                           for pid, fname in partitions], ignore_index=True)
+    index = geopandas.GeoDataFrame(index, geometry='geometry', crs=info['crs'])
+    if index['partition'].duplicated().any():
+        raise ValueError('prepare_soil_store partition ids must be unique')
+    if os.path.isfile(fname_index): os.remove(fname_index)
+    for pid in index['partition']:
+        dir_partition = os.path.join(dir_store,pid)
+        if os.path.isdir(dir_partition):
+            for fname in os.listdir(dir_partition): os.remove(os.path.join(dir_partition,fname))
+        os.makedirs(dir_partition,exist_ok=True)
+    stats = numpy.zeros((len(index),5)) # n_features, minx, miny, maxx, maxy
+    stats[:,1:3], stats[:,3:5] = numpy.inf, -numpy.inf
+    n_features = info['features']
+    for ichunk, skip in enumerate(range(0,n_features,chunk_size)):
+        if verbose: print(f' partitioning features {skip} to {min(skip+chunk_size,n_features)} of {n_features}')
+        chunk = pyogrio.read_dataframe(fname_texture_parent, skip_features=skip, max_features=chunk_size)
+        chunk['_fid'] = numpy.arange(skip,skip+len(chunk),dtype=numpy.int64)
+        ifeat, ipart = index.sindex.query(chunk.geometry, predicate='intersects')
+        bounds = chunk.geometry.bounds.to_numpy()
+        for i in numpy.unique(ipart):
+            feats = ifeat[ipart == i]
+            chunk.iloc[feats].to_parquet(os.path.join(dir_store,index['partition'].iloc[i],f'part_{ichunk:05d}.parquet'),
+                                         write_covering_bbox=True)
+            stats[i,0] += len(feats)
+            stats[i,1:3] = numpy.minimum(stats[i,1:3],bounds[feats,0:2].min(axis=0))
+            stats[i,3:5] = numpy.maximum(stats[i,3:5],bounds[feats,2:4].max(axis=0))
+    index['n_features'] = stats[:,0].astype(numpy.int64)
+    for j, name in enumerate(['minx','miny','maxx','maxy']):
+        index[name] = numpy.where(stats[:,0] > 0, stats[:,j+1], numpy.nan)
+    index.to_parquet(fname_index)
+    return fname_index
+
+def read_soil_store(dir_store, domain):
+    """Features of a prepare_soil_store store that intersect the bbox of domain (unclipped)"""
+    index  = geopandas.read_parquet(os.path.join(dir_store,'index.parquet'))
+    domain = domain.to_crs(index.crs)
+    bbox   = tuple(domain.geometry.total_bounds)
+    hits   = index.iloc[numpy.sort(index.sindex.query(domain.geometry.union_all(), predicate='intersects'))]
+    hits   = hits[(hits['n_features'] > 0) & (hits['minx'] <= bbox[2]) & (hits['maxx'] >= bbox[0])
+                  & (hits['miny'] <= bbox[3]) & (hits['maxy'] >= bbox[1])]
+    parts  = [geopandas.read_parquet(os.path.join(dir_store,pid), bbox=bbox) for pid in hits['partition']]
+    parts  = [part for part in parts if len(part) > 0]
+    if len(parts) == 0:
+        return geopandas.GeoDataFrame(geometry=[], crs=index.crs)
+    soil_texture = pandas.concat(parts, ignore_index=True)
+    soil_texture = soil_texture.drop_duplicates(subset='_fid').sort_values('_fid')
+    soil_texture = soil_texture.drop(columns=[c for c in ('_fid','bbox') if c in soil_texture.columns])
+    return geopandas.GeoDataFrame(soil_texture.reset_index(drop=True), geometry='geometry', crs=index.crs)
+
 async def download_soil_texture(**kwargs):
-    fname_texture = kwargs.get('fname_texture', None)
-    domain        = kwargs.get('domain',        None)
-    domain_buf    = kwargs.get('domain_buf',    None)
-    verbose       = kwargs.get('verbose',       False)
-    overwrite     = kwargs.get('overwrite',     False)
+    fname_texture    = kwargs.get('fname_texture',    None)
+    domain           = kwargs.get('domain',           None)
+    domain_buf       = kwargs.get('domain_buf',       None)
+    verbose          = kwargs.get('verbose',          False)
+    overwrite        = kwargs.get('overwrite',        False)
+    fname_soil_cache = kwargs.get('fname_soil_cache', None)
+    backend          = kwargs.get('backend',          None)
     if verbose: print(f'calling set_soil_texture')
     if not os.path.isfile(fname_texture) or overwrite:
         if verbose: print(f' using soildb to download soil texture and saving to {fname_texture}')
+        if backend is None: backend = SoildbBackend()
         #geom = domain_buf.to_crs(epsg=4326).geometry.union_all()
         xmin, ymin, xmax, ymax = domain_buf.to_crs(epsg=4326).total_bounds
         bbox = {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax}
-        response = await soildb.spatial_query(geometry=bbox,
-                                              table="mupolygon",
-                                              spatial_relation="intersects",
-                                              return_type="spatial")
-        soilsgdf = response.to_geodataframe()
-        response = await soildb.fetch_by_keys(soilsgdf.mukey.unique().tolist(), 
-                                        "component",
-                                        key_column="mukey",
-                                        columns=["mukey","cokey", "compname", "comppct_r"])
-        comps = response.to_pandas()
-        dom_comps = comps.loc[comps.groupby('mukey')['comppct_r'].idxmax()] # get dominant component per map unit
-        response = await soildb.fetch_by_keys(dom_comps['cokey'].tolist(), 
-                                        "chorizon",
-                                        key_column="cokey",
-                                        columns=["cokey","sandtotal_r","silttotal_r","claytotal_r","hzdept_r",'hzdepb_r','hzdept_r'])
-        chorizons = response.to_pandas()
-        chorizons['depth_range'] = chorizons['hzdepb_r'] - chorizons['hzdept_r']
-        sand = chorizons.groupby('cokey')[['sandtotal_r', 'depth_range']].apply(lambda x: (x['sandtotal_r'] * x['depth_range']).sum() / x['depth_range'].sum()).reset_index(name='weighted_sandtotal_r')
-        silt = chorizons.groupby('cokey')[['silttotal_r', 'depth_range']].apply(lambda x: (x['silttotal_r'] * x['depth_range']).sum() / x['depth_range'].sum()).reset_index(name='weighted_silttotal_r')
-        clay = chorizons.groupby('cokey')[['claytotal_r', 'depth_range']].apply(lambda x: (x['claytotal_r'] * x['depth_range']).sum() / x['depth_range'].sum()).reset_index(name='weighted_claytotal_r')
-        texture = sand.merge(silt, on='cokey').merge(clay, on='cokey')
-        def calc_texture(row): 
-            try: sand = float(row['weighted_sandtotal_r'])
-            except: return 'None'
-            try: clay = float(row['weighted_claytotal_r'])
-            except: return 'None'
-            return soiltexture.getTexture(sand,clay)
-        texture['texture'] = texture.apply(calc_texture, axis=1)
-        soilsgdf = soilsgdf.merge(dom_comps.merge(texture, on='cokey')[['mukey','texture']], on='mukey')
+        soilsgdf = await backend.fetch_mupolygons(bbox)
+        cache    = SoilTextureCache(fname_soil_cache) if fname_soil_cache is not None else None
+        texture  = await get_mukey_textures(soilsgdf.mukey.unique().tolist(), backend=backend, cache=cache, verbose=verbose)
+        texture  = texture.loc[texture['cokey'].notna(),['mukey','texture']]
+        texture['mukey'] = texture['mukey'].astype(soilsgdf['mukey'].dtype)
+        soilsgdf = soilsgdf.merge(texture, on='mukey')
         soilsgdf = geopandas.clip(gdf=soilsgdf.to_crs(domain.crs),mask=domain)
         soilsgdf.to_file(fname_texture, driver="GPKG")
     else:
         if verbose: print(f' found existing soil texture file {fname_texture}')
 
+async def get_mukey_textures(mukeys, backend=None, cache=None, verbose=False):
+    """
+    Dominant component (cokey), depth weighted sand/silt/clay and texture of
+    each map unit (mukey). With a SoilTextureCache only the mukeys not yet in
+    the cache are queried from backend (default SoildbBackend), and the new
+    results are added to the cache. Map units without a component or horizon
+    data have cokey None.
+    """
+    if backend is None: backend = SoildbBackend()
+    mukeys = [str(k) for k in pandas.unique(pandas.Series(mukeys,dtype=object).astype(str))]
+    cached = cache.get(mukeys) if cache is not None else _empty_texture_table()
+    found   = set(cached['mukey'])
+    missing = [k for k in mukeys if k not in found]
+    if verbose and cache is not None:
+        print(f' found {len(mukeys)-len(missing)} of {len(mukeys)} map units in soil cache {cache.fname}')
+    if len(missing) == 0:
+        return cached
+    queried = await _query_mukey_textures(missing, backend)
+    if cache is not None: cache.put(queried)
+    return pandas.concat([cached,queried], ignore_index=True)
+
+async def _query_mukey_textures(mukeys, backend):
+    """Query components and horizons of mukeys from backend and derive their textures"""
+    comps = await backend.fetch_components(mukeys)
+    comps = comps.astype({'mukey':str,'cokey':str})
+    comps = comps.loc[comps['comppct_r'].notna()]
+    dom_comps = comps.loc[comps.groupby('mukey')['comppct_r'].idxmax()] # get dominant component per map unit
+    texture = _empty_texture_table().drop(columns=['mukey'])
+    if len(dom_comps) > 0:
+        chorizons = await backend.fetch_horizons(dom_comps['cokey'].tolist())
+        chorizons = chorizons.astype({'cokey':str})
+        if len(chorizons) > 0:
+            texture = _weight_horizons(chorizons)
+            texture['texture'] = classify_texture(texture['weighted_sandtotal_r'].to_numpy(),
+                                                  texture['weighted_claytotal_r'].to_numpy())
+    texture = dom_comps[['mukey','cokey']].merge(texture, on='cokey')
+    # keep map units without texture too, so they are not queried again
+    texture = pandas.DataFrame({'mukey':mukeys}).merge(texture, on='mukey', how='left')
+    return texture[_empty_texture_table().columns]
+
+def _empty_texture_table():
+    return pandas.DataFrame({'mukey'               : pandas.Series(dtype=object),
+                             'cokey'               : pandas.Series(dtype=object),
+                             'weighted_sandtotal_r': pandas.Series(dtype=float),
+                             'weighted_silttotal_r': pandas.Series(dtype=float),
+                             'weighted_claytotal_r': pandas.Series(dtype=float),
+                             'texture'             : pandas.Series(dtype=object)})
+
+class SoilTextureCache:
+    """
+    Persistent SQLite cache of mukey -> dominant cokey -> depth weighted
+    texture. Every call opens its own connection (WAL journal, busy timeout),
+    so one cache file can be shared by concurrent pool workers.
+    """
+
+    def __init__(self, fname, timeout=120.):
+        self.fname   = fname
+        self.timeout = timeout
+        dirname = os.path.dirname(os.path.abspath(fname))
+        os.makedirs(dirname, exist_ok=True)
+        with self._connect() as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute("""CREATE TABLE IF NOT EXISTS mukey_texture (
+                               mukey                TEXT PRIMARY KEY,
+                               cokey                TEXT,
+                               weighted_sandtotal_r REAL,
+                               weighted_silttotal_r REAL,
+                               weighted_claytotal_r REAL,
+                               texture              TEXT)""")
+
+    def _connect(self):
+        return contextlib.closing(sqlite3.connect(self.fname, timeout=self.timeout, isolation_level=None))
+
+    def get(self, mukeys):
+        """Cached rows of mukeys (missing mukeys are left out)"""
+        mukeys = [str(k) for k in mukeys]
+        tables = [_empty_texture_table()]
+        with self._connect() as con:
+            for i in range(0, len(mukeys), 900): # stay below the sqlite variable limit
+                chunk = mukeys[i:i+900]
+                sql = f'SELECT * FROM mukey_texture WHERE mukey IN ({",".join("?"*len(chunk))})'
+                tables.append(pandas.read_sql_query(sql, con, params=chunk))
+        tables = [t for t in tables[1:] if len(t) > 0]
+        if len(tables) == 0: return _empty_texture_table()
+        return pandas.concat(tables, ignore_index=True)[_empty_texture_table().columns]
+
+    def put(self, texture):
+        """Insert or replace the rows of a texture table"""
+        rows = texture[_empty_texture_table().columns].astype(object)
+        rows = rows.where(rows.notna(), None).itertuples(index=False, name=None)
+        with self._connect() as con:
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                con.executemany('INSERT OR REPLACE INTO mukey_texture VALUES (?,?,?,?,?,?)', rows)
+                con.execute('COMMIT')
+            except BaseException:
+                con.execute('ROLLBACK')
+                raise
+
+class SoildbBackend:
+    """Soil data from the NRCS Soil Data Access service through soildb"""
+
+    async def fetch_mupolygons(self, bbox):
+        response = await soildb.spatial_query(geometry=bbox,
+                                              table="mupolygon",
+                                              spatial_relation="intersects",
+                                              return_type="spatial")
+        return response.to_geodataframe()
+
+    async def fetch_components(self, mukeys):
+        response = await soildb.fetch_by_keys(mukeys,
+                                              "component",
+                                              key_column="mukey",
+                                              columns=["mukey","cokey", "compname", "comppct_r"])
+        return response.to_pandas()
+
+    async def fetch_horizons(self, cokeys):
+        response = await soildb.fetch_by_keys(cokeys,
+                                              "chorizon",
+                                              key_column="cokey",
+                                              columns=["cokey","sandtotal_r","silttotal_r","claytotal_r","hzdept_r",'hzdepb_r'])
+        return response.to_pandas()
+
+class LocalSoilBackend:
+    """
+    Stand-in for SoildbBackend serving map unit polygons, components and
+    horizons from local tables (GeoDataFrame/DataFrame or files readable by
+    geopandas/pandas), e.g. for tests or offline runs. Counts the keys it is
+    asked for in n_queried.
+    """
+
+    def __init__(self, mupolygons=None, components=None, chorizons=None):
+        self.mupolygons = geopandas.read_file(mupolygons) if isinstance(mupolygons,str) else mupolygons
+        self.components = pandas.read_csv(components,dtype={'mukey':str,'cokey':str}) if isinstance(components,str) else components
+        self.chorizons  = pandas.read_csv(chorizons,dtype={'cokey':str}) if isinstance(chorizons,str) else chorizons
+        self.n_queried  = {'mupolygon':0,'component':0,'chorizon':0}
+
+    async def fetch_mupolygons(self, bbox):
+        self.n_queried['mupolygon'] += 1
+        gdf = self.mupolygons.to_crs(epsg=4326)
+        return gdf.cx[bbox['xmin']:bbox['xmax'], bbox['ymin']:bbox['ymax']].reset_index(drop=True)
+
+    async def fetch_components(self, mukeys):
+        self.n_queried['component'] += len(mukeys)
+        keys = set(str(k) for k in mukeys)
+        return self.components.loc[self.components['mukey'].astype(str).isin(keys)].reset_index(drop=True)
+
+    async def fetch_horizons(self, cokeys):
+        self.n_queried['chorizon'] += len(cokeys)
+        keys = set(str(k) for k in cokeys)
+        return self.chorizons.loc[self.chorizons['cokey'].astype(str).isin(keys)].reset_index(drop=True)
+
+def _weight_horizons(chorizons):
+    """Depth weighted sand, silt and clay percentages of each component (cokey) over its horizons"""
+    fractions = ['sandtotal_r','silttotal_r','claytotal_r']
+    depth_range = chorizons['hzdepb_r'] - chorizons['hzdept_r']
+    weighted = chorizons[fractions].mul(depth_range,axis=0)
+    weighted['depth_range'] = depth_range
+    sums = weighted.groupby(chorizons['cokey']).sum()
+    texture = sums[fractions].div(sums['depth_range'],axis=0)
+    texture.columns = ['weighted_'+c for c in fractions]
+    return texture.reset_index()
+
+def classify_texture(sand, clay, classification='USDA'):
+    """
+    Array version of soiltexture.getTexture: class name of the first texture
+    triangle polygon containing each (sand, clay) pair, None where there is
+    no match (e.g. NaN fractions). Uses the same polygons (and class order)
+    as soiltexture so the labels are identical.
+    """
+    sand = numpy.asarray(sand,dtype=numpy.float64)
+    clay = numpy.asarray(clay,dtype=numpy.float64)
+    texture = numpy.full(sand.shape,None,dtype=object)
+    todo = numpy.isfinite(sand) & numpy.isfinite(clay)
+    points = numpy.column_stack([sand.ravel(),clay.ravel()])
+    todo = todo.ravel()
+    flat = texture.ravel()
+    for name, polygon in soiltexture.texture.tables[classification].items():
+        if not todo.any(): break
+        idx = numpy.flatnonzero(todo)
+        hit = idx[polygon.contains_points(points[idx])]
+        flat[hit] = name
+        todo[hit] = False
+    return flat.reshape(sand.shape)
+
 def set_soil_transmissivity(**kwargs):
+    """
+    Rasterize the soil texture polygons to a transmissivity decay factor (f)
+    grid aligned with fname_dem.
+
+    Textures are mapped to f once per category, and polygons are burned as
+    category codes strip by strip (blocksize rows) with rasterio. Pixel counts
+    per category are accumulated while burning, so the grid mean used to fill
+    cells without a polygon (where the DEM has data) is known after a single
+    rasterization pass; the codes are then looked up into a float32 f grid.
+    """
     fname_texture        = kwargs.get('fname_texture', None)
     fname_dem            = kwargs.get('fname_dem',     None)
     fname_transmissivity = kwargs.get('fname_transmissivity', None)
     verbose              = kwargs.get('verbose',       False)
     overwrite            = kwargs.get('overwrite',     False)
+    blocksize            = kwargs.get('blocksize',     1024)
     if verbose: print('calling set_soil_transmissivity')
     if not os.path.isfile(fname_transmissivity) or overwrite:
         if verbose: print(f' creating {fname_transmissivity} from {fname_texture}')
-        dt_transmissivity = {'clay heavy'    :3.2,
-                            'silty clay'     :3.1,
-                            'clay'           :2.8,
-                            'silty clay loam':2.9,
-                            'clay loam'      :2.7,
-                            'silt'           :3.4,
-                            'silt loam'      :2.6,
-                            'sandy clay'     :2.5,
-                            'loam'           :2.5,
-                            'sandy clay loam':2.4,
-                            'sandy loam'     :2.3,
-                            'loamy sand'     :2.2,
-                            'sand'           :2.1,
-                            'organic'        :2.5}
+        soil_texture = geopandas.read_file(fname_texture)
+        with rasterio.open(fname_dem) as dem:
+            soil_texture = soil_texture.to_crs(dem.crs)
+            soil_texture = soil_texture[~(soil_texture.geometry.is_empty | soil_texture.geometry.isna())]
+            # code 0 - no polygon (filled with the grid mean), 1..n - texture category, NODATA_CODE - no polygon and no dem
+            codes, f_categories = _texture_codes(soil_texture['texture'])
+            counts = numpy.zeros(len(f_categories)+1, dtype=numpy.int64)
+            tot = 0
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(fname_transmissivity))) as scratch_dir:
+                code_grid = numpy.lib.format.open_memmap(os.path.join(scratch_dir,'codes.npy'), mode='w+',
+                                                         dtype=numpy.uint16, shape=(dem.height,dem.width))
+                for window in _row_windows(dem.height, dem.width, blocksize):
+                    window_codes = _burn_codes(soil_texture, codes, window, dem.transform)
+                    dem_valid = dem.read_masks(1, window=window) > 0
+                    window_codes[(window_codes == 0) & ~dem_valid] = NODATA_CODE
+                    counts += numpy.bincount(window_codes[window_codes != NODATA_CODE].ravel(), minlength=len(counts))[:len(counts)]
+                    tot += int(dem_valid.sum())
+                    code_grid[window.toslices()] = window_codes
+                nancount = int(counts[0])
+                ncells   = int(counts[1:].sum())
+                nanmean  = float((counts[1:]*f_categories).sum()/ncells) if ncells > 0 else numpy.nan
+                if verbose and nancount > 0:
+                    percnan = (nancount / tot) * 100.
+                    print(f' WARNING : {nancount} of {tot} cells (~{percnan:.2f}% of domain) had nan transmissivity - filling with grid mean value {nanmean}')
+                f_table = numpy.full(NODATA_CODE+1, numpy.nan, dtype=numpy.float32)
+                f_table[0] = nanmean
+                f_table[1:len(f_categories)+1] = f_categories
+                profile = dem.profile.copy()
+                profile.update(driver='GTiff', count=1, dtype='float32', nodata=numpy.nan)
+                with rasterio.open(fname_transmissivity, 'w', **profile) as dst:
+                    for window in _row_windows(dem.height, dem.width, blocksize):
+                        dst.write(f_table[code_grid[window.toslices()]], 1, window=window)
+                del code_grid
+    else:
+        if verbose: print(f' using existing transmissivity data {fname_transmissivity}')
+
+def _texture_codes(texture):
+    """
+    Category codes (1..n, int) of a texture column and the float32 f of each
+    category. Textures not in TRANSMISSIVITY_F (and missing textures) get the
+    mean f of the table, as in set_soil_transmissivity_slow.
+    """
+    f_default = numpy.mean(list(TRANSMISSIVITY_F.values()))
+    categorical = texture.astype('category')
+    f_categories = numpy.array([TRANSMISSIVITY_F[str(c).lower()] if c in TRANSMISSIVITY_F else f_default
+                                for c in categorical.cat.categories] + [f_default], dtype=numpy.float32)
+    codes = categorical.cat.codes.to_numpy().astype(numpy.int64)
+    codes[codes < 0] = len(f_categories) - 1 # missing texture -> the extra default category
+    if len(f_categories) >= NODATA_CODE:
+        raise Exception(f'set_soil_transmissivity found too many texture categories ({len(f_categories)})')
+    return codes + 1, f_categories
+
+def _row_windows(height, width, blocksize):
+    return [rasterio.windows.Window(0, row_off, width, min(blocksize, height - row_off))
+            for row_off in range(0, height, blocksize)]
+
+def _burn_codes(gdf, codes, window, transform):
+    """Burn the category codes of the polygons intersecting a window (later polygons on top, like make_geocube)"""
+    window_transform = rasterio.windows.transform(window, transform)
+    out = numpy.zeros((window.height, window.width), dtype=numpy.uint16)
+    bounds = rasterio.windows.bounds(window, transform)
+    idx = numpy.sort(gdf.sindex.query(shapely.geometry.box(*bounds)))
+    if len(idx) == 0:
+        return out
+    shapes = zip(gdf.geometry.values[idx], codes[idx])
+    return rasterio.features.rasterize(shapes, out=out, transform=window_transform, all_touched=False)
+
+def set_soil_transmissivity_slow(**kwargs):
+    fname_texture        = kwargs.get('fname_texture', None)
+    fname_dem            = kwargs.get('fname_dem',     None)
+    fname_transmissivity = kwargs.get('fname_transmissivity', None)
+    verbose              = kwargs.get('verbose',       False)
+    overwrite            = kwargs.get('overwrite',     False)
+    if verbose: print('calling set_soil_transmissivity_slow')
+    if not os.path.isfile(fname_transmissivity) or overwrite:
+        if verbose: print(f' creating {fname_transmissivity} from {fname_texture}')
+        dt_transmissivity = TRANSMISSIVITY_F
         soil_texture = geopandas.read_file(fname_texture)
         def calc_f(row):
             if    row['texture'] in dt_transmissivity: return dt_transmissivity[str(row['texture']).lower()]
@@ -1,4 +1,4 @@
-import os,geopandas,pynhd,sys
+import os,geopandas,sys,twtproviders
 
 def set_streams(**kwargs):
     domain        = kwargs.get('domain',        None)
@@ -6,6 +6,7 @@ def set_streams(**kwargs):
     verbose       = kwargs.get('verbose',       False)
     overwrite     = kwargs.get('overwrite',     False)
     fname_verbose = kwargs.get('fname_verbose', None)
+    provider      = kwargs.get('provider',      None) or twtproviders.NHDPlusHRFlowlines()
     if fname_verbose is not None:
         f = open(fname_verbose, "a", buffering=1)
         sys.stdout = f
@@ -16,9 +17,8 @@ def set_streams(**kwargs):
     if fname_streams is None:
         raise ValueError(f'set_streams missing required argument fname_streams')
     if not os.path.isfile(fname_streams) or overwrite:
-        if verbose: print(f' using pynhd to download NHDPlusHR flowlines - saving to {fname_streams}')
-        nhd = pynhd.NHDPlusHR("flowline").bygeom(geom   =domain.total_bounds,
-                                                 geo_crs=domain.crs.to_string())
+        if verbose: print(f' getting NHDPlusHR flowlines - saving to {fname_streams}')
+        nhd = provider.bygeom(domain.total_bounds, domain.crs.to_string())
         nhd = nhd.to_crs(domain.crs)
         nhd = geopandas.clip(nhd, domain.geometry.union_all())
         nhd.to_file(fname_streams, driver="GPKG")
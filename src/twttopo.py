@@ -1,11 +1,18 @@
 import os
+import json
+import numpy
 import rasterio
-import py3dep
+import rasterio.features
 import geopandas
 import rioxarray
 import whitebox
 import multiprocessing
 import subprocess
+import tempfile
+import concurrent.futures
+import twtproviders
+import twtflow
+import twtcalc
 from osgeo import gdal
 from geocube.api.core import make_geocube
 #from whitebox_workflows import WbEnvironment
@@ -16,21 +23,18 @@ async def download_dem(**kwargs):
     overwrite     = kwargs.get('overwrite', False)
     dem_rez       = kwargs.get('dem_rez',   None)
     fname_dem     = kwargs.get('fname_dem', None)
+    provider      = kwargs.get('provider',  None) or twtproviders.Py3depDEM()
     if not os.path.isfile(fname_dem) or overwrite:
-        avail = py3dep.check_3dep_availability(bbox=tuple(domain.total_bounds),crs=domain.crs)
-        vals  = list()
-        for k in avail.keys():
-            try: vals.append(int(k.replace('m','')))
-            except: pass
+        vals = provider.resolutions(tuple(domain.total_bounds), domain.crs)
         if len(vals) == 0:
             raise ValueError(f'download_dem 3dep could not find dem resolution')
         rez = min(vals)
         if dem_rez in vals: rez = dem_rez # override with user input if available
         if verbose:
             print(f' downloading {str(rez)}m DEM to {fname_dem}')
-        dem = py3dep.get_dem(geometry   = domain.geometry.union_all(),
-                             resolution = rez,
-                             crs        = domain.crs)
+        dem = provider.get_dem(geometry   = domain.geometry.union_all(),
+                               resolution = rez,
+                               crs        = domain.crs)
         dem.rio.to_raster(fname_dem)
     else:
         if verbose: print(f' using existing dem {fname_dem}')
@@ -95,9 +99,127 @@ def break_dem(**kwargs):
     else:
         if verbose: print(f' found {fname_dem_child}')
 
+def break_dems(**kwargs):
+    """
+    Batch version of break_dem: extract the DEMs of many subdomains in one
+    pass over the parent DEM (e.g. the CONUS 10 m VRT).
+
+    boundaries is a list of (fname_boundary, fname_dem_child) tuples. Each
+    child covers the bbox of its boundary on the parent grid, with cells
+    whose center is outside the boundary set to nodata (as the break_dem
+    cutline). The parent is read once in blocksize x blocksize tiles over the
+    union of the children, and every tile is copied into all children it
+    overlaps. Children are written as uncompressed scratch files (partial
+    window writes) and compressed into place once complete.
+    """
+    fname_dem_parent = kwargs.get('fname_dem_parent', None)
+    boundaries       = kwargs.get('boundaries',       None)
+    blocksize        = kwargs.get('blocksize',        4096)
+    verbose          = kwargs.get('verbose',          False)
+    overwrite        = kwargs.get('overwrite',        False)
+    if verbose: print('calling break_dems')
+    boundaries = [(fb, fc) for fb, fc in boundaries if not os.path.isfile(fc) or overwrite]
+    if len(boundaries) == 0:
+        if verbose: print(f' found all child dems of {fname_dem_parent}')
+        return
+    with rasterio.open(fname_dem_parent) as src:
+        parent_window = rasterio.windows.Window(0, 0, src.width, src.height)
+        nodata = src.nodata
+        if nodata is None: nodata = 0
+        children = list()
+        for fname_boundary, fname_dem_child in boundaries:
+            boundary = geopandas.read_file(fname_boundary).to_crs(src.crs)
+            window = rasterio.windows.from_bounds(*boundary.total_bounds, transform=src.transform)
+            window = window.round_offsets(op='floor').round_lengths(op='ceil')
+            try:
+                window = window.intersection(parent_window)
+            except rasterio.errors.WindowError:
+                print(f' WARNING break_dems boundary {fname_boundary} does not overlap {fname_dem_parent}')
+                continue
+            children.append({'geometry' : boundary.geometry.union_all(),
+                             'window'   : window,
+                             'fname'    : fname_dem_child,
+                             'dst'      : None})
+        if len(children) == 0: return
+        row_start = min(int(c['window'].row_off) for c in children)
+        row_stop  = max(int(c['window'].row_off + c['window'].height) for c in children)
+        col_start = min(int(c['window'].col_off) for c in children)
+        col_stop  = max(int(c['window'].col_off + c['window'].width) for c in children)
+        profile = src.profile.copy()
+        profile.update(driver='GTiff', count=1, nodata=nodata, tiled=True, blockxsize=256, blockysize=256,
+                       compress=None, BIGTIFF='IF_SAFER')
+        try:
+            for row_off in range(row_start, row_stop, blocksize):
+                tile_rows = min(blocksize, row_stop - row_off)
+                for col_off in range(col_start, col_stop, blocksize):
+                    tile = rasterio.windows.Window(col_off, row_off, min(blocksize, col_stop - col_off), tile_rows)
+                    overlaps = [c for c in children if rasterio.windows.intersect(tile, c['window'])]
+                    if len(overlaps) == 0: continue
+                    data = src.read(1, window=tile)
+                    for child in overlaps:
+                        _write_child_tile(child, tile, data, src.transform, profile)
+                # children that end in this tile row are complete
+                for child in children:
+                    if child['dst'] is not None and child['window'].row_off + child['window'].height <= row_off + tile_rows:
+                        _finalize_child(child, verbose)
+        finally:
+            for child in children:
+                if child['dst'] is not None:
+                    child['dst'].close()
+                    child['dst'] = None
+
+def _write_child_tile(child, tile, data, transform, profile):
+    """Copy the part of a parent tile that overlaps a child dem into it"""
+    overlap = tile.intersection(child['window'])
+    if child['dst'] is None:
+        child_profile = profile.copy()
+        child_profile.update(height    = int(child['window'].height),
+                             width     = int(child['window'].width),
+                             transform = rasterio.windows.transform(child['window'], transform))
+        os.makedirs(os.path.dirname(os.path.abspath(child['fname'])), exist_ok=True)
+        child['dst'] = rasterio.open(child['fname'] + '.part', 'w', **child_profile)
+    rows = slice(int(overlap.row_off - tile.row_off), int(overlap.row_off - tile.row_off + overlap.height))
+    cols = slice(int(overlap.col_off - tile.col_off), int(overlap.col_off - tile.col_off + overlap.width))
+    values = data[rows, cols].copy()
+    inside = rasterio.features.geometry_mask([child['geometry']], out_shape=values.shape,
+                                             transform=rasterio.windows.transform(overlap, transform), invert=True)
+    values[~inside] = profile['nodata']
+    child_window = rasterio.windows.Window(overlap.col_off - child['window'].col_off,
+                                           overlap.row_off - child['window'].row_off,
+                                           overlap.width, overlap.height)
+    child['dst'].write(values, 1, window=child_window)
+
+def _finalize_child(child, verbose=False):
+    """Compress a completed child dem scratch file into place"""
+    child['dst'].close()
+    child['dst'] = None
+    fname_part = child['fname'] + '.part'
+    with rasterio.open(fname_part) as part:
+        profile = part.profile.copy()
+        profile.update(compress='LZW', BIGTIFF='IF_SAFER')
+        with rasterio.open(child['fname'], 'w', **profile) as dst:
+            for _, window in part.block_windows(1):
+                dst.write(part.read(1, window=window), 1, window=window)
+    os.remove(fname_part)
+    if verbose: print(f' wrote {child["fname"]}')
+
 def breach_dem(**kwargs):
+    """
+    Breach depressions in fname_dem with whitebox breach_depressions_least_cost
+    (after breach_single_cell_pits). mode 'single' breaches the whole DEM in
+    one call (timeout seconds), 'tiled' breaches overlapping tiles in
+    parallel (see _breach_tiled) and 'auto' uses tiles when the DEM is wider
+    or taller than tile_size cells. The default is 'single' until tiling has
+    been compared with it on real DEMs. fill_depressions is only used if
+    breaching fails.
+    """
     fname_dem_breached = kwargs.get('fname_dem_breached', None)
     fname_dem          = kwargs.get('fname_dem',          None)
+    mode               = kwargs.get('mode',               'single')
+    tile_size          = kwargs.get('tile_size',          4096)
+    tile_overlap       = kwargs.get('tile_overlap',       256)
+    workers            = kwargs.get('workers',            None)
+    timeout            = kwargs.get('timeout',            900)
     verbose            = kwargs.get('verbose',            False)
     overwrite          = kwargs.get('overwrite',          False)
     if verbose: print('calling breach_dem')
@@ -105,8 +227,13 @@ def breach_dem(**kwargs):
         raise KeyError('breach_dem missing required argument fname_dem')
     if not os.path.isfile(fname_dem):
         raise ValueError(f'breach_dem could not find fname_dem {fname_dem}')
+    if mode not in ['auto','single','tiled']:
+        raise ValueError(f'breach_dem invalid mode {mode}, must be auto, single or tiled')
     if not os.path.isfile(fname_dem_breached) or overwrite:
-        if verbose: print(f' using whitebox to breach dem and writing to {fname_dem_breached}')
+        if mode == 'auto':
+            with rasterio.open(fname_dem) as src:
+                mode = 'tiled' if max(src.height, src.width) > tile_size else 'single'
+        if verbose: print(f' using whitebox to breach dem ({mode}) and writing to {fname_dem_breached}')
         wbt = whitebox.WhiteboxTools()
         fname_filled = fname_dem.replace('.tif','_fill.tif')
         wbt.breach_single_cell_pits(
@@ -114,23 +241,13 @@ def breach_dem(**kwargs):
             output=fname_filled, 
         )
         try:
-            cmd = [
-                os.path.join(wbt.exe_path,wbt.exe_name),
-                "-r=breach_depressions_least_cost",
-                f"--dem={fname_filled}",
-                f"--output={fname_dem_breached}",
-                f"--dist={int(1000)}",
-            ]
-            if verbose:
-                cmd.append("--verbose")
-            result = subprocess.run(
-                cmd,
-                check=True,
-                timeout=900,
-                text=True,
-            )
+            if mode == 'single':
+                _breach_least_cost(wbt, fname_filled, fname_dem_breached, timeout=timeout, verbose=verbose)
+            else:
+                _breach_tiled(wbt, fname_filled, fname_dem_breached, tile_size=tile_size, tile_overlap=tile_overlap,
+                              workers=workers, timeout=timeout, verbose=verbose)
         except subprocess.TimeoutExpired:
-            if verbose: print(" breach least cost timeout reached (15 min)")
+            if verbose: print(f" breach least cost timeout reached ({timeout} s)")
         except Exception as e:
             if verbose: print(f" WARNING breach least cost failed with message {e}")
         if not os.path.isfile(fname_dem_breached): 
@@ -144,23 +261,180 @@ def breach_dem(**kwargs):
     else:
         if verbose: print(f' found existing breached dem {fname_dem_breached}')
 
+def _breach_least_cost(wbt, fname_in, fname_out, timeout=900, fill=False, dist=1000, verbose=False):
+    """Run whitebox breach_depressions_least_cost (max breach length dist cells) as a subprocess with a timeout"""
+    cmd = [
+        os.path.join(wbt.exe_path,wbt.exe_name),
+        "-r=breach_depressions_least_cost",
+        f"--dem={fname_in}",
+        f"--output={fname_out}",
+        f"--dist={int(dist)}",
+    ]
+    if fill:
+        cmd.append("--fill")
+    if verbose:
+        cmd.append("--verbose")
+    subprocess.run(
+        cmd,
+        check=True,
+        timeout=timeout,
+        text=True,
+    )
+
+def _breach_tiled(wbt, fname_in, fname_out, tile_size=4096, tile_overlap=256, workers=None, timeout=900, verbose=False):
+    """
+    Breach fname_in in tiles of tile_size cells, each read with tile_overlap
+    cells on every side and breached in parallel (workers threads, each
+    running a whitebox subprocess with the timeout). Only the core of a
+    tile (without the overlap) is kept, so every cell comes from exactly one
+    tile whatever the order they finish in.
+
+    A tile edge is an outlet to whitebox, so depressions that cross a seam
+    between tiles can be left draining towards it. A second pass breaches
+    bands of 2 x tile_overlap cells centered on the seams (first all
+    vertical, then all horizontal seams, each band read with tile_overlap
+    more cells on either side) over the stitched DEM, with the remaining
+    depressions in a band filled, and keeps the band. Bands of one
+    direction do not overlap and are all read before any is written back.
+
+    Breach paths are limited to tile_overlap cells (at most 1000, as in
+    single mode), so a path starting in the kept part of a window stays
+    within what was read for it. The stitched DEM is passed through
+    breach_single_cell_pits, and a warning gives the number of cells that
+    are still left without a lower neighbour (see _count_pits).
+    """
+    workers = max(1, int(workers or os.cpu_count() or 1))
+    with rasterio.open(fname_in) as src:
+        height, width = src.height, src.width
+        profile = src.profile.copy()
+    profile.update(driver='GTiff', count=1, tiled=True, blockxsize=256, blockysize=256, compress=None, BIGTIFF='IF_SAFER')
+    tile_size = max(int(tile_size), 4 * int(tile_overlap) + 1)
+    dist = min(1000, int(tile_overlap))
+    tiles = [rasterio.windows.Window(col_off, row_off, min(tile_size, width - col_off), min(tile_size, height - row_off))
+             for row_off in range(0, height, tile_size) for col_off in range(0, width, tile_size)]
+    col_seams = list(range(tile_size, width, tile_size))
+    row_seams = list(range(tile_size, height, tile_size))
+    bands_v = [rasterio.windows.Window(c - tile_overlap, 0, 2 * tile_overlap, height) for c in col_seams]
+    bands_h = [rasterio.windows.Window(0, r - tile_overlap, width, 2 * tile_overlap) for r in row_seams]
+    if verbose: print(f' breaching {len(tiles)} tiles of {tile_size} cells ({tile_overlap} cells overlap) and {len(bands_v) + len(bands_h)} seams over {workers} workers')
+    dirname = os.path.dirname(os.path.abspath(fname_out))
+    with tempfile.TemporaryDirectory(dir=dirname, prefix='breach_') as tmpdir:
+        fname_part = os.path.join(tmpdir, 'stitched.tif')
+        with rasterio.open(fname_in) as src, rasterio.open(fname_part, 'w', **profile) as dst:
+            _breach_windows(wbt, src, dst, tiles, tile_overlap, tmpdir, 'tile', workers, timeout, False, dist, verbose)
+        for name, bands in (('vseam', bands_v), ('hseam', bands_h)):
+            if len(bands) == 0: continue
+            with rasterio.open(fname_part, 'r+') as dst:
+                _breach_windows(wbt, dst, dst, bands, tile_overlap, tmpdir, name, workers, timeout, True, dist, verbose)
+        fname_pits = os.path.join(tmpdir, 'stitched_pits.tif')
+        wbt.breach_single_cell_pits(dem=fname_part, output=fname_pits)
+        n_pits = _count_pits(fname_pits)
+        if n_pits > 0:
+            print(f' WARNING {n_pits} cells without a lower neighbour left in the tiled breached dem')
+        elif verbose: print(' no cells without a lower neighbour left in the tiled breached dem')
+        with rasterio.open(fname_pits) as part:
+            profile.update(compress='LZW')
+            with rasterio.open(fname_out + '.tmp', 'w', **profile) as dst:
+                for _, window in dst.block_windows(1):
+                    data = part.read(1, window=window, masked=True).filled(dst.nodata if dst.nodata is not None else 0)
+                    dst.write(data.astype(dst.dtypes[0]), 1, window=window)
+    os.replace(fname_out + '.tmp', fname_out)
+
+def _count_pits(fname, band_rows=1024):
+    """
+    Number of valid cells of fname with no lower neighbour, leaving out the
+    grid edge and cells next to nodata (both of which are outlets)
+    """
+    n_pits = 0
+    with rasterio.open(fname) as src:
+        height = src.height
+        for row0 in range(0, height, band_rows):
+            row1 = min(row0 + band_rows, height)
+            outer = rasterio.windows.Window(0, max(0, row0 - 1), src.width, min(height, row1 + 1) - max(0, row0 - 1))
+            z = src.read(1, window=outer, masked=True).astype(numpy.float64).filled(numpy.nan)
+            z = numpy.pad(z, ((int(row0 == 0), int(row1 == height)), (1, 1)), constant_values=numpy.nan)
+            core = z[1:-1, 1:-1]
+            pit = numpy.isfinite(core)
+            for drow in (-1, 0, 1):
+                for dcol in (-1, 0, 1):
+                    if drow == 0 and dcol == 0: continue
+                    neighbour = z[1 + drow:z.shape[0] - 1 + drow, 1 + dcol:z.shape[1] - 1 + dcol]
+                    pit &= neighbour >= core # False for a NaN neighbour
+            n_pits += int(pit.sum())
+    return n_pits
+
+def _breach_windows(wbt, src, dst, windows, overlap, tmpdir, name, workers, timeout, fill, dist, verbose):
+    """Breach each window of src read with overlap cells around it (breach paths up to dist cells) and write the window to dst"""
+    grid = rasterio.windows.Window(0, 0, src.width, src.height)
+    jobs = list()
+    for i, window in enumerate(windows):
+        window = window.intersection(grid)
+        outer = rasterio.windows.Window(window.col_off - overlap, window.row_off - overlap,
+                                        window.width + 2 * overlap, window.height + 2 * overlap).intersection(grid)
+        data = src.read(1, window=outer)
+        if src.nodata is not None and numpy.all(data == src.nodata):
+            jobs.append((window, outer, None))
+            continue
+        fname_tile = os.path.join(tmpdir, f'{name}_{i}.tif')
+        profile = src.profile.copy()
+        profile.update(height=int(outer.height), width=int(outer.width), transform=src.window_transform(outer), compress=None)
+        with rasterio.open(fname_tile, 'w', **profile) as tile:
+            tile.write(data, 1)
+        jobs.append((window, outer, fname_tile))
+    def run(job):
+        _, _, fname_tile = job
+        if fname_tile is not None:
+            _breach_least_cost(wbt, fname_tile, fname_tile.replace('.tif', '_breached.tif'), timeout=timeout, fill=fill, dist=dist)
+        return job
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for window, outer, fname_tile in pool.map(run, jobs):
+            if fname_tile is None:
+                continue
+            fname_breached = fname_tile.replace('.tif', '_breached.tif')
+            inner = rasterio.windows.Window(window.col_off - outer.col_off, window.row_off - outer.row_off,
+                                            window.width, window.height)
+            with rasterio.open(fname_breached) as tile:
+                dst.write(tile.read(1, window=inner).astype(dst.dtypes[0]), 1, window=window)
+            os.remove(fname_tile)
+            os.remove(fname_breached)
+    if verbose: print(f' breached {len(windows)} {name} windows')
+
 def set_flow_acc(**kwargs):
     fname_dem_breached = kwargs.get('fname_dem_breached', None)
     fname_facc_ncells  = kwargs.get('fname_facc_ncells',  None)
     fname_facc_sca     = kwargs.get('fname_facc_sca',     None)
+    engine             = kwargs.get('engine',             'whitebox')
+    method             = kwargs.get('method',             'dinf')
     verbose            = kwargs.get('verbose',            False)
     overwrite          = kwargs.get('overwrite',          False)
     if verbose: print(f'calling set_flow_acc')
-    if not os.path.isfile(fname_facc_ncells) or overwrite:
+    if engine not in ['twtflow','whitebox']:
+        raise ValueError(f'set_flow_acc invalid engine {engine}, must be twtflow or whitebox')
+    if engine == 'whitebox' and method != 'dinf':
+        raise ValueError(f'set_flow_acc engine whitebox only supports method dinf')
+    get_ncells = not os.path.isfile(fname_facc_ncells) or overwrite
+    get_sca    = not os.path.isfile(fname_facc_sca)    or overwrite
+    if not get_ncells:
+        if verbose: print(f' using existing flow accumulation (ncells) file {fname_facc_ncells}')
+    if not get_sca:
+        if verbose: print(f' using existing flow accumulation (sca) file {fname_facc_sca}')
+    if engine == 'twtflow':
+        if get_ncells or get_sca:
+            if verbose: print(f' using twtflow to calculate {method} flow accumulation (n cells and sca) from {fname_dem_breached}')
+            twtflow.write_flow_acc(fname_dem   = fname_dem_breached,
+                                   fname_cells = fname_facc_ncells if get_ncells else None,
+                                   fname_sca   = fname_facc_sca    if get_sca    else None,
+                                   method      = method,
+                                   verbose     = verbose)
+        return
+    if get_ncells:
         if verbose: print(f' using whitebox to calculate flow accumulation (n cells), writing to {fname_facc_ncells}')
         wbt = whitebox.WhiteboxTools()
         wbt.d_inf_flow_accumulation(i        = fname_dem_breached,
                                     output   = fname_facc_ncells,
                                     out_type = 'cells',
                                     log      = False)
-    else:
-        if verbose: print(f' using existing flow accumulation (ncells) file {fname_facc_ncells}')
-    if not os.path.isfile(fname_facc_sca) or overwrite:
+    if get_sca:
         if verbose: print(f' using whitebox to calculate flow accumulation (sca), writing to {fname_facc_sca}')
         wbt = whitebox.WhiteboxTools()
         wbt.d_inf_flow_accumulation(i        = fname_dem_breached,
@@ -168,10 +442,14 @@ def set_flow_acc(**kwargs):
                                     out_type = 'sca',
                                     log      = False)
 
-    else:
-        if verbose: print(f' using existing flow accumulation (sca) file {fname_facc_sca}')
-
 def calc_stream_mask(**kwargs):
+    """
+    Stream mask of the cells whose flow accumulation (fname_facc_ncells, or
+    fname_facc_sca if that does not exist) is above the threshold, with
+    whitebox extract_streams. If facc_thresholds is given the thresholds are
+    swept in one pass instead (see calc_stream_mask_sweep) and written to
+    fname_strm_sweep.
+    """
     verbose               = kwargs.get('verbose',              False)
     overwrite             = kwargs.get('overwrite',            False)
     fname_facc_ncells     = kwargs.get('fname_facc_ncells',    None)
@@ -179,7 +457,22 @@ def calc_stream_mask(**kwargs):
     facc_threshold_ncells = kwargs.get('facc_threshold_ncells',None)
     facc_threshold_sca    = kwargs.get('facc_threshold_sca',   None)
     fname_strm_mask       = kwargs.get('fname_strm_mask',      None)
+    facc_thresholds       = kwargs.get('facc_thresholds',      None)
+    fname_strm_sweep      = kwargs.get('fname_strm_sweep',     None)
     if verbose: print('calling calc_stream_mask')
+    if facc_thresholds is not None:
+        if fname_facc_ncells is not None and os.path.isfile(fname_facc_ncells):
+            fname_facc = fname_facc_ncells
+        elif fname_facc_sca is not None and os.path.isfile(fname_facc_sca):
+            fname_facc = fname_facc_sca
+        else:
+            raise Exception(f'calc_stream_mask did not find valid flow accumulation file fname_facc_ncells {fname_facc_ncells} or fname_facc_sca {fname_facc_sca}')
+        calc_stream_mask_sweep(fname_facc       = fname_facc,
+                               facc_thresholds  = facc_thresholds,
+                               fname_strm_sweep = fname_strm_sweep,
+                               verbose          = verbose,
+                               overwrite        = overwrite)
+        return
     if not os.path.isfile(fname_strm_mask) or overwrite:
         if os.path.isfile(fname_facc_ncells):
             if verbose: print(f' setting stream mask using fname_facc_ncells {fname_facc_ncells} and facc_threshold_ncells {facc_threshold_ncells}')
@@ -200,6 +493,48 @@ def calc_stream_mask(**kwargs):
     else:
         if verbose: print(f' using existing stream mask {fname_strm_mask}')
 
+def calc_stream_mask_sweep(**kwargs):
+    """
+    Stream masks of several flow accumulation thresholds from one read of
+    fname_facc, as one uint8 raster fname_strm_sweep. The thresholds are
+    swept from the largest down and a cell holds the (1 based) step at which
+    it becomes a stream (flow accumulation above the threshold), 0 if it is
+    not a stream at any threshold and 255 where the flow accumulation is
+    nodata. The thresholds in sweep order are stored in the stream_thresholds
+    tag; the mask of step k is 1 <= value <= k (see
+    twtcalc.stream_mask_from_sweep).
+    """
+    fname_facc       = kwargs.get('fname_facc',       None)
+    facc_thresholds  = kwargs.get('facc_thresholds',  None)
+    fname_strm_sweep = kwargs.get('fname_strm_sweep', None)
+    verbose          = kwargs.get('verbose',          False)
+    overwrite        = kwargs.get('overwrite',        False)
+    if verbose: print('calling calc_stream_mask_sweep')
+    thresholds = sorted(set(float(t) for t in facc_thresholds), reverse=True)
+    if len(thresholds) == 0 or len(thresholds) > 254:
+        raise ValueError(f'calc_stream_mask_sweep needs 1 to 254 thresholds, got {len(thresholds)}')
+    if os.path.isfile(fname_strm_sweep) and not overwrite:
+        with rasterio.open(fname_strm_sweep) as src:
+            if json.loads(src.tags().get('stream_thresholds', '[]')) == thresholds:
+                if verbose: print(f' using existing stream mask sweep {fname_strm_sweep}')
+                return
+    if verbose: print(f' sweeping {len(thresholds)} flow accumulation thresholds of {fname_facc}, writing to {fname_strm_sweep}')
+    edges = numpy.array(thresholds[::-1])
+    with rasterio.open(fname_facc) as src:
+        profile = src.profile.copy()
+        profile.update(driver='GTiff', count=1, dtype='uint8', nodata=255, tiled=True, blockxsize=256,
+                       blockysize=256, compress='deflate', BIGTIFF='IF_SAFER')
+        with rasterio.open(fname_strm_sweep + '.part', 'w', **profile) as dst:
+            dst.update_tags(stream_thresholds=json.dumps(thresholds))
+            for _, window in src.block_windows(1):
+                facc = src.read(1, window=window, masked=True)
+                # number of thresholds below facc, the cell is a stream from step len(thresholds) - n + 1 on
+                n = numpy.searchsorted(edges, facc.filled(-numpy.inf), side='left')
+                step = numpy.where(n > 0, len(thresholds) - n + 1, 0).astype(numpy.uint8)
+                step[numpy.ma.getmaskarray(facc)] = 255
+                dst.write(step, 1, window=window)
+    os.replace(fname_strm_sweep + '.part', fname_strm_sweep)
+
 def calc_slope(**kwargs):
     fname_dem_breached = kwargs.get('fname_dem_breached', None)
     fname_slope        = kwargs.get('fname_slope',        None)
@@ -230,23 +565,122 @@ def calc_twi(**kwargs):
     else:
         if verbose: print(f' found existing TWI file {fname_twi}')
 
+def calc_slope_twi(**kwargs):
+    """
+    Slope and TWI in one pass over fname_dem_breached and fname_facc_sca, in
+    place of calc_slope and calc_twi. The rasters are processed in blocksize
+    tiles over workers threads, each tile read with a one cell halo for the
+    3 x 3 slope kernel (Horn 1981, nodata and off grid neighbours take the
+    value of the center cell, as whitebox slope). TWI is ln(sca / tan(slope))
+    with tan(slope) at least 0.00017, as whitebox wetness_index. Slope (in
+    degrees) is only written if fname_slope is given.
+    """
+    fname_dem_breached = kwargs.get('fname_dem_breached', None)
+    fname_facc_sca     = kwargs.get('fname_facc_sca',     None)
+    fname_twi          = kwargs.get('fname_twi',          None)
+    fname_slope        = kwargs.get('fname_slope',        None)
+    blocksize          = kwargs.get('blocksize',          1024)
+    workers            = kwargs.get('workers',            None)
+    verbose            = kwargs.get('verbose',            False)
+    overwrite          = kwargs.get('overwrite',          False)
+    if verbose: print('calling calc_slope_twi')
+    if os.path.isfile(fname_twi) and (fname_slope is None or os.path.isfile(fname_slope)) and not overwrite:
+        if verbose: print(f' found existing TWI file {fname_twi}')
+        return
+    if verbose: print(f' calculating slope and TWI from {fname_dem_breached} and {fname_facc_sca}, writing to {fname_twi}')
+    with rasterio.open(fname_dem_breached) as src:
+        height, width = src.height, src.width
+        dx, dy = twtflow.cell_sizes(src.transform, src.crs, src.height)
+        profile = src.profile.copy()
+    nodata = -32768.
+    profile.update(driver='GTiff', count=1, dtype='float32', nodata=nodata, tiled=True, blockxsize=256,
+                   blockysize=256, compress='deflate', BIGTIFF='IF_SAFER')
+    tiles = [rasterio.windows.Window(col_off, row_off, min(blocksize, width - col_off), min(blocksize, height - row_off))
+             for row_off in range(0, height, blocksize) for col_off in range(0, width, blocksize)]
+    def run(tile):
+        return tile, _slope_twi_tile(fname_dem_breached, fname_facc_sca, tile, dx, dy)
+    outputs = [(fname_twi, 1)] + ([(fname_slope, 0)] if fname_slope is not None else [])
+    dsts = list()
+    try:
+        for fname, _ in outputs:
+            dsts.append(rasterio.open(fname + '.part', 'w', **profile))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(workers or os.cpu_count() or 1))) as pool:
+            for tile, arrs in pool.map(run, tiles):
+                for dst, (_, i) in zip(dsts, outputs):
+                    dst.write(numpy.where(numpy.isnan(arrs[i]), nodata, arrs[i]).astype(numpy.float32), 1, window=tile)
+    finally:
+        for dst in dsts:
+            dst.close()
+    for fname, _ in outputs:
+        os.replace(fname + '.part', fname)
+
+def _slope_twi_tile(fname_dem, fname_sca, tile, dx, dy):
+    """Slope (degrees) and TWI of one tile (NaN nodata)"""
+    with rasterio.open(fname_dem) as src:
+        halo = rasterio.windows.Window(tile.col_off - 1, tile.row_off - 1, tile.width + 2, tile.height + 2)
+        inner = halo.intersection(rasterio.windows.Window(0, 0, src.width, src.height))
+        z = numpy.full((tile.height + 2, tile.width + 2), numpy.nan)
+        r0, c0 = int(inner.row_off - halo.row_off), int(inner.col_off - halo.col_off)
+        z[r0:r0 + inner.height, c0:c0 + inner.width] = src.read(1, window=inner, masked=True).astype(numpy.float64).filled(numpy.nan)
+    with rasterio.open(fname_sca) as src:
+        sca = src.read(1, window=tile, masked=True).astype(numpy.float64).filled(numpy.nan)
+    center = z[1:-1, 1:-1]
+    def nb(drow, dcol):
+        v = z[1 + drow:z.shape[0] - 1 + drow, 1 + dcol:z.shape[1] - 1 + dcol]
+        return numpy.where(numpy.isnan(v), center, v)
+    a, b, c = nb(-1, -1), nb(-1, 0), nb(-1, 1)
+    d, f    = nb( 0, -1),            nb( 0, 1)
+    g, h, i = nb( 1, -1), nb( 1, 0), nb( 1, 1)
+    dzdx = ((c + 2. * f + i) - (a + 2. * d + g)) / (8. * dx)
+    dzdy = ((g + 2. * h + i) - (a + 2. * b + c)) / (8. * dy)
+    tan_slope = numpy.hypot(dzdx, dzdy)
+    slope = numpy.degrees(numpy.arctan(tan_slope))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        twi = numpy.log(sca / numpy.maximum(tan_slope, 0.00017))
+    twi[~(sca > 0.) | numpy.isnan(center)] = numpy.nan
+    return slope, twi
+
 def calc_twi_mean(**kwargs):
+    """
+    Mean TWI of every WTD cell, broadcast back onto the TWI grid. The TWI
+    pixels are labelled with the WTD cell containing their centre (the
+    domain's twtcalc.wtd_labels, kept in dir_labels and reused by
+    calculate_inundation), the means are sums over the labels and every
+    pixel takes the mean of its label - no warping. The WTD grid is that of
+    wtd_source (e.g. twtwt.WTDNetCDFSource) if given, else of the
+    wtd_YYYYMMDD.tiff files in wtd_raw_dir.
+    """
     fname_twi          = kwargs.get('fname_twi',      None)
     fname_twi_mean     = kwargs.get('fname_twi_mean', None)
     wtd_raw_dir        = kwargs.get('wtd_raw_dir',    None)
+    wtd_source         = kwargs.get('wtd_source',     None)
+    dir_labels         = kwargs.get('dir_labels',     None)
     verbose            = kwargs.get('verbose',        False)
     overwrite          = kwargs.get('overwrite',      False)
     if verbose: print('calling calc_twi_mean')
     if not os.path.isfile(fname_twi_mean) or overwrite:
-        fname_example_wtd_raw = [fn for fn in os.listdir(wtd_raw_dir) if str(fn).endswith('.tiff')][0]
-        fname_example_wtd_raw = os.path.join(wtd_raw_dir,fname_example_wtd_raw)
-        if not os.path.isfile(fname_example_wtd_raw):
-            raise ValueError(f'calc_twi_mean could not locate example raw wtd file - {fname_example_wtd_raw} is not valid file')
+        if wtd_source is not None:
+            wtd_shape, wtd_transform, wtd_crs = wtd_source.shape, wtd_source.transform, wtd_source.crs
+        else:
+            fnames_wtd = sorted(fn for fn in os.listdir(wtd_raw_dir) if fn.startswith('wtd_') and fn.endswith('.tiff'))
+            if len(fnames_wtd) == 0:
+                raise ValueError(f'calc_twi_mean could not locate example raw wtd file in {wtd_raw_dir}')
+            with rasterio.open(os.path.join(wtd_raw_dir, fnames_wtd[0])) as src:
+                wtd_shape, wtd_transform, wtd_crs = src.shape, src.transform, src.crs
+        if dir_labels is None:
+            dir_labels = os.path.join(os.path.dirname(os.path.abspath(fname_twi_mean)), 'wtd_labels')
         if verbose: print(f' calculating mean twi and saving to {fname_twi_mean} (calculating mean twi in each wtd grid cell)')
-        with rioxarray.open_rasterio(fname_twi,masked=True) as riox_ds_twi, rioxarray.open_rasterio(fname_example_wtd_raw,masked=True) as riox_ds_wtd:
-            twi_mean = riox_ds_twi.rio.reproject_match(riox_ds_wtd, resampling=rasterio.enums.Resampling.average)
-            twi_mean = twi_mean.rio.reproject_match(riox_ds_twi, resample=rasterio.enums.Resampling.nearest)
-            twi_mean.rio.to_raster(fname_twi_mean,compress=True)
+        with rasterio.open(fname_twi) as src:
+            profile = src.profile.copy()
+            twi = src.read(1, masked=True).astype(numpy.float32).filled(numpy.nan)
+        labels = twtcalc.wtd_labels(dir_labels, wtd_shape, wtd_transform, wtd_crs, profile, verbose=verbose)
+        twi_mean = labels.apply(labels.block_mean(twi))
+        nodata = profile.get('nodata')
+        if nodata is None:
+            nodata = numpy.nan
+        profile.update(driver='GTiff', count=1, dtype='float32', nodata=nodata, compress='deflate')
+        with rasterio.open(fname_twi_mean, 'w', **profile) as dst:
+            dst.write(numpy.where(numpy.isnan(twi_mean), nodata, twi_mean).astype(numpy.float32), 1)
     else:
         if verbose: print(f' found existing mean TWI file {fname_twi_mean}')
 
@@ -1,4 +1,4 @@
-import os,sys,geopandas,twtnamelist,multiprocessing
+import os,sys,datetime,geopandas,twtnamelist,multiprocessing
 
 def _mask(fname:str, huc:geopandas.GeoDataFrame):
     with rasterio.open(fname,'r') as riods:
@@ -84,4 +84,40 @@ def merge_grids(fname_col:str, fname_out:str, namelist:twtnamelist.Namelist):
                  riods.close()
         for memfile in memfiles:
             if memfile and not memfile.closed:
-                memfile.close()
\ No newline at end of file
+                memfile.close()
+
+def dates_in_dir(dirname:str, prefix:str, suffix:str='.tiff', fmt:str='%Y%m%d'):
+    """Dates of the files {prefix}{date}{suffix} in dirname, read from one directory listing"""
+    dates = set()
+    if dirname is None or not os.path.isdir(dirname): return dates
+    with os.scandir(dirname) as entries:
+        for entry in entries:
+            name = entry.name
+            if not name.startswith(prefix) or not name.endswith(suffix) or not entry.is_file():
+                continue
+            try:
+                dates.add(datetime.datetime.strptime(name[len(prefix):len(name)-len(suffix)], fmt))
+            except ValueError:
+                continue
+    return dates
+
+def daterange(dt_start:datetime.datetime, dt_end:datetime.datetime):
+    """Daily dates from dt_start to dt_end (inclusive)"""
+    return [dt_start + datetime.timedelta(days=i) for i in range(max(0, (dt_end - dt_start).days + 1))]
+
+def missing_dates(dirname:str, dt_start:datetime.datetime, dt_end:datetime.datetime, prefix:str, suffix:str='.tiff', overwrite:bool=False):
+    """Sorted dates from dt_start to dt_end (inclusive) without a {prefix}{YYYYMMDD}{suffix} file in dirname, all of them with overwrite"""
+    dates = daterange(dt_start, dt_end)
+    if overwrite: return dates
+    found = dates_in_dir(dirname, prefix, suffix)
+    return [idt for idt in dates if idt.replace(hour=0, minute=0, second=0, microsecond=0) not in found]
+
+def date_ranges(dates):
+    """Contiguous (first, last) date ranges of a collection of daily dates"""
+    ranges = list()
+    for idt in sorted(dates):
+        if ranges and idt - ranges[-1][1] == datetime.timedelta(days=1):
+            ranges[-1][1] = idt
+        else:
+            ranges.append([idt, idt])
+    return [tuple(r) for r in ranges]
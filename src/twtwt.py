@@ -1,4 +1,19 @@
-import os,sys,math,datetime,geopandas,hf_hydrodata,rasterio,numpy,twtnamelist,rioxarray
+import os,sys,math,datetime,contextlib,geopandas,hf_hydrodata,rasterio,numpy,twtnamelist,rioxarray
+import xarray as xr
+import multiprocessing
+import concurrent.futures
+import rasterio.features
+import rasterio.mask
+import time
+import json
+import random
+import shutil
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+import twtutils
+import twtproviders
 
 def _get_parflow_conus1_bbox(domain:geopandas.GeoDataFrame):
     latlon_tbounds = domain.to_crs(epsg=4326).total_bounds
@@ -15,6 +30,7 @@ def hf_query_nc(**kwargs):
     verbose  = kwargs.get('verbose',  False)
     huc_id   = kwargs.get('huc_id',   None)
     domain   = kwargs.get('domain',   None)
+    provider = kwargs.get('provider', None) or twtproviders.HFHydrodataWTD()
     if verbose: print('calling hf_query')
     if dt_start is None or not isinstance(dt_start,datetime.datetime):
         raise Exception(f'hf_query missing required argument dt_start or is not a valid datetime')
@@ -35,21 +51,151 @@ def hf_query_nc(**kwargs):
                       "end_time"            : end_date_str}
     if huc_id is not None: options_wtd['huc_id'] = huc_id
     else:                  options_wtd['grid_bounds'] = _get_parflow_conus1_bbox(domain)
-    if verbose: 
-        hf_hydrodata.get_gridded_files(options_wtd,
-                                       variables=['water_table_depth'],
-                                       filename_template=os.path.join(savedir,"{dataset}_{variable}_{wy}.nc"),
-                                       verbose=True)
-    else: 
-        hf_hydrodata.get_gridded_files(options_wtd,
-                                       variables=['water_table_depth'],
-                                       filename_template=os.path.join(savedir,"{dataset}_{variable}_{wy}.nc"))
+    provider.get_gridded_files(options_wtd,
+                               variables=['water_table_depth'],
+                               filename_template=os.path.join(savedir,"{dataset}_{variable}_{wy}.nc"),
+                               verbose=verbose)
+
+def _water_year(dt:datetime.datetime):
+    """Water year (Oct 1 - Sep 30, named by the year it ends) of a date"""
+    return dt.year + 1 if dt.month >= 10 else dt.year
+
+def _water_years(dt_start:datetime.datetime,dt_end:datetime.datetime):
+    return list(range(_water_year(dt_start),_water_year(dt_end)+1))
+
+def set_wtd_nc_get_flag(**kwargs):
+    dt_start  = kwargs.get('dt_start',  None)
+    dt_end    = kwargs.get('dt_end',    None)
+    dir_wtd   = kwargs.get('dir_wtd',   None)
+    overwrite = kwargs.get('overwrite', False)
+    if overwrite: return True
+    for wy in _water_years(dt_start,dt_end):
+        if not os.path.isfile(WTDNetCDFSource.nc_fname(dir_wtd,wy)):
+            return True
+    return False
+
+class WTDNetCDFSource:
+    """
+    Daily water table depth read lazily from the water-year NetCDF stacks
+    ({dataset}_{variable}_{wy}.nc) written by hf_query_nc, so that
+    twtcalc.calculate_inundation can use them without daily GeoTIFFs.
+
+    The stacks hold the ParFlow CONUS1 grid_bounds subset (rows south to
+    north) and are georeferenced here from grid_bounds. Days are read
+    chunk_days time slices at a time and kept until a day outside the
+    chunk is requested. Instances are picklable (open files and the chunk
+    are dropped) so they can be handed to pool workers.
+    """
+
+    def __init__(self, savedir, grid_bounds, dt_start=None,
+                 dataset='conus1_baseline_mod', variable='water_table_depth', chunk_days=32):
+        self.savedir     = savedir
+        self.grid_bounds = tuple(int(b) for b in grid_bounds)
+        self.dt_start    = dt_start
+        self.dataset     = dataset
+        self.variable    = variable
+        self.chunk_days  = max(1,int(chunk_days))
+        conus1_proj, _, conus1_transform, _ = _get_parflow_conus1_grid_info()
+        minx, miny, maxx, maxy = self.grid_bounds
+        self.crs       = rasterio.crs.CRS.from_proj4(conus1_proj)
+        self.transform = conus1_transform * rasterio.transform.Affine.translation(minx,miny)
+        self.shape     = (maxy-miny,maxx-minx)
+        self._reset()
+
+    @classmethod
+    def from_domain(cls, savedir, domain:geopandas.GeoDataFrame, **kwargs):
+        """Source for the grid bounds hf_query_nc downloads for domain"""
+        return cls(savedir,_get_parflow_conus1_bbox(domain),**kwargs)
+
+    @staticmethod
+    def nc_fname(savedir, wy, dataset='conus1_baseline_mod', variable='water_table_depth'):
+        return os.path.join(savedir,f'{dataset}_{variable}_{wy}.nc')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update({'_files':dict(),'_chunk':None})
+        return state
+
+    def _reset(self):
+        self._files = dict() # wy -> (xarray.DataArray, numpy datetime64[D] dates)
+        self._chunk = None   # (wy, first index, float32 array)
+
+    def close(self):
+        for da, _ in self._files.values():
+            da.close()
+        self._reset()
+
+    @property
+    def profile(self):
+        return {'driver'    : 'GTiff',
+                'height'    : self.shape[0],
+                'width'     : self.shape[1],
+                'count'     : 1,
+                'dtype'     : 'float32',
+                'nodata'    : numpy.nan,
+                'crs'       : self.crs,
+                'transform' : self.transform}
+
+    def _open(self, wy):
+        if wy not in self._files:
+            fname = WTDNetCDFSource.nc_fname(self.savedir,wy,self.dataset,self.variable)
+            if not os.path.isfile(fname):
+                raise FileNotFoundError(f'WTDNetCDFSource could not find {fname}')
+            ds = xr.open_dataset(fname,cache=False)
+            if self.variable not in ds:
+                raise Exception(f'WTDNetCDFSource could not find variable {self.variable} in {fname}')
+            da = ds[self.variable]
+            if da.ndim != 3 or tuple(da.shape[1:]) != self.shape:
+                raise Exception(f'WTDNetCDFSource {fname} has shape {da.shape} - expected (time,)+{self.shape} for grid bounds {self.grid_bounds}')
+            if 'time' in da.coords and numpy.issubdtype(da['time'].dtype,numpy.datetime64):
+                dates = da['time'].values.astype('datetime64[D]')
+            else:
+                # no time coordinate - the stack starts on the first requested day of its water year
+                dt_first = datetime.datetime(wy-1,10,1)
+                if self.dt_start is not None and self.dt_start > dt_first: dt_first = self.dt_start
+                dates = numpy.datetime64(dt_first.date(),'D') + numpy.arange(da.shape[0])
+            self._files[wy] = (da,dates)
+        return self._files[wy]
+
+    def _locate(self, dt:datetime.datetime):
+        wy = _water_year(dt)
+        _, dates = self._open(wy)
+        i = numpy.searchsorted(dates,numpy.datetime64(dt.date(),'D'))
+        if i >= len(dates) or dates[i] != numpy.datetime64(dt.date(),'D'):
+            raise FileNotFoundError(f'WTDNetCDFSource could not find {dt.strftime("%Y-%m-%d")} in {WTDNetCDFSource.nc_fname(self.savedir,wy,self.dataset,self.variable)}')
+        return wy, int(i)
+
+    def has_day(self, dt:datetime.datetime):
+        try:
+            self._locate(dt)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def read_day(self, dt:datetime.datetime):
+        """One day of water table depth as float32 with NaN nodata"""
+        wy, i = self._locate(dt)
+        if self._chunk is None or self._chunk[0] != wy or not (self._chunk[1] <= i < self._chunk[1] + len(self._chunk[2])):
+            da, _ = self._files[wy]
+            block = da.isel({da.dims[0]:slice(i,i+self.chunk_days)}).values.astype(numpy.float32)
+            self._chunk = (wy,i,block)
+        return self._chunk[2][i-self._chunk[1]]
+
+    @contextlib.contextmanager
+    def open_day(self, dt:datetime.datetime):
+        """One day as an open in-memory rasterio dataset"""
+        with rasterio.io.MemoryFile() as memfile:
+            with memfile.open(**self.profile) as dataset:
+                dataset.write(self.read_day(dt),1)
+            with memfile.open() as dataset:
+                yield dataset
 
 def hf_query(**kwargs):
     dt_start = kwargs.get('dt_start', None)
     dt_end   = kwargs.get('dt_end',   None)
     huc_id   = kwargs.get('huc_id',   None)
     domain   = kwargs.get('domain',   None)
+    provider = kwargs.get('provider', None) or twtproviders.HFHydrodataWTD()
     if dt_start is None or not isinstance(dt_start,datetime.datetime):
         raise Exception(f'hf_query missing required argument dt_start or is not a valid datetime')
     if dt_end is None or not isinstance(dt_end,datetime.datetime):
@@ -71,8 +217,8 @@ def hf_query(**kwargs):
                       "end_time"            : end_date_str}
     if huc_id is not None: options_wtd['huc_id']      = huc_id
     else:                  options_wtd['grid_bounds'] = _get_parflow_conus1_bbox(domain)
-    hf_data = hf_hydrodata.get_gridded_data(options_wtd)
-    if hf_data is None: raise Exception(f'hf_query call to hf_hydrodata.get_gridded_data failed - result is None')
+    hf_data = provider.get_gridded_data(options_wtd)
+    if hf_data is None: raise Exception(f'hf_query call to get_gridded_data failed - result is None')
     expected_days = (dt_end - dt_start).days + 1
     if hf_data.shape[0] != expected_days:
         raise Exception(f'hf_hydrodata returned data of unexpected time length or invalid structure')
@@ -83,15 +229,7 @@ def set_wtd_get_flag(**kwargs):
     dt_end    = kwargs.get('dt_end',    None)
     dir_wtd   = kwargs.get('dir_wtd',   None)
     overwrite = kwargs.get('overwrite', False)
-    download_flag = False
-    idt = dt_start
-    while idt <= dt_end:
-        fname = os.path.join(dir_wtd,'wtd_'+idt.strftime('%Y%m%d')+'.tiff')
-        if not os.path.isfile(fname) or overwrite:
-            download_flag = True
-            break
-        idt += datetime.timedelta(days=1)
-    return download_flag
+    return len(twtutils.missing_dates(dir_wtd, dt_start, dt_end, 'wtd_', overwrite=overwrite)) > 0
 
 def break_conus1_tiffs(**kwargs):
     domain        = kwargs.get('domain',        None)
@@ -119,29 +257,123 @@ def break_conus1_tiffs(**kwargs):
         raise Exception(f'break_conus1_tiffs missing required argument wtd_in_dir')
     if not os.path.isdir(wtd_in_dir):
         raise Exception(f'break_conus1_tiffs argument wtd_in_dir is not a valid directory')
-    os.makedirs(wtd_out_dir,exist_ok=True)
-    conus1_proj, _, _, _ = _get_parflow_conus1_grid_info()
-    geom = domain.to_crs(conus1_proj).geometry.union_all()
-    idt = dt_start 
-    while idt <= dt_end:
-        fname_in = os.path.join(wtd_in_dir,f'conus1_baseline_mod_water_table_depth_{idt.strftime("%Y%m%d")}.tiff')
-        fname_out = os.path.join(wtd_out_dir,'wtd_'+idt.strftime('%Y%m%d')+'.tiff')
-        if not os.path.isfile(fname_out) or overwrite:
-            if not os.path.isfile(fname_in):
-                raise Exception(f'break_conus1_tiffs could not find conus1 file {fname_in}')
-            with rioxarray.open_rasterio(fname_in, masked=True, chunks={'band':1,'x':500,'y':500}) as riox_i:                    
-                wtd_dt = riox_i.rio.clip(geometries  = [geom],
-                                         crs         = riox_i.rio.crs,
-                                         all_touched = True, 
-                                         drop        = True, 
-                                         from_disk   = True)
-                wtd_dt.rio.to_raster(fname_out,compress='LZMA')
-        idt += datetime.timedelta(days=1)
+    kwargs = {'wtd_in_dir' : wtd_in_dir,
+              'jobs'       : [(domain, wtd_out_dir, dt_start, dt_end)],
+              'verbose'    : verbose,
+              'overwrite'  : overwrite}
+    split_conus1_tiffs(**kwargs)
     if fname_verbose is not None:
         sys.stdout = sys.__stdout__
         sys.stderr = sys.__stderr__
         f.close()
 
+def split_conus1_tiffs(**kwargs):
+    """
+    Cut the daily CONUS1 water table depth tiffs in wtd_in_dir for many
+    subdomains at once. jobs is a list of (domain, wtd_out_dir, dt_start,
+    dt_end). Each daily file is opened once and only the window covering the
+    subdomains that still miss that day is read; every subdomain's piece
+    (cropped to the cells its domain touches, cells outside the domain set
+    to nodata) is written to its wtd_out_dir as wtd_YYYYMMDD.tiff. Days are
+    spread over workers processes.
+    """
+    wtd_in_dir = kwargs.get('wtd_in_dir', None)
+    jobs       = kwargs.get('jobs',       None)
+    workers    = kwargs.get('workers',    1)
+    verbose    = kwargs.get('verbose',    False)
+    overwrite  = kwargs.get('overwrite',  False)
+    if verbose: print('calling split_conus1_tiffs')
+    if jobs is None:
+        raise Exception(f'split_conus1_tiffs missing required argument jobs')
+    if wtd_in_dir is None or not os.path.isdir(wtd_in_dir):
+        raise Exception(f'split_conus1_tiffs argument wtd_in_dir {wtd_in_dir} is not a valid directory')
+    days = dict() # date -> indices of the jobs missing it
+    for i, (domain, wtd_out_dir, dt_start, dt_end) in enumerate(jobs):
+        os.makedirs(wtd_out_dir, exist_ok=True)
+        for idt in twtutils.missing_dates(wtd_out_dir, dt_start, dt_end, 'wtd_', overwrite=overwrite):
+            days.setdefault(idt, list()).append(i)
+    if len(days) == 0:
+        if verbose: print(f' found water table depth data for all dates and subdomains')
+        return
+    available = twtutils.dates_in_dir(wtd_in_dir, 'conus1_baseline_mod_water_table_depth_')
+    tasks = list()
+    for idt in sorted(days):
+        fname_in = os.path.join(wtd_in_dir,f'conus1_baseline_mod_water_table_depth_{idt.strftime("%Y%m%d")}.tiff')
+        if idt not in available:
+            raise Exception(f'split_conus1_tiffs could not find conus1 file {fname_in}')
+        tasks.append((fname_in, idt.strftime('%Y%m%d'), days[idt]))
+    # all daily files share the CONUS1 grid, so the cuts are computed once
+    conus1_proj, _, _, _ = _get_parflow_conus1_grid_info()
+    with rasterio.open(tasks[0][0]) as src:
+        cuts = [_conus1_cut(domain.to_crs(conus1_proj).geometry.union_all(), src) for domain, _, _, _ in jobs]
+    state = {'cuts'     : cuts,
+             'out_dirs' : [wtd_out_dir for _, wtd_out_dir, _, _ in jobs]}
+    workers = max(1, min(int(workers or 1), len(tasks)))
+    if workers > 1 and multiprocessing.current_process().daemon:
+        workers = 1
+    if verbose: print(f' cutting {len(tasks)} days for {len(jobs)} subdomains with {workers} process(es)')
+    if workers == 1:
+        for task in tasks:
+            _split_conus1_day(task, state)
+    else:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(processes=workers, initializer=_init_split_worker, initargs=(state,)) as pool:
+            for dt_str in pool.imap_unordered(_split_conus1_day, tasks):
+                if verbose: print(f'  cut {dt_str}', flush=True)
+
+def _conus1_cut(geom, src):
+    """Window of src covering the cells geom touches, and the mask of those cells within it"""
+    window = rasterio.features.geometry_window(src, [geom], pad_x=1, pad_y=1)
+    window = window.intersection(rasterio.windows.Window(0, 0, src.width, src.height))
+    mask = rasterio.features.geometry_mask([geom],
+                                           out_shape   = (window.height, window.width),
+                                           transform   = rasterio.windows.transform(window, src.transform),
+                                           all_touched = True,
+                                           invert      = True)
+    rows, cols = numpy.flatnonzero(mask.any(axis=1)), numpy.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        raise Exception(f'split_conus1_tiffs domain does not overlap the conus1 grid')
+    window = rasterio.windows.Window(window.col_off + cols[0], window.row_off + rows[0],
+                                     cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+    return window, mask[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1]
+
+_split_state = dict()
+
+def _init_split_worker(state):
+    _split_state.clear()
+    _split_state.update(state)
+
+def _split_conus1_day(task, state=None):
+    """Write one day's piece of every job in task from a single read of the CONUS1 file"""
+    state = _split_state if state is None else state
+    fname_in, dt_str, job_ids = task
+    with rasterio.open(fname_in) as src:
+        windows = [state['cuts'][i][0] for i in job_ids]
+        union   = rasterio.windows.union(windows)
+        arr     = src.read(1, window=union)
+        nodata  = src.nodata if src.nodata is not None else numpy.nan
+        if numpy.isnan(nodata) and not numpy.issubdtype(arr.dtype, numpy.floating):
+            arr = arr.astype(numpy.float32)
+        profile = {'driver'    : 'GTiff',
+                   'count'     : 1,
+                   'dtype'     : arr.dtype,
+                   'crs'       : src.crs,
+                   'nodata'    : nodata,
+                   'compress'  : 'LZMA'}
+        for i, window in zip(job_ids, windows):
+            mask = state['cuts'][i][1]
+            r0, c0 = window.row_off - union.row_off, window.col_off - union.col_off
+            data = numpy.where(mask, arr[r0:r0+window.height, c0:c0+window.width], nodata).astype(arr.dtype)
+            fname_out = os.path.join(state['out_dirs'][i],'wtd_'+dt_str+'.tiff')
+            profile.update({'height'    : window.height,
+                            'width'     : window.width,
+                            'transform' : rasterio.windows.transform(window, src.transform)})
+            # written under a temporary name, an interrupted day is not mistaken for a complete one
+            with rasterio.open(fname_out+'.part', 'w', **profile) as dst:
+                dst.write(data, 1)
+            os.replace(fname_out+'.part', fname_out)
+    return dt_str
+
 def download_hydroframe_data(**kwargs):
     domain    = kwargs.get('domain',    None)
     dt_start  = kwargs.get('dt_start',  None)
@@ -149,6 +381,7 @@ def download_hydroframe_data(**kwargs):
     dir_wtd   = kwargs.get('dir_wtd',   None)
     verbose   = kwargs.get('verbose',   False)
     overwrite = kwargs.get('overwrite', False)
+    workers   = kwargs.get('workers',   4)
     if verbose: print('calling download_hydroframe_data')
     if domain is None or not isinstance(domain,geopandas.GeoDataFrame):
         raise Exception(f'download_hydroframe_data missing required argument domain or is not a valid geopandas.GeoDataFrame')
@@ -159,47 +392,71 @@ def download_hydroframe_data(**kwargs):
     if dir_wtd is None:
         raise Exception(f'download_hydroframe_data missing required argument dir_wtd')
     if not os.path.isdir(dir_wtd): os.makedirs(dir_wtd,exist_ok=True)
-    if verbose: print(f' using hf_hydrodata to download parflow water table depth simulations to {dir_wtd}')
+    # only the missing dates are requested, one hf_hydrodata query per contiguous range of them
+    ranges = twtutils.date_ranges(twtutils.missing_dates(dir_wtd, dt_start, dt_end, 'wtd_', overwrite=overwrite))
+    if len(ranges) == 0:
+        if verbose: print(f' found water table depth data for all dates in range in {dir_wtd}')
+        return
+    if verbose: print(f' using hf_hydrodata to download parflow water table depth simulations to {dir_wtd} ({len(ranges)} date range(s))')
     conus1_proj, _, conus1_transform, conus1_shape = _get_parflow_conus1_grid_info()
     domain        = geopandas.GeoDataFrame(domain.drop(columns=['geometry']), 
                                             geometry=domain.to_crs(conus1_proj).buffer(distance=1000),              
                                             crs=conus1_proj)
     kwargs['domain']   = domain # overwriting with buffered gdf
-    hf_data            = hf_query(**kwargs)
-    hf_conus1grid_temp = numpy.empty(shape=conus1_shape,dtype=numpy.float64)
     grid_bounds        = _get_parflow_conus1_bbox(domain)
-    for i in range(hf_data.shape[0]):
-        idt = dt_start + datetime.timedelta(days=i)
+    window, outside    = _conus1_crop(domain.geometry.union_all(), conus1_proj, conus1_transform, conus1_shape)
+    # rows and columns of the crop window covered by the returned subset (conus1 rows grid_bounds[1]:grid_bounds[3])
+    rows = slice(max(window.row_off, grid_bounds[1]), min(window.row_off + window.height, grid_bounds[3]))
+    cols = slice(max(window.col_off, grid_bounds[0]), min(window.col_off + window.width,  grid_bounds[2]))
+    wtd_meta = {"driver"    : "GTiff",
+                "height"    : window.height,
+                "width"     : window.width,
+                "count"     : 1,
+                "dtype"     : "float32",
+                "crs"       : conus1_proj,
+                "transform" : rasterio.windows.transform(window, conus1_transform),
+                "nodata"    : numpy.nan}
+    def write_day(hf_data, range_start, i):
+        idt = range_start + datetime.timedelta(days=i)
         fname = os.path.join(dir_wtd,'wtd_'+idt.strftime('%Y%m%d')+'.tiff')
-        if not os.path.isfile(fname) or overwrite:
-            hf_conus1grid_temp[grid_bounds[1]:grid_bounds[3],
-                                grid_bounds[0]:grid_bounds[2]] = hf_data[i,:,:]
-            with rasterio.io.MemoryFile() as memfile:
-                hf_conus1data = memfile.open(driver    = "GTiff", 
-                                            height    = hf_conus1grid_temp.shape[0], 
-                                            width     = hf_conus1grid_temp.shape[1], 
-                                            crs       = conus1_proj, 
-                                            transform = conus1_transform, 
-                                            nodata    = numpy.nan, 
-                                            count     = 1, 
-                                            dtype     = numpy.float64)
-                hf_conus1data.write(hf_conus1grid_temp,1)
-                wtd_data, wtd_transform = rasterio.mask.mask(dataset    = hf_conus1data, 
-                                                            shapes      = [domain.geometry.union_all()], 
-                                                            crop        = True, 
-                                                            all_touched = True, 
-                                                            filled      = True, 
-                                                            pad         = True,
-                                                            nodata      = numpy.nan)
-                wtd_meta = hf_conus1data.meta
-                wtd_meta.update({"driver"   : "GTiff",
-                                "height"    : wtd_data.shape[1],
-                                "width"     : wtd_data.shape[2],
-                                "transform" : wtd_transform, 
-                                "nodata"    : numpy.nan})
-                with rasterio.open(fname,'w',**wtd_meta) as wtd_dataset:
-                    wtd_dataset.write(wtd_data[0,:,:],1)
-    del hf_data, hf_conus1grid_temp
+        wtd_data = numpy.full((window.height, window.width), numpy.nan, dtype=numpy.float32)
+        wtd_data[rows.start-window.row_off:rows.stop-window.row_off,
+                 cols.start-window.col_off:cols.stop-window.col_off] = hf_data[i,
+                                                                               rows.start-grid_bounds[1]:rows.stop-grid_bounds[1],
+                                                                               cols.start-grid_bounds[0]:cols.stop-grid_bounds[0]]
+        wtd_data[outside] = numpy.nan
+        with rasterio.open(fname,'w',**wtd_meta) as wtd_dataset:
+            wtd_dataset.write(wtd_data,1)
+    # the encoders release the GIL, so the days are written by a few threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(workers))) as pool:
+        for range_start, range_end in ranges:
+            if verbose: print(f'  requesting {range_start.strftime("%Y-%m-%d")} to {range_end.strftime("%Y-%m-%d")}')
+            kwargs['dt_start'], kwargs['dt_end'] = range_start, range_end
+            hf_data = hf_query(**kwargs)
+            list(pool.map(lambda i: write_day(hf_data, range_start, i), range(hf_data.shape[0])))
+            del hf_data
+
+def _conus1_crop(geom, conus1_proj, conus1_transform, conus1_shape):
+    """
+    Window of the CONUS1 grid cropped to geom and the mask of the cells in it
+    outside geom - what rasterio.mask.mask(crop=True, all_touched=True,
+    pad=True) gives for a CONUS1 raster, computed once without the raster
+    """
+    with rasterio.io.MemoryFile() as memfile:
+        with memfile.open(driver    = "GTiff",
+                          height    = conus1_shape[0],
+                          width     = conus1_shape[1],
+                          crs       = conus1_proj,
+                          transform = conus1_transform,
+                          count     = 1,
+                          dtype     = numpy.float32,
+                          sparse_ok = True) as conus1_grid:
+            outside, _, window = rasterio.mask.raster_geometry_mask(dataset     = conus1_grid,
+                                                                    shapes      = [geom],
+                                                                    all_touched = True,
+                                                                    crop        = True,
+                                                                    pad         = True)
+    return window, outside
 
 def _get_latlon_parflow_grid(grid_minx,grid_miny,grid_maxx,grid_maxy):
     """Get latlon bbox from ParFlow CONUS1 grid xy bbox"""
@@ -245,29 +502,175 @@ def _get_parflow_conus2_grid_info():
     return conus2_proj,conus2_spatext,conus2_transform,conus2_shape
 
 def get_conus1_tiffs(**kwargs):
-    dt_start = kwargs.get('dt_start', None)
-    dt_end   = kwargs.get('dt_end',   None)
-    savedir  = kwargs.get('savedir',  None)
-    verbose  = kwargs.get('verbose',  False)
+    """
+    Download the daily CONUS1 water table depth tiffs
+    (conus1_baseline_mod_water_table_depth_YYYYMMDD.tiff) from dt_start to
+    dt_end that are missing in savedir.
+
+    Days are fetched by workers threads and at most rate requests are
+    started per second (no limit when rate is None). A failed request is
+    retried up to max_retries times after an exponential backoff of
+    backoff * 2**attempt seconds (with jitter, at most max_backoff). Each day
+    is written to a .part file and renamed when complete, so an interrupted
+    run leaves no partial tiffs and a rerun picks up the missing days (http
+    downloads also continue their .part files with range requests). The
+    days done and the days that failed, with their last error, are kept in
+    savedir/get_conus1_tiffs_progress.json.
+
+    The days come from the wtd provider (default hf_hydrodata, see
+    twtproviders) or, with url_template
+    (e.g. 'http://host/wtd/{ymd}.tiff', ymd is YYYYMMDD), over http from a
+    mirror or a local test server. Returns the dates that failed.
+    """
+    dt_start     = kwargs.get('dt_start',     None)
+    dt_end       = kwargs.get('dt_end',       None)
+    savedir      = kwargs.get('savedir',      None)
+    verbose      = kwargs.get('verbose',      False)
+    workers      = kwargs.get('workers',      4)
+    rate         = kwargs.get('rate',         None)
+    max_retries  = kwargs.get('max_retries',  10)
+    backoff      = kwargs.get('backoff',      1.)
+    max_backoff  = kwargs.get('max_backoff',  60.)
+    url_template = kwargs.get('url_template', None)
+    timeout      = kwargs.get('timeout',      120.)
+    provider     = kwargs.get('provider',     None) or twtproviders.HFHydrodataWTD()
     if verbose: print('calling get_conus1_tiffs')
+    if dt_start is None or not isinstance(dt_start,datetime.datetime):
+        raise Exception(f'get_conus1_tiffs missing required argument dt_start or is not a valid datetime')
+    if dt_end is None or not isinstance(dt_end,datetime.datetime):
+        raise Exception(f'get_conus1_tiffs missing required argument dt_end or is not a valid datetime')
+    if savedir is None:
+        raise Exception(f'get_conus1_tiffs missing required argument savedir')
     if not os.path.isdir(savedir): os.makedirs(savedir,exist_ok=True)
-    options_wtd    = {"dataset"             : "conus1_baseline_mod",
-                      "temporal_resolution" : "daily"}
-    idatetime = dt_start
-    while idatetime <= dt_end:
-        if verbose: print(f' working on {idatetime.strftime('%Y-%m-%d')}')
-        options_wtd["start_time"] = idatetime.strftime('%Y-%m-%d')
-        options_wtd["end_time"] = idatetime.strftime('%Y-%m-%d')
-        fname = os.path.join(savedir,f'conus1_baseline_mod_water_table_depth_{idatetime.strftime('%Y%m%d')}.tiff')
-        if not os.path.isfile(fname):
-            c = 0
-            while c < 10:
-                try:
-                    hf_hydrodata.get_gridded_files(options_wtd,
-                                                variables=['water_table_depth'],
-                                                filename_template=os.path.join(savedir,"{dataset}_{variable}_{ymd}.tiff"),
-                                                verbose=True)
+    prefix = 'conus1_baseline_mod_water_table_depth_'
+    dates  = twtutils.missing_dates(savedir, dt_start, dt_end, prefix)
+    if len(dates) == 0:
+        if verbose: print(f' found conus1 water table depth tiffs for all dates in range in {savedir}')
+        return list()
+    progress = _DownloadProgress(os.path.join(savedir, 'get_conus1_tiffs_progress.json'))
+    limiter  = _RateLimiter(rate)
+    def get_day(idt):
+        ymd        = idt.strftime('%Y%m%d')
+        fname      = os.path.join(savedir, f'{prefix}{ymd}.tiff')
+        fname_part = f'{fname}.part'
+        for attempt in range(max_retries + 1):
+            limiter.wait()
+            try:
+                if url_template is not None:
+                    _fetch_url(url_template.format(ymd=ymd), fname_part, timeout)
+                else:
+                    _fetch_provider_day(idt, savedir, fname_part, provider)
+                os.replace(fname_part, fname)
+                progress.done(ymd)
+                return None
+            except Exception as e:
+                error = e
+                if attempt == max_retries or _is_permanent(e):
                     break
-                except Exception as e:
-                    c += 1
-        idatetime += datetime.timedelta(days=1)
\ No newline at end of file
+                time.sleep(min(max_backoff, backoff * 2**attempt) * random.uniform(0.5, 1.))
+        progress.failed(ymd, error)
+        return idt
+    workers = max(1, min(int(workers or 1), len(dates)))
+    if verbose: print(f' downloading {len(dates)} days to {savedir} with {workers} thread(s)')
+    failed = list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for idt, idt_failed in zip(dates, pool.map(get_day, dates)):
+            if idt_failed is not None:
+                failed.append(idt_failed)
+                print(f'WARNING get_conus1_tiffs could not download {idt.strftime("%Y-%m-%d")}: {progress.errors.get(idt.strftime("%Y%m%d"))}', flush=True)
+            elif verbose:
+                print(f'  downloaded {idt.strftime("%Y-%m-%d")}', flush=True)
+    return failed
+
+def _fetch_provider_day(idt, savedir, fname_part, provider):
+    """One day of conus1 water table depth from a wtd provider (see twtproviders), written to fname_part"""
+    options_wtd = {"dataset"             : "conus1_baseline_mod",
+                   "temporal_resolution" : "daily",
+                   "start_time"          : idt.strftime('%Y-%m-%d'),
+                   "end_time"            : idt.strftime('%Y-%m-%d')}
+    # the provider names the file itself, so it writes to a private directory first
+    tmpdir = tempfile.mkdtemp(prefix=f'.{idt.strftime("%Y%m%d")}_', dir=savedir)
+    try:
+        provider.get_gridded_files(options_wtd,
+                                   variables=['water_table_depth'],
+                                   filename_template=os.path.join(tmpdir,"{dataset}_{variable}_{ymd}.tiff"),
+                                   verbose=False)
+        fnames = os.listdir(tmpdir)
+        if len(fnames) != 1:
+            raise Exception(f'get_gridded_files wrote {len(fnames)} files for {idt.strftime("%Y-%m-%d")}')
+        os.replace(os.path.join(tmpdir, fnames[0]), fname_part)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def _fetch_url(url, fname_part, timeout):
+    """Download url to fname_part, continuing an existing fname_part with a range request"""
+    offset  = os.path.getsize(fname_part) if os.path.isfile(fname_part) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset > 0 else dict()
+    try:
+        resp = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset > 0: # nothing left to get
+            return
+        raise
+    with resp:
+        if offset > 0 and resp.status != 206: # range not supported, start over
+            offset = 0
+        length = resp.headers.get('Content-Length')
+        with open(fname_part, 'ab' if offset > 0 else 'wb') as f:
+            shutil.copyfileobj(resp, f, 2**20)
+    if length is not None and os.path.getsize(fname_part) != offset + int(length):
+        raise IOError(f'incomplete download of {url}')
+
+def _is_permanent(e):
+    """Errors a retry will not fix (e.g. http 404)"""
+    return isinstance(e, urllib.error.HTTPError) and 400 <= e.code < 500 and e.code not in (408, 425, 429)
+
+class _RateLimiter:
+    """Spaces the starts of requests (from any thread) at least 1/rate seconds apart"""
+
+    def __init__(self, rate=None):
+        self.interval = 1. / rate if rate else 0.
+        self._next    = 0.
+        self._lock    = threading.Lock()
+
+    def wait(self):
+        if self.interval <= 0.: return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(start - now)
+
+class _DownloadProgress:
+    """Days done and failed (with their last error) of get_conus1_tiffs, kept in a json file across runs"""
+
+    def __init__(self, fname):
+        self.fname  = fname
+        self._lock  = threading.Lock()
+        self.days   = set()
+        self.errors = dict()
+        if os.path.isfile(fname):
+            try:
+                with open(fname, 'r') as f:
+                    data = json.load(f)
+                self.days   = set(data.get('done', list()))
+                self.errors = dict(data.get('failed', dict()))
+            except (ValueError, OSError):
+                pass
+
+    def done(self, ymd):
+        with self._lock:
+            self.days.add(ymd)
+            self.errors.pop(ymd, None)
+            self._save()
+
+    def failed(self, ymd, error):
+        with self._lock:
+            self.errors[ymd] = f'{type(error).__name__}: {error}'
+            self._save()
+
+    def _save(self):
+        fname_tmp = f'{self.fname}.{os.getpid()}.tmp'
+        with open(fname_tmp, 'w') as f:
+            json.dump({'done': sorted(self.days), 'failed': self.errors}, f, indent=1, sort_keys=True)
+        os.replace(fname_tmp, self.fname)
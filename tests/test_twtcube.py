@@ -0,0 +1,125 @@
+import os
+import sys
+import datetime
+import numpy
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+rasterio = pytest.importorskip('rasterio')
+import rasterio.transform
+from rasterio.windows import Window
+from twtcube import InundationCube
+
+DT_START = datetime.datetime(2020, 1, 30)
+N_DAYS   = 10
+
+def _profile(height, width):
+    return {'height'    : height,
+            'width'     : width,
+            'crs'       : rasterio.crs.CRS.from_epsg(5070),
+            'transform' : rasterio.transform.from_origin(0., 0., 30., 30.)}
+
+def _days(height, width, seed=0):
+    """Clustered wet flags that change a little from day to day"""
+    rng = numpy.random.default_rng(seed)
+    base = rng.random((height, width))
+    return numpy.stack([base + 0.05 * i + 0.1 * rng.random((height, width)) > 0.7 for i in range(N_DAYS)])
+
+def _dates(i0, i1):
+    return DT_START + datetime.timedelta(days=i0), DT_START + datetime.timedelta(days=i1)
+
+def _write(cube, wet, windows):
+    for i in range(N_DAYS):
+        for window in windows:
+            cube.write_day(i, wet[i][window.toslices()], window=window)
+        cube.set_done(i)
+
+def _check(cube, wet):
+    height, width = wet.shape[1:]
+    for i, dt in enumerate(cube.dates):
+        assert (cube.read_day(dt, as_bool=True) == wet[i]).all()
+        day = cube.read_day(dt)
+        assert day.dtype == numpy.float32
+        assert (numpy.isnan(day) == ~wet[i]).all() and (day[wet[i]] == 1.).all()
+    window = Window(8, 3, width - 9, height - 5) if width > 9 else Window(0, 1, width - 1, height - 2)
+    slices = window.toslices()
+    assert (cube.read_range(*_dates(2, 8), window=window) == wet[2:9][(slice(None),) + slices]).all()
+    assert (cube.read_range(*_dates(0, N_DAYS - 1)) == wet).all()
+    for row, col in ((0, 0), (height - 1, width - 1), (height // 2, min(13, width - 1))):
+        assert (cube.read_pixel(row, col) == wet[:, row, col]).all()
+        assert (cube.read_pixel(row, col, *_dates(3, 7)) == wet[3:8, row, col]).all()
+    assert (cube.count_wet() == wet.sum(axis=0)).all()
+    assert cube.count_wet().dtype == numpy.uint16
+    assert (cube.count_wet(*_dates(1, 6), window=window) == wet[1:7][(slice(None),) + slices].sum(axis=0)).all()
+
+@pytest.mark.parametrize('codec', ['bz2', 'zlib'])
+@pytest.mark.parametrize('height, width', [(13, 21), (16, 32), (7, 3)])
+def test_round_trip(tmp_path, codec, height, width):
+    wet = _days(height, width)
+    dirname = str(tmp_path / 'cube')
+    cube = InundationCube.create(dirname, *_dates(0, N_DAYS - 1), _profile(height, width),
+                                 block_days=4, chunk_rows=5, codec=codec)
+    windows = [Window(col, row, min(8, width - col), min(6, height - row))
+               for row in range(0, height, 6) for col in range(0, width, 8)]
+    _write(cube, wet, windows)
+    assert len(cube.missing_days()) == 0
+    _check(cube, wet)
+    cube.close()
+    assert sorted(os.listdir(os.path.join(dirname, 'wet'))) == [f'block_{b:05d}.bin' for b in range(3)]
+    cube = InundationCube(dirname)
+    _check(cube, wet)
+    cube.close()
+
+def test_read_before_block_is_complete(tmp_path):
+    height, width = 11, 19
+    wet = _days(height, width, seed=1)
+    cube = InundationCube.create(str(tmp_path / 'cube'), *_dates(0, N_DAYS - 1), _profile(height, width),
+                                 block_days=4, chunk_rows=4)
+    for i in range(6):
+        cube.write_day(i, wet[i])
+        cube.set_done(i)
+    cube.write_day(6, wet[6])
+    assert os.path.isfile(cube._block_fname(0)) and not os.path.isfile(cube._block_fname(1))
+    assert (cube.read_range(*_dates(0, 6)) == wet[:7]).all()
+    assert not cube.read_range(*_dates(7, 9)).any()
+    assert (cube.count_wet(*_dates(0, 6)) == wet[:7].sum(axis=0)).all()
+    assert list(cube.missing_days()) == [6, 7, 8, 9]
+
+def test_days_written_by_separate_writers(tmp_path):
+    height, width = 9, 17
+    wet = _days(height, width, seed=2)
+    dirname = str(tmp_path / 'cube')
+    InundationCube.create(dirname, *_dates(0, N_DAYS - 1), _profile(height, width), block_days=4, chunk_rows=4).close()
+    writers = [InundationCube(dirname, mode='r+') for _ in range(2)]
+    for i in range(N_DAYS):
+        writers[i % 2].write_day(i, wet[i])
+        writers[i % 2].set_done(i)
+    for writer in writers:
+        writer.close()
+    assert not [name for name in os.listdir(os.path.join(dirname, 'wet')) if not name.startswith('block_')]
+    _check(InundationCube(dirname), wet)
+
+def test_compresses_slowly_changing_days(tmp_path):
+    height, width = 256, 512
+    rng = numpy.random.default_rng(3)
+    field = numpy.cumsum(numpy.cumsum(rng.standard_normal((height, width)), axis=0), axis=1)
+    wet = numpy.stack([field > numpy.quantile(field, 0.7 - 0.002 * i) for i in range(N_DAYS)])
+    dirname = str(tmp_path / 'cube')
+    cube = InundationCube.create(dirname, *_dates(0, N_DAYS - 1), _profile(height, width))
+    _write(cube, wet, [Window(0, 0, width, height)])
+    cube.close()
+    stored = sum(os.path.getsize(os.path.join(dirname, 'wet', name)) for name in os.listdir(os.path.join(dirname, 'wet')))
+    assert stored * 8 < wet[0].size * N_DAYS / 8
+
+def test_older_layout_is_recreated(tmp_path):
+    dirname = str(tmp_path / 'cube')
+    os.makedirs(dirname)
+    with open(os.path.join(dirname, 'meta.json'), 'w') as f:
+        f.write('{"dt_start": "20200130", "n_days": 10}')
+    numpy.save(os.path.join(dirname, 'wet.npy'), numpy.zeros((10, 4, 1), dtype=numpy.uint8))
+    with pytest.raises(ValueError):
+        InundationCube(dirname)
+    cube = InundationCube.open_or_create(dirname, *_dates(0, N_DAYS - 1), _profile(4, 5))
+    assert not os.path.exists(os.path.join(dirname, 'wet.npy'))
+    assert len(cube.missing_days()) == N_DAYS
+    cube.close()
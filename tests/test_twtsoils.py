@@ -0,0 +1,31 @@
+import os
+import sys
+import numpy
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+soiltexture = pytest.importorskip('soiltexture')
+twtsoils    = pytest.importorskip('twtsoils')
+
+def _grid(step=0.5):
+    """Every (sand, clay) pair on a step % grid with sand + clay <= 100, plus NaN pairs"""
+    values = numpy.arange(0., 100. + step, step)
+    sand, clay = numpy.meshgrid(values, values, indexing='ij')
+    keep = sand + clay <= 100.
+    sand = numpy.concatenate([sand[keep], [numpy.nan, 50., numpy.nan]])
+    clay = numpy.concatenate([clay[keep], [20., numpy.nan, numpy.nan]])
+    return sand, clay
+
+@pytest.mark.parametrize('classification', sorted(soiltexture.texture.tables))
+def test_classify_texture_matches_get_texture(classification):
+    sand, clay = _grid()
+    texture = twtsoils.classify_texture(sand, clay, classification=classification)
+    expected = [soiltexture.getTexture(s, c, classification=classification) for s, c in zip(sand, clay)]
+    mismatch = [(s, c, t, e) for s, c, t, e in zip(sand, clay, texture, expected) if t != e]
+    assert mismatch == []
+
+def test_classify_texture_keeps_shape():
+    sand, clay = _grid(step=5.)
+    texture = twtsoils.classify_texture(sand[:20].reshape(4, 5), clay[:20].reshape(4, 5))
+    assert texture.shape == (4, 5)
+    assert texture[0, 0] == soiltexture.getTexture(sand[0], clay[0])